@@ -0,0 +1,9 @@
+import os
+import django
+
+
+def setup():
+    '''Configure Django for a standalone benchmark run'''
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'chatAPI.settings')
+    os.environ.setdefault('SECRET_KEY', 'benchmark')
+    django.setup()
@@ -0,0 +1,162 @@
+'''
+Chat sends (POST) through chatAPI.asgi.application with the sync viewset
+action, which bridges to group_send with async_to_sync, and with the async view
+(CHAT_ASYNC_VIEWS), which awaits it on the event loop. Sends are also measured
+with fire-and-forget fan-out (CHAT_FANOUT_ASYNC), where the response does not
+wait for group_send at all.
+
+Joins (GET) are measured too; they have nothing to await, so they show the
+cost of each view on its own. Concurrent senders hit one room. With the in-memory channel layer, group_send
+is slowed by --publish-delay to stand in for a Redis round trip. Reports
+latency percentiles, requests per second, the time a worker thread is held per
+request and the peak number of threads.
+
+    python -m benchmarks.async_views --concurrency 50 --requests 1000 --publish-delay 0.002
+'''
+import argparse
+import asyncio
+import json
+import threading
+import time
+from . import setup
+from .load import configure, create_fixtures, percentiles
+
+
+class ThreadTimer:
+    '''Time spent inside the sync viewset, i.e. holding a worker thread, per request'''
+
+    def __init__(self):
+        self.seconds = 0.0
+        self.calls = 0
+        self.lock = threading.Lock()
+
+    def wrap(self, dispatch):
+        timer = self
+
+        def timed(view, request, *args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return dispatch(view, request, *args, **kwargs)
+            finally:
+                with timer.lock:
+                    timer.seconds += time.perf_counter() - started
+                    timer.calls += 1
+        return timed
+
+
+async def watch_threads(peak, stop):
+    while not stop.is_set():
+        peak[0] = max(peak[0], threading.active_count())
+        await asyncio.sleep(0.001)
+
+
+async def request(application, method, path, token, body=b''):
+    from channels.testing import HttpCommunicator
+    headers = [
+        (b'host', b'testserver'),
+        (b'authorization', f'Bearer {token}'.encode()),
+        (b'content-type', b'application/json'),
+        (b'content-length', str(len(body)).encode()),
+    ]
+    started = time.perf_counter()
+    response = await HttpCommunicator(application, method, path, body=body, headers=headers).get_response(timeout=60)
+    return response['status'], time.perf_counter() - started
+
+
+async def run(application, method, path, tokens, total):
+    from chat.fanout import publisher
+    body = json.dumps({'content': 'hello'}).encode() if method == 'POST' else b''
+    queue = list(range(total))
+    times = []
+    failures = 0
+
+    async def worker(token):
+        nonlocal failures
+        while queue:
+            queue.pop()
+            status, seconds = await request(application, method, path, token, body)
+            times.append(seconds)
+            failures += status not in (200, 201)
+
+    peak, stop = [threading.active_count()], asyncio.Event()
+    watcher = asyncio.ensure_future(watch_threads(peak, stop))
+    started = time.perf_counter()
+    await asyncio.gather(*[worker(token) for token in tokens])
+    elapsed = time.perf_counter() - started
+    await publisher.drain()
+    stop.set()
+    await watcher
+    return times, failures, elapsed, peak[0]
+
+
+def measure(mode, method, args, path, tokens, timer):
+    from django.conf import settings
+    from chatAPI.asgi import application
+
+    settings.CHAT_ASYNC_VIEWS = mode != 'sync'
+    settings.CHAT_FANOUT_ASYNC = mode == 'fanout'
+    timer.seconds, timer.calls = 0.0, 0
+    times, failures, elapsed, peak_threads = asyncio.run(run(application, method, path, tokens, args.requests))
+    return {
+        'failures': failures,
+        'requests_per_second': round(args.requests / elapsed, 1),
+        'latency_ms': percentiles(times),
+        'thread_ms_per_request': round(timer.seconds / max(timer.calls, 1) * 1000, 3),
+        'peak_threads': peak_threads,
+    }
+
+
+def slow_group_send(delay):
+    from channels.layers import get_channel_layer
+    layer = get_channel_layer()
+    group_send = layer.group_send
+
+    async def delayed(group, message):
+        await asyncio.sleep(delay)
+        await group_send(group, message)
+    layer.group_send = delayed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--concurrency', type=int, default=50, help='Concurrent senders')
+    parser.add_argument('--requests', type=int, default=1000, help='Requests per mode and method')
+    parser.add_argument('--publish-delay', type=float, default=0.002, help='Seconds added to each group_send (memory layer only)')
+    parser.add_argument('--layer', choices=['memory', 'redis'], default='memory')
+    args = parser.parse_args()
+
+    setup()
+    configure(args.layer)
+    from django.db import connection
+    from chat.views import ChatRoomViewSet
+
+    timer = ThreadTimer()
+    ChatRoomViewSet.dispatch = timer.wrap(ChatRoomViewSet.dispatch)
+    if args.layer == 'memory' and args.publish_delay:
+        slow_group_send(args.publish_delay)
+
+    test_database = connection.creation.create_test_db(verbosity=0, autoclobber=True)
+    try:
+        room_id, tokens = create_fixtures(0, args.concurrency)
+        path = f'/api/v1/chatroom/{room_id}/chat/'
+        results = {
+            f'{mode}_{name}': measure(mode, method, args, path, tokens[1:], timer)
+            for name, method, modes in [('send', 'POST', ('sync', 'async', 'fanout')), ('join', 'GET', ('sync', 'async'))]
+            for mode in modes
+        }
+    finally:
+        connection.creation.destroy_test_db(test_database, verbosity=0)
+
+    print(json.dumps({
+        'benchmark': 'async_views',
+        'database': connection.vendor,
+        'layer': args.layer,
+        'concurrency': args.concurrency,
+        'requests': args.requests,
+        'publish_delay': args.publish_delay if args.layer == 'memory' else None,
+        'results': results,
+    }, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,83 @@
+'''
+CPU cost of delivering one chat message to every subscriber of a room.
+
+Compares per-subscriber encoding (each consumer encodes the event itself) with
+serialize-once (the publisher encodes once, consumers forward the bytes).
+Subscribers are real ChatConsumer handlers with the socket send stubbed out.
+
+    python -m benchmarks.broadcast --sizes 10 100 1000 5000
+'''
+import argparse
+import asyncio
+import json
+import time
+from . import setup
+
+
+def run(sizes, repeat, protocol_name):
+    from chat.consumers import ChatConsumer
+    from chat.protocol import JSONProtocol, MsgpackProtocol, encode_once
+
+    protocol_class = {'json': JSONProtocol, 'msgpack': MsgpackProtocol}[protocol_name]
+    event = {
+        'type': 'chat_message',
+        'message': 'Message with id 7f9c0d6e-7a55-4d3c-9d0e-2f0b8c3c1a11 was created!',
+        'message_id': '7f9c0d6e-7a55-4d3c-9d0e-2f0b8c3c1a11',
+        'content': 'Hello everyone, this is a fairly ordinary chat message. ' * 2,
+        'date_sent': '2024-09-09T09:35:00.000000+00:00',
+        'user': 'testuser',
+        'room_name': 'general',
+    }
+
+    async def no_op_send(**frame):
+        pass
+
+    def consumers(count):
+        subscribers = []
+        for _ in range(count):
+            consumer = ChatConsumer()
+            consumer.protocol = protocol_class()
+            consumer.send = no_op_send
+            subscribers.append(consumer)
+        return subscribers
+
+    async def broadcast(subscribers, encode):
+        delivered = encode_once(event) if encode else event
+        for consumer in subscribers:
+            await consumer.chat_message(delivered)
+
+    def measure(subscribers, encode):
+        best = None
+        for _ in range(repeat):
+            started = time.process_time()
+            asyncio.run(broadcast(subscribers, encode))
+            elapsed = time.process_time() - started
+            best = elapsed if best is None else min(best, elapsed)
+        return best
+
+    results = []
+    for size in sizes:
+        subscribers = consumers(size)
+        per_subscriber = measure(subscribers, encode=False)
+        once = measure(subscribers, encode=True)
+        results.append({
+            'room_size': size,
+            'per_subscriber_encode_cpu_ms': round(per_subscriber * 1000, 3),
+            'serialize_once_cpu_ms': round(once * 1000, 3),
+            'speedup': round(per_subscriber / once, 2) if once else None,
+        })
+    return {'benchmark': 'broadcast', 'protocol': protocol_name, 'repeat': repeat, 'results': results}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10, 100, 1000, 5000])
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--protocol', choices=['json', 'msgpack'], default='json')
+    args = parser.parse_args()
+    setup()
+    print(json.dumps(run(args.sizes, args.repeat, args.protocol), indent=2))
+
+
+if __name__ == '__main__':
+    main()
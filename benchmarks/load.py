@@ -0,0 +1,241 @@
+'''
+End-to-end load test of the chat hot paths, in one process.
+
+WebSocket clients join a room through chatAPI.asgi.application while REST
+senders POST to ChatRoomViewSet.chat and some of the sockets send too. Runs
+against a throwaway test database (SQLite, or PostgreSQL with DB_ENGINE) and
+the in-memory channel layer unless --layer redis is given.
+
+Reports send-to-receive latency percentiles, throughput, REST response times,
+queries per send and Python heap per connection, as JSON.
+
+    python -m benchmarks.load --clients 200 --rest-senders 4 --ws-senders 4 --messages 50
+'''
+import argparse
+import asyncio
+import gc
+import json
+import threading
+import time
+import tracemalloc
+from . import setup
+
+PROBE_SENDS = 20
+
+
+def percentiles(values):
+    '''p50/p95/p99/max in milliseconds (nearest rank)'''
+    if not values:
+        return None
+    values = sorted(values)
+    pick = lambda p: values[min(len(values) - 1, int(round(p / 100 * len(values) + 0.5)) - 1)]
+    return {f'p{p}': round(pick(p) * 1000, 3) for p in (50, 95, 99)} | {'max': round(values[-1] * 1000, 3)}
+
+
+class QueryCounter:
+    '''execute_wrapper counting queries on every connection, in every thread'''
+
+    def __init__(self):
+        self.count = 0
+        self.lock = threading.Lock()
+
+    def __call__(self, execute, sql, params, many, context):
+        with self.lock:
+            self.count += 1
+        return execute(sql, params, many, context)
+
+    def install(self, sender, connection, **kwargs):
+        # Fired again each time a closed connection object reconnects
+        if self not in connection.execute_wrappers:
+            connection.execute_wrappers.append(self)
+
+
+def configure(layer):
+    from django.conf import settings
+    settings.ALLOWED_HOSTS = ['testserver']
+    # Measuring throughput, not the rate limiter
+    settings.CHAT_SEND_RATE_PER_USER = 0
+    settings.CHAT_SEND_RATE_PER_ROOM = 0
+    settings.CHAT_SEND_RATE_PER_CONNECTION = 0
+    if layer == 'memory':
+        settings.CHANNEL_LAYERS = {
+            'default': {'BACKEND': 'channels.layers.InMemoryChannelLayer', 'CONFIG': {'capacity': 100000}},
+        }
+
+
+def create_fixtures(clients, rest_senders):
+    from django.contrib.auth import get_user_model
+    from rest_framework_simplejwt.tokens import AccessToken
+    from chat.models import ChatRoom
+
+    User = get_user_model()
+    users = User.objects.bulk_create([User(username=f'load{i}') for i in range(max(clients, rest_senders) + 1)])
+    room = ChatRoom.objects.create(room_name='load', creator=users[0])
+    room.members.add(*users)
+    return str(room.room_id), [str(AccessToken.for_user(user)) for user in users]
+
+
+class LoadTest:
+    def __init__(self, args, room_id, tokens, counter):
+        from chatAPI.asgi import application
+        self.application = application
+        self.args = args
+        self.room_id = room_id
+        self.tokens = tokens
+        self.counter = counter
+        self.rest_times = []
+        self.latencies = []
+
+    def socket(self, token):
+        from channels.testing import WebsocketCommunicator
+        return WebsocketCommunicator(self.application, f'chat/{self.room_id}/?token={token}')
+
+    def payload(self):
+        return json.dumps({'sent_at': time.perf_counter()})
+
+    async def rest_send(self, token):
+        from channels.testing import HttpCommunicator
+        started = time.perf_counter()
+        body = json.dumps({'content': self.payload()}).encode()
+        communicator = HttpCommunicator(
+            self.application, 'POST', f'/api/v1/chatroom/{self.room_id}/chat/', body=body,
+            headers=[
+                (b'host', b'testserver'),
+                (b'content-type', b'application/json'),
+                (b'content-length', str(len(body)).encode()),
+                (b'authorization', f'Bearer {token}'.encode()),
+            ],
+        )
+        response = await communicator.get_response(timeout=self.args.timeout)
+        self.rest_times.append(time.perf_counter() - started)
+        return response['status']
+
+    async def probe(self):
+        '''Queries per send, measured one send at a time before the load starts'''
+        start = self.counter.count
+        for _ in range(PROBE_SENDS):
+            await self.rest_send(self.tokens[0])
+        rest = (self.counter.count - start) / PROBE_SENDS
+        self.rest_times.clear()
+
+        client = self.socket(self.tokens[0])
+        await client.connect()
+        start = self.counter.count
+        for _ in range(PROBE_SENDS):
+            await client.send_json_to({'type': 'message', 'content': self.payload()})
+            while (await client.receive_json_from(timeout=self.args.timeout)).get('type') != 'ack':
+                pass
+        ws = (self.counter.count - start) / PROBE_SENDS
+        await client.disconnect()
+        return rest, ws
+
+    async def connect(self, count):
+        '''Connect the clients, measuring the Python heap they add'''
+        gc.collect()
+        tracemalloc.start()
+        before = tracemalloc.get_traced_memory()[0]
+        clients = [self.socket(token) for token in self.tokens[1:count + 1]]
+        results = await asyncio.gather(*[client.connect(timeout=self.args.timeout) for client in clients])
+        gc.collect()
+        used = tracemalloc.get_traced_memory()[0] - before
+        tracemalloc.stop()
+        if not all(connected for connected, _ in results):
+            raise RuntimeError('Some clients could not connect')
+        return clients, used / count
+
+    async def receive(self, client, expected, deadline):
+        received = 0
+        while received < expected:
+            remaining = deadline - time.perf_counter()
+            if remaining <= 0:
+                break
+            try:
+                frame = await client.receive_json_from(timeout=remaining)
+            except asyncio.TimeoutError:
+                break
+            event = frame.get('message')
+            if isinstance(event, dict) and 'content' in event:
+                self.latencies.append(time.perf_counter() - json.loads(event['content'])['sent_at'])
+                received += 1
+        return received
+
+    async def rest_sender(self, token):
+        statuses = [await self.rest_send(token) for _ in range(self.args.messages)]
+        return sum(status != 201 for status in statuses)
+
+    async def ws_sender(self, client):
+        for _ in range(self.args.messages):
+            await client.send_json_to({'type': 'message', 'content': self.payload()})
+            await asyncio.sleep(0)
+
+    async def run(self):
+        args = self.args
+        queries_per_rest_send, queries_per_ws_send = await self.probe()
+        clients, memory_per_connection = await self.connect(args.clients)
+
+        sent = (args.rest_senders + args.ws_senders) * args.messages
+        started = time.perf_counter()
+        deadline = started + args.timeout
+        receivers = [asyncio.ensure_future(self.receive(client, sent, deadline)) for client in clients]
+        senders = [self.rest_sender(self.tokens[1 + i]) for i in range(args.rest_senders)]
+        senders += [self.ws_sender(client) for client in clients[:args.ws_senders]]
+        failures = await asyncio.gather(*senders)
+        received = await asyncio.gather(*receivers)
+        elapsed = time.perf_counter() - started
+
+        await asyncio.gather(*[client.disconnect() for client in clients])
+        return {
+            'messages_sent': sent,
+            'rest_failures': sum(failure or 0 for failure in failures),
+            'deliveries_expected': sent * len(clients),
+            'deliveries_received': sum(received),
+            'seconds': round(elapsed, 3),
+            'messages_per_second': round(sent / elapsed, 1),
+            'deliveries_per_second': round(sum(received) / elapsed, 1),
+            'send_to_receive_ms': percentiles(self.latencies),
+            'rest_send_ms': percentiles(self.rest_times),
+            'queries_per_rest_send': queries_per_rest_send,
+            'queries_per_ws_send': queries_per_ws_send,
+            'memory_per_connection_kb': round(memory_per_connection / 1024, 1),
+        }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--clients', type=int, default=100, help='WebSocket clients in the room')
+    parser.add_argument('--rest-senders', type=int, default=4)
+    parser.add_argument('--ws-senders', type=int, default=4, help='How many of the clients also send')
+    parser.add_argument('--messages', type=int, default=25, help='Messages per sender')
+    parser.add_argument('--layer', choices=['memory', 'redis'], default='memory')
+    parser.add_argument('--timeout', type=float, default=60)
+    args = parser.parse_args()
+    args.ws_senders = min(args.ws_senders, args.clients)
+
+    setup()
+    configure(args.layer)
+    from django.db import connection
+    from django.db.backends.signals import connection_created
+
+    counter = QueryCounter()
+    connection_created.connect(counter.install)
+    test_database = connection.creation.create_test_db(verbosity=0, autoclobber=True)
+    try:
+        room_id, tokens = create_fixtures(args.clients, args.rest_senders)
+        results = asyncio.run(LoadTest(args, room_id, tokens, counter).run())
+    finally:
+        connection.creation.destroy_test_db(test_database, verbosity=0)
+
+    print(json.dumps({
+        'benchmark': 'load',
+        'database': connection.vendor,
+        'layer': args.layer,
+        'clients': args.clients,
+        'rest_senders': args.rest_senders,
+        'ws_senders': args.ws_senders,
+        'messages_per_sender': args.messages,
+        'results': results,
+    }, indent=2))
+
+
+if __name__ == '__main__':
+    main()
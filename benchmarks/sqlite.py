@@ -0,0 +1,130 @@
+'''
+SQLite throughput with Django's default connection settings vs SQLITE_PRAGMAS.
+
+Writer threads insert messages one per transaction, as concurrent sends do,
+while reader threads page through the room's history. Each configuration runs
+in its own process against a fresh database file, so nothing carries over.
+
+    python -m benchmarks.sqlite --writers 4 --readers 4 --messages 500
+'''
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from . import setup
+
+BASELINE = {
+    'DB_SQLITE_JOURNAL_MODE': '',
+    'DB_SQLITE_SYNCHRONOUS': '',
+    'DB_SQLITE_CACHE_SIZE': '',
+    'DB_SQLITE_MMAP_SIZE': '',
+    'DB_SQLITE_BUSY_TIMEOUT': '',
+}
+
+
+def run(writers, readers, messages):
+    '''One configuration, in this process. The database comes from DB_NAME.'''
+    from django.contrib.auth import get_user_model
+    from django.core.management import call_command
+    from django.db import OperationalError, connection
+    from chat.models import ChatRoom, Message
+
+    call_command('migrate', verbosity=0)
+    user = get_user_model().objects.create_user(username='benchmark', password='benchmark')
+    room = ChatRoom.objects.create(room_name='benchmark', creator=user)
+    with connection.cursor() as cursor:
+        journal_mode = cursor.execute('PRAGMA journal_mode').fetchone()[0]
+    connection.close()
+
+    done = threading.Event()
+    locked = []
+    reads = []
+
+    def write():
+        errors = 0
+        for i in range(messages):
+            try:
+                Message.objects.create(content=f'message {i}', sender=user, room=room)
+            except OperationalError:
+                errors += 1
+        locked.append(errors)
+        connection.close()
+
+    def read():
+        pages = 0
+        while not done.is_set():
+            try:
+                list(Message.objects.filter(room=room).order_by('-date_sent', '-id')[:50])
+                pages += 1
+            except OperationalError:
+                pass
+        reads.append(pages)
+        connection.close()
+
+    reader_threads = [threading.Thread(target=read) for _ in range(readers)]
+    writer_threads = [threading.Thread(target=write) for _ in range(writers)]
+    for thread in reader_threads:
+        thread.start()
+    started = time.perf_counter()
+    for thread in writer_threads:
+        thread.start()
+    for thread in writer_threads:
+        thread.join()
+    elapsed = time.perf_counter() - started
+    done.set()
+    for thread in reader_threads:
+        thread.join()
+
+    inserted = writers * messages - sum(locked)
+    return {
+        'journal_mode': journal_mode,
+        'seconds': round(elapsed, 3),
+        'inserts_per_second': round(inserted / elapsed, 1),
+        'database_locked_errors': sum(locked),
+        'history_pages_per_second': round(sum(reads) / elapsed, 1),
+    }
+
+
+def run_isolated(configuration, args):
+    '''Run one configuration in a child process against a fresh database file'''
+    with tempfile.TemporaryDirectory() as directory:
+        env = {**os.environ, 'DB_NAME': os.path.join(directory, 'benchmark.sqlite3')}
+        if configuration == 'baseline':
+            env.update(BASELINE)
+        output = subprocess.run(
+            [sys.executable, '-m', 'benchmarks.sqlite', '--child',
+             '--writers', str(args.writers), '--readers', str(args.readers), '--messages', str(args.messages)],
+            env=env, check=True, capture_output=True, text=True,
+        ).stdout
+    return {'configuration': configuration, **json.loads(output)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--writers', type=int, default=4)
+    parser.add_argument('--readers', type=int, default=4)
+    parser.add_argument('--messages', type=int, default=500, help='messages per writer')
+    parser.add_argument('--child', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        setup()
+        print(json.dumps(run(args.writers, args.readers, args.messages)))
+        return
+
+    results = [run_isolated(configuration, args) for configuration in ('baseline', 'tuned')]
+    print(json.dumps({
+        'benchmark': 'sqlite',
+        'writers': args.writers,
+        'readers': args.readers,
+        'messages_per_writer': args.messages,
+        'results': results,
+    }, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,80 @@
+import logging
+import threading
+import time
+from collections import OrderedDict
+from django.conf import settings
+import redis
+
+logger = logging.getLogger(__name__)
+
+MISSING = object()
+
+# Errors that mean "Redis is unavailable right now": callers fall back to the database
+REDIS_ERRORS = (redis.RedisError, OSError)
+
+_redis = None
+_redis_lock = threading.Lock()
+
+
+def get_redis():
+    '''Shared Redis client for chat data, or None when REDIS_URL is not configured'''
+    global _redis
+    if not settings.REDIS_URL:
+        return None
+    with _redis_lock:
+        if _redis is None:
+            _redis = redis.Redis.from_url(
+                settings.REDIS_URL,
+                socket_timeout=settings.CHAT_REDIS_SOCKET_TIMEOUT,
+                socket_connect_timeout=settings.CHAT_REDIS_SOCKET_TIMEOUT,
+            )
+        return _redis
+
+
+class LRUCache:
+    '''
+    Small thread-safe in-process cache. Holds at most `maxsize` entries, evicting
+    the least recently used, and entries expire `ttl` seconds after being set.
+    '''
+
+    def __init__(self, maxsize=10000, ttl=30):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.data = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key, default=MISSING):
+        with self.lock:
+            entry = self.data.get(key)
+            if entry is None:
+                return default
+            value, expires = entry
+            if expires <= time.monotonic():
+                del self.data[key]
+                return default
+            self.data.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl=None):
+        expires = time.monotonic() + (self.ttl if ttl is None else ttl)
+        with self.lock:
+            self.data[key] = (value, expires)
+            self.data.move_to_end(key)
+            while len(self.data) > self.maxsize:
+                self.data.popitem(last=False)
+
+    def delete(self, key):
+        with self.lock:
+            self.data.pop(key, None)
+
+    def delete_matching(self, predicate):
+        with self.lock:
+            for key in [key for key in self.data if predicate(key)]:
+                del self.data[key]
+
+    def clear(self):
+        with self.lock:
+            self.data.clear()
+
+    def __len__(self):
+        return len(self.data)
@@ -1,34 +1,187 @@
-import json
-from asgiref.sync import async_to_sync
-from channels.generic.websocket import WebsocketConsumer
-from django.contrib.auth.models import AnonymousUser
-from .models import  ChatRoom
+import asyncio
+import logging
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from channels.db import database_sync_to_async
+from channels.generic.websocket import AsyncJsonWebsocketConsumer
+from rest_framework.exceptions import APIException
+from .ephemeral import coalescer, ephemeral_value
+from .events import chat_message_event, publish, read_event, typing_event
+from .fanout import fan_out
+from .unread import mark_read
+from .membership import is_member
+from .presence import get_store, notifier
+from .protocol import EVENT_FRAMES, frame_payload, negotiate
+from .ratelimit import check_send
+from . import rooms
+from .serializers import SendChatSerializer
 
+logger = logging.getLogger(__name__)
 
-class ChatConsumer(WebsocketConsumer):
-    def connect(self):
+
+class ChatConsumer(AsyncJsonWebsocketConsumer):
+    async def connect(self):
         self.room_id = self.scope["url_route"]["kwargs"]["room_id"]
-        self.room_name = ChatRoom.objects.get(room_id=self.room_id).room_name.replace(' ', '-').lower()[:99]
-        self.room_group_name = f'chat_{self.room_name}'
-        
-        if self.scope['user'] is not AnonymousUser:
-            async_to_sync(self.channel_layer.group_add)(
-                self.room_group_name, self.channel_name
-            )
-            self.accept()
+        self.user = self.scope.get('user')
+
+        if self.user is None or not self.user.is_authenticated:
+            await self.close()
+            return
 
-    def disconnect(self, code):
-        async_to_sync(self.channel_layer.group_discard)(
+        try:
+            self.room_group_name = rooms.group_name(self.room_id)
+        except ValueError:
+            await self.close()
+            return
+
+        self.room = await self.get_room()
+        if self.room is None:
+            await self.close()
+            return
+
+        self.protocol, subprotocol = negotiate(self.scope.get('subprotocols') or [])
+        await self.channel_layer.group_add(
             self.room_group_name, self.channel_name
         )
 
+        self.presence = get_store()
+        if await sync_to_async(self.presence.join, thread_sensitive=False)(self.room.pk, self.user.pk):
+            notifier.joined(self.room, self.user.username)
+            await notifier.flush_soon()
+        self.heartbeat_task = asyncio.ensure_future(self.heartbeat())
+        await self.accept(subprotocol=subprotocol)
+
+    async def disconnect(self, code):
+        if hasattr(self, 'room_group_name'):
+            await self.channel_layer.group_discard(
+                self.room_group_name, self.channel_name
+            )
+        if hasattr(self, 'heartbeat_task'):
+            self.heartbeat_task.cancel()
+            if await sync_to_async(self.presence.leave, thread_sensitive=False)(self.room.pk, self.user.pk):
+                notifier.left(self.room, self.user.username)
+                await notifier.flush_soon()
+
+    async def heartbeat(self):
+        '''Keep this user's presence fresh; it expires CHAT_PRESENCE_TTL after the last beat'''
+        while True:
+            await asyncio.sleep(settings.CHAT_PRESENCE_HEARTBEAT)
+            try:
+                await sync_to_async(self.presence.heartbeat, thread_sensitive=False)(self.room.pk, self.user.pk)
+            except Exception:
+                logger.warning('Presence heartbeat failed', exc_info=True)
+
+    async def receive(self, text_data=None, bytes_data=None, **kwargs):
+        try:
+            content = self.protocol.decode(text_data=text_data, bytes_data=bytes_data)
+        except ValueError as exc:
+            await self.send_frame('error', {'type': 'error', 'errors': {'detail': str(exc)}})
+            return
+        await self.receive_json(content, **kwargs)
+
+    async def send_frame(self, kind, payload):
+        '''Send a frame in whichever wire protocol this socket negotiated'''
+        await self.send(**self.protocol.encode(kind, payload))
+
+    async def forward(self, event):
+        '''Relay a group event, reusing the publisher's pre-encoded frame when there is one'''
+        frame = event.get('frames', {}).get(self.protocol.subprotocol)
+        if frame is not None:
+            await self.send(**frame)
+        else:
+            await self.send_frame(EVENT_FRAMES[event['type']], frame_payload(event))
+
+    async def receive_json(self, content, **kwargs):
+        kind = content.get('type', 'message') if isinstance(content, dict) else None
+        if kind not in ('message', 'typing', 'read'):
+            await self.send_frame('error', {'type': 'error', 'errors': {'detail': 'Unsupported frame type.'}})
+            return
+
+        # Membership is re-checked per message (cheap, it is cached) so removed members can't keep sending
+        if not await database_sync_to_async(is_member)(self.room, self.user):
+            await self.send_frame('error', {'type': 'error', 'errors': {'detail': 'You are no longer a member of this room.'}})
+            await self.close()
+            return
+
+        if kind == 'message':
+            await self.receive_message(content)
+        else:
+            await self.receive_ephemeral(kind, content)
+
+    async def receive_message(self, content):
+        wait = await sync_to_async(check_send, thread_sensitive=False)(self.user.pk, self.room.pk, self.channel_name)
+        if wait:
+            await self.send_frame('error', {'type': 'error', 'client_id': content.get('client_id'), 'errors': {
+                'detail': 'Too many messages, slow down.', 'retry_after': round(wait, 3),
+            }})
+            return
+
+        message, errors = await self.save_message(content)
+        if errors:
+            await self.send_frame('error', {'type': 'error', 'client_id': content.get('client_id'), 'errors': errors})
+            return
+
+        await fan_out(self.room, chat_message_event(message))
+        await self.send_frame('ack', {
+            'type': 'ack',
+            'client_id': content.get('client_id'),
+            'message_id': str(message.message_id),
+            'date_sent': message.date_sent.isoformat(),
+        })
+
+    async def receive_ephemeral(self, kind, content):
+        '''Typing and read-cursor frames: relayed to the room and throttled. Only read cursors are saved.'''
+        try:
+            value = ephemeral_value(kind, content)
+        except ValueError as exc:
+            await self.send_frame('error', {'type': 'error', 'errors': {'detail': str(exc)}})
+            return
+        make_event = typing_event if kind == 'typing' else read_event
+        room, user, channel_name = self.room, self.user, self.channel_name
+
+        async def send(value):
+            # Read cursors for messages outside the room are neither saved nor relayed
+            if kind == 'read' and await database_sync_to_async(mark_read)(room, user, value) is None:
+                return
+            await publish(room, make_event(user, value, channel_name))
+
+        await coalescer.submit((room.pk, user.pk, kind), value, send)
+
+    @database_sync_to_async
+    def get_room(self):
+        '''The room, if it exists and the connecting user is a member of it'''
+        room = rooms.get_room(self.room_id)
+        if room is None or not is_member(room, self.user):
+            return None
+        return room
+
+    @database_sync_to_async
+    def save_message(self, content):
+        serializer = SendChatSerializer(data=content, context={'room': self.room, 'user': self.user})
+        if not serializer.is_valid():
+            return None, serializer.errors
+        try:
+            return serializer.save(), None
+        except APIException as exc:
+            return None, {'detail': exc.detail}
+
     # Receive chats from room group
-    def chat_message(self, event):
-        message = event
-        # Send message to WebSocket
-        self.send(text_data=json.dumps({"message": message}))
-
-    # user acceses chat 
-    def send_info_to_user_group(self, event):
-        message = event["text"]
-        self.send(text_data=json.dumps(message))
\ No newline at end of file
+    async def chat_message(self, event):
+        await self.forward(event)
+
+    # user acceses chat
+    async def send_info_to_user_group(self, event):
+        await self.forward(event)
+
+    # users came online or went offline
+    async def presence_diff(self, event):
+        await self.forward(event)
+
+    # someone is typing / has read up to a message; not echoed back to the socket it came from
+    async def chat_typing(self, event):
+        if event.get('sender_channel') != self.channel_name:
+            await self.forward(event)
+
+    async def chat_read(self, event):
+        if event.get('sender_channel') != self.channel_name:
+            await self.forward(event)
@@ -0,0 +1,81 @@
+import asyncio
+import logging
+import uuid
+from django.conf import settings
+from .cache import LRUCache, MISSING
+
+logger = logging.getLogger(__name__)
+
+TYPING_STATES = ('start', 'stop')
+
+
+def ephemeral_value(kind, content):
+    '''The value a typing or read frame carries; ValueError if it is malformed'''
+    if kind == 'typing':
+        state = content.get('state') or 'start'
+        if state not in TYPING_STATES:
+            raise ValueError('state must be "start" or "stop".')
+        return state
+    try:
+        return str(uuid.UUID(str(content.get('message_id'))))
+    except ValueError:
+        raise ValueError('message_id must be a valid message id.')
+
+
+class Coalescer:
+    '''
+    Throttles ephemeral events (typing, read cursors) per user per room.
+
+    At most one event per key goes out per `window` seconds. Within a window a
+    repeat of the last value sent is dropped, and a different value is held
+    back and sent when the window ends (only the latest one). Nothing here
+    touches the database.
+    '''
+
+    def __init__(self, window, maxsize=100000):
+        self.window = window
+        # Entries expire with the window, so an idle key always sends immediately
+        self.entries = LRUCache(maxsize=maxsize, ttl=window)
+        # Held so the loop's weak references don't let a pending send be collected
+        self.tasks = set()
+
+    async def submit(self, key, value, send):
+        '''Send `value` with the `send` coroutine function now, later, or not at all.'''
+        loop = asyncio.get_running_loop()
+        entry = self.entries.get(key)
+        if entry is MISSING:
+            self.entries.set(key, {'value': value, 'sent_at': loop.time(), 'pending': MISSING})
+            await send(value)
+            return True
+
+        if value == entry['value']:
+            # Back to what was already sent: anything held back is now redundant
+            entry['pending'] = MISSING
+            return False
+
+        if entry['pending'] is MISSING:
+            delay = max(0, entry['sent_at'] + self.window - loop.time())
+            loop.call_later(delay, self.start_task, loop, lambda: self.send_pending(key, entry, send))
+        entry['pending'] = value
+        return False
+
+    def start_task(self, loop, coroutine_function):
+        task = loop.create_task(coroutine_function())
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    async def send_pending(self, key, entry, send):
+        value, entry['pending'] = entry['pending'], MISSING
+        if value is MISSING:
+            return
+        self.entries.set(key, {'value': value, 'sent_at': asyncio.get_running_loop().time(), 'pending': MISSING})
+        try:
+            await send(value)
+        except Exception:
+            logger.exception('Could not send coalesced %s event', key[-1])
+
+    def clear(self):
+        self.entries.clear()
+
+
+coalescer = Coalescer(settings.CHAT_EPHEMERAL_WINDOW)
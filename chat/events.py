@@ -0,0 +1,40 @@
+import time
+from channels.layers import get_channel_layer
+from . import metrics, rooms
+from .protocol import encode_once
+
+
+async def publish(room, event):
+    '''Send an event to everyone subscribed to a room, with its frames encoded once'''
+    channel_layer = get_channel_layer()
+    for group, group_event in rooms.group_events(room, encode_once(event)):
+        await send_group(channel_layer, group, group_event)
+
+
+async def send_group(channel_layer, group, event):
+    started = time.perf_counter()
+    await channel_layer.group_send(group, event)
+    metrics.observe_group_send(time.perf_counter() - started)
+
+
+def chat_message_event(message):
+    '''Channel layer event announcing a newly created message to a room group'''
+    return {
+        'type': 'chat_message',
+        'message': f"Message with id {message.message_id} was created!",
+        'message_id': str(message.message_id),
+        'content': message.content,
+        'date_sent': message.date_sent.isoformat(),
+        'user': message.sender.username,
+        'room_name': message.room.room_name,
+    }
+
+
+def typing_event(user, state, sender_channel):
+    '''Ephemeral event: a member started or stopped typing. Never stored.'''
+    return {'type': 'chat_typing', 'user': user.username, 'state': state, 'sender_channel': sender_channel}
+
+
+def read_event(user, message_id, sender_channel):
+    '''Ephemeral event: a member has read up to message_id'''
+    return {'type': 'chat_read', 'user': user.username, 'message_id': message_id, 'sender_channel': sender_channel}
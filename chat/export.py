@@ -0,0 +1,83 @@
+import csv
+import json
+from asgiref.sync import sync_to_async
+from django.db.models import Q
+from .models import Message
+
+EXPORT_FIELDS = ['message_id', 'sender', 'content', 'date_sent']
+
+FORMATS = {
+    'ndjson': 'application/x-ndjson',
+    'csv': 'text/csv',
+}
+
+
+def keyset_walk(queryset, fields, batch_size):
+    '''
+    Rows of `queryset` as dicts of `fields`, oldest first. Each batch is a bounded
+    range scan on (date_sent, id) that resumes after the previous one, streamed
+    from the cursor with iterator(), so memory stays flat however long the walk.
+    '''
+    fields = list(dict.fromkeys([*fields, 'id', 'date_sent']))
+    position = Q()
+    while True:
+        last = None
+        for row in queryset.filter(position).order_by('date_sent', 'id').values(*fields)[:batch_size].iterator(chunk_size=batch_size):
+            last = row
+            yield row
+        if last is None:
+            return
+        position = Q(date_sent__gt=last['date_sent']) | Q(date_sent=last['date_sent'], id__gt=last['id'])
+
+
+def export_rows(room, batch_size):
+    '''A room's history as export records, oldest first'''
+    for row in keyset_walk(Message.objects.history(room), ['message_id', 'sender__username', 'content'], batch_size):
+        yield {
+            'message_id': str(row['message_id']),
+            'sender': row['sender__username'],
+            'content': row['content'],
+            'date_sent': row['date_sent'].isoformat(),
+        }
+
+
+class Echo:
+    '''File-like object whose write() returns the line, so csv.writer can produce lines one at a time'''
+
+    def write(self, value):
+        return value
+
+
+def export_lines(room, output, batch_size):
+    '''The export as a generator of text lines in `output` format (ndjson or csv)'''
+    rows = export_rows(room, batch_size)
+    if output == 'csv':
+        writer = csv.writer(Echo())
+        yield writer.writerow(EXPORT_FIELDS)
+        for row in rows:
+            yield writer.writerow([row[field] for field in EXPORT_FIELDS])
+    else:
+        for row in rows:
+            yield json.dumps(row) + '\n'
+
+
+def read_chunk(lines, size):
+    chunk = []
+    for line in lines:
+        chunk.append(line)
+        if len(chunk) >= size:
+            break
+    return ''.join(chunk).encode()
+
+
+async def stream_lines(lines, size=1000):
+    '''
+    Serve a synchronous line generator from an async iterator. Under ASGI, Django
+    buffers a whole synchronous StreamingHttpResponse in memory before sending it;
+    this pulls `size` lines at a time from a worker thread instead.
+    '''
+    while True:
+        chunk = await sync_to_async(read_chunk)(lines, size)
+        if not chunk:
+            return
+        yield chunk
@@ -0,0 +1,127 @@
+import asyncio
+import logging
+from django.conf import settings
+from asgiref.sync import AsyncToSync
+from channels.layers import get_channel_layer
+from .cache import REDIS_ERRORS
+from .events import publish, send_group
+from .protocol import encode_once
+from . import metrics, rooms
+
+logger = logging.getLogger(__name__)
+
+# Failures worth another attempt: the channel layer's Redis connection dropped or timed out
+TRANSIENT_ERRORS = REDIS_ERRORS + (asyncio.TimeoutError,)
+
+
+class Publisher:
+    '''
+    Fire-and-forget fan-out for one worker (CHAT_FANOUT_ASYNC). Callers queue an
+    event and move on; a task on the worker's event loop drains up to
+    `batch_size` events at a time and sends them with the sends for different
+    groups in flight together, so their channel layer round trips overlap.
+    Events for the same group keep their order. Transient failures are retried
+    with exponential backoff, then the event is dropped and logged; the message
+    is already saved, so clients can catch up from history.
+    '''
+
+    def __init__(self, maxsize, batch_size, retries, retry_delay):
+        self.maxsize = maxsize
+        self.batch_size = batch_size
+        self.retries = retries
+        self.retry_delay = retry_delay
+        self.loop = None
+        self.queue = None
+        self.task = None
+
+    def start(self):
+        '''Start draining on the running loop, if not already doing so'''
+        loop = asyncio.get_running_loop()
+        if self.loop is not loop:
+            self.loop = loop
+            self.queue = asyncio.Queue(self.maxsize)
+            self.task = None
+        if self.task is None or self.task.done():
+            self.task = loop.create_task(self.run())
+
+    async def submit(self, room, event):
+        '''Queue a room event. Waits only when the queue is full, so order is kept.'''
+        self.start()
+        await self.queue.put(rooms.group_events(room, encode_once(event)))
+
+    async def run(self):
+        channel_layer = get_channel_layer()
+        while True:
+            batch = [await self.queue.get()]
+            while len(batch) < self.batch_size and not self.queue.empty():
+                batch.append(self.queue.get_nowait())
+
+            by_group = {}
+            for sends in batch:
+                for group, event in sends:
+                    by_group.setdefault(group, []).append(event)
+            try:
+                await asyncio.gather(*[
+                    self.send_in_order(channel_layer, group, events) for group, events in by_group.items()
+                ])
+            finally:
+                for _ in batch:
+                    self.queue.task_done()
+
+    async def send_in_order(self, channel_layer, group, events):
+        for event in events:
+            await self.send(channel_layer, group, event)
+
+    async def send(self, channel_layer, group, event):
+        for attempt in range(self.retries + 1):
+            try:
+                await send_group(channel_layer, group, event)
+            except TRANSIENT_ERRORS:
+                if attempt < self.retries:
+                    metrics.FANOUT_FAILURES.inc('retried')
+                    await asyncio.sleep(self.retry_delay * 2 ** attempt)
+                    continue
+                self.dropped(group, event)
+            except Exception:
+                self.dropped(group, event)
+            return
+
+    def dropped(self, group, event):
+        metrics.FANOUT_FAILURES.inc('dropped')
+        logger.exception('Dropped %s event for group %s', event['type'], group)
+
+    async def drain(self):
+        '''Wait until everything queued so far has been sent or dropped'''
+        if self.queue is not None:
+            await self.queue.join()
+
+    def clear(self):
+        self.loop = None
+        self.queue = None
+        self.task = None
+
+
+publisher = Publisher(
+    settings.CHAT_FANOUT_QUEUE_SIZE, settings.CHAT_FANOUT_BATCH_SIZE,
+    settings.CHAT_FANOUT_RETRIES, settings.CHAT_FANOUT_RETRY_DELAY,
+)
+
+
+def short_lived(loop):
+    '''
+    Whether `loop` was started by async_to_sync for a single call, as under WSGI
+    or the test client. It is closed as soon as the view returns, cancelling
+    the drain task with the event still queued.
+    '''
+    return loop in AsyncToSync.loop_thread_executors
+
+
+async def fan_out(room, event):
+    '''
+    Publish a new message's event: queued on this worker's publisher under
+    CHAT_FANOUT_ASYNC when running on the server's event loop, otherwise awaited
+    '''
+    if settings.CHAT_FANOUT_ASYNC and not short_lived(asyncio.get_running_loop()):
+        await publisher.submit(room, event)
+    else:
+        await publish(room, event)
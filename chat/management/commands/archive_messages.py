@@ -0,0 +1,36 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from chat.models import ChatRoom
+from chat.retention import archive_room, retention_cutoff
+
+
+class Command(BaseCommand):
+    help = 'Archive messages past their room\'s retention period to gzipped JSONL, then delete them.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--room', help='Only this room_id')
+        parser.add_argument('--output-dir', default=settings.CHAT_ARCHIVE_DIR)
+        parser.add_argument('--batch-size', type=int, default=1000, help='Messages read per query while archiving')
+        parser.add_argument('--chunk-size', type=int, default=500, help='Messages deleted per transaction')
+        parser.add_argument('--pause', type=float, default=0, help='Seconds to sleep between delete chunks')
+        parser.add_argument('--dry-run', action='store_true', help='Only report each room\'s cutoff')
+
+    def handle(self, *args, **options):
+        chatrooms = ChatRoom.objects.order_by('pk')
+        if options['room']:
+            chatrooms = chatrooms.filter(room_id=options['room'])
+            if not chatrooms.exists():
+                raise CommandError(f'No room with room_id {options["room"]}')
+
+        for room in chatrooms.iterator():
+            cutoff = retention_cutoff(room)
+            if cutoff is None:
+                continue
+            if options['dry_run']:
+                self.stdout.write(f'{room.room_id}: would archive messages before {cutoff.isoformat()}')
+                continue
+            path, archived, deleted = archive_room(
+                room, options['output_dir'], options['batch_size'], options['chunk_size'], options['pause'],
+            )
+            if archived:
+                self.stdout.write(f'{room.room_id}: archived {archived} messages to {path}, deleted {deleted}')
@@ -0,0 +1,26 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from chat import rooms
+from chat.export import FORMATS, export_lines
+
+
+class Command(BaseCommand):
+    help = 'Export a room\'s message history as NDJSON or CSV.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('room_id')
+        parser.add_argument('--format', dest='output', choices=list(FORMATS), default='ndjson')
+        parser.add_argument('--output-file', help='Write here instead of stdout')
+        parser.add_argument('--batch-size', type=int, default=settings.CHAT_EXPORT_BATCH_SIZE)
+
+    def handle(self, *args, **options):
+        room = rooms.get_room(options['room_id'])
+        if room is None:
+            raise CommandError(f'No room with room_id {options["room_id"]}')
+        lines = export_lines(room, options['output'], options['batch_size'])
+        if options['output_file']:
+            with open(options['output_file'], 'w', encoding='utf-8', newline='') as export:
+                export.writelines(lines)
+        else:
+            for line in lines:
+                self.stdout.write(line, ending='')
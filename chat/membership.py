@@ -0,0 +1,113 @@
+import logging
+from django.conf import settings
+from django.db import transaction
+from .cache import LRUCache, MISSING, REDIS_ERRORS, get_redis
+from .models import ChatRoom
+
+logger = logging.getLogger(__name__)
+
+Membership = ChatRoom.members.through
+
+# Stored in every Redis member set so a loaded-but-empty room still has a key
+LOADED = 0
+
+_cache = LRUCache(maxsize=settings.CHAT_MEMBERSHIP_CACHE_SIZE, ttl=settings.CHAT_MEMBERSHIP_CACHE_TTL)
+
+
+# Fill the member set only if no invalidation has happened since the reader
+# looked, so a set loaded from stale rows cannot outlive the invalidation.
+# Members go in FILL_CHUNK at a time: Lua's unpack() fails at about 8000 values.
+FILL_CHUNK = 5000
+FILL_SCRIPT = f'''
+if redis.call('GET', KEYS[2]) ~= (ARGV[1] ~= '' and ARGV[1] or false) then
+    return 0
+end
+for i = 3, #ARGV, {FILL_CHUNK} do
+    redis.call('SADD', KEYS[1], unpack(ARGV, i, math.min(i + {FILL_CHUNK - 1}, #ARGV)))
+end
+redis.call('EXPIRE', KEYS[1], ARGV[2])
+return 1
+'''
+
+
+def members_key(room_pk):
+    return f'chat:room:{room_pk}:members'
+
+
+def generation_key(room_pk):
+    return f'chat:room:{room_pk}:members:gen'
+
+
+def is_member(room, user):
+    '''
+    Whether `user` belongs to `room`.
+
+    Checked against a short-lived local cache, then the room's member ID set in
+    Redis (one SISMEMBER), then an indexed EXISTS on the through table if Redis is
+    not configured or unavailable. The whole member list is never scanned per check.
+    '''
+    if not user.is_authenticated:
+        return False
+    key = (room.pk, user.pk)
+    member = _cache.get(key)
+    if member is MISSING:
+        member = _redis_is_member(room.pk, user.pk)
+        if member is None:
+            member = Membership.objects.filter(chatroom_id=room.pk, customuser_id=user.pk).exists()
+        _cache.set(key, member)
+    return member
+
+
+def _redis_is_member(room_pk, user_pk):
+    client = get_redis()
+    if client is None:
+        return None
+    key = members_key(room_pk)
+    try:
+        loaded, member, generation = (
+            client.pipeline(transaction=False).exists(key).sismember(key, user_pk).get(generation_key(room_pk)).execute()
+        )
+        if not loaded:
+            member_ids = list(Membership.objects.filter(chatroom_id=room_pk).values_list('customuser_id', flat=True))
+            client.eval(
+                FILL_SCRIPT, 2, key, generation_key(room_pk),
+                generation or '', settings.CHAT_ROOM_CACHE_TTL, LOADED, *member_ids,
+            )
+            member = user_pk in member_ids
+    except REDIS_ERRORS:
+        logger.warning('Redis unavailable for membership check, using the database', exc_info=True)
+        return None
+    return bool(member)
+
+
+def invalidate(room_pk, user_pks=None):
+    '''Forget cached memberships for some users of a room, or for the whole room'''
+    if user_pks is None:
+        _cache.delete_matching(lambda key: key[0] == room_pk)
+    else:
+        for user_pk in user_pks:
+            _cache.delete((room_pk, user_pk))
+
+    # The Redis set is dropped rather than patched; the next check reloads it.
+    # Bumping the generation voids fills that loaded their rows before this.
+    client = get_redis()
+    if client is not None:
+        try:
+            (client.pipeline().incr(generation_key(room_pk)).expire(generation_key(room_pk), 2 * settings.CHAT_ROOM_CACHE_TTL)
+             .delete(members_key(room_pk)).execute())
+        except REDIS_ERRORS:
+            logger.warning('Could not invalidate member set for room %s', room_pk, exc_info=True)
+
+
+def invalidate_on_commit(room_pk, user_pks=None):
+    '''
+    Invalidate now, so this transaction sees its own changes, and again once it
+    commits, in case another reader refilled the caches from the rows as they
+    were before the commit.
+    '''
+    invalidate(room_pk, user_pks)
+    transaction.on_commit(lambda: invalidate(room_pk, user_pks))
+
+
+def clear():
+    _cache.clear()
@@ -0,0 +1,328 @@
+import contextvars
+import hmac
+import threading
+import time
+from bisect import bisect_left
+from django.conf import settings
+from django.http import Http404, HttpResponse
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from .middlewares import connect_stats
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+QUERY_BUCKETS = (0, 1, 2, 3, 5, 8, 13, 21, 34, 55, 100)
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+def escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def format_labels(names, values):
+    if not names:
+        return ''
+    return '{' + ','.join(f'{name}="{escape(value)}"' for name, value in zip(names, values)) + '}'
+
+
+def format_value(value):
+    return str(value) if isinstance(value, int) else repr(float(value))
+
+
+class Metric:
+    kind = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.lock = threading.Lock()
+        self.series = {}
+
+    def clear(self):
+        with self.lock:
+            self.series.clear()
+
+    def header(self):
+        return [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.kind}']
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, *labels, amount=1):
+        with self.lock:
+            self.series[labels] = self.series.get(labels, 0) + amount
+
+    def value(self, *labels):
+        return self.series.get(labels, 0)
+
+    def render(self):
+        with self.lock:
+            series = sorted(self.series.items())
+        return self.header() + [
+            f'{self.name}{format_labels(self.labelnames, labels)} {format_value(value)}' for labels, value in series
+        ]
+
+
+class Histogram(Metric):
+    '''Prometheus histogram; each labelled series is per-bucket counts plus a running sum'''
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, *labels):
+        index = bisect_left(self.buckets, value)
+        with self.lock:
+            series = self.series.get(labels)
+            if series is None:
+                series = self.series[labels] = [[0] * (len(self.buckets) + 1), 0]
+            series[0][index] += 1
+            series[1] += value
+
+    def count(self, *labels):
+        series = self.series.get(labels)
+        return sum(series[0]) if series else 0
+
+    def sum(self, *labels):
+        series = self.series.get(labels)
+        return series[1] if series else 0
+
+    def render(self):
+        with self.lock:
+            series = sorted((labels, (list(counts), total)) for labels, (counts, total) in self.series.items())
+        lines = self.header()
+        names = self.labelnames + ('le',)
+        for labels, (counts, total) in series:
+            cumulative = 0
+            for bound, count in zip(self.buckets + ('+Inf',), counts):
+                cumulative += count
+                le = bound if bound == '+Inf' else format_value(float(bound))
+                lines.append(f'{self.name}_bucket{format_labels(names, labels + (le,))} {cumulative}')
+            lines.append(f'{self.name}_sum{format_labels(self.labelnames, labels)} {format_value(total)}')
+            lines.append(f'{self.name}_count{format_labels(self.labelnames, labels)} {cumulative}')
+        return lines
+
+
+REQUEST_SECONDS = Histogram(
+    'chat_http_request_duration_seconds', 'HTTP request latency by route.', ['route', 'method', 'status'],
+)
+WS_CONNECT_SECONDS = Histogram(
+    'chat_ws_connect_duration_seconds', 'WebSocket handshake latency, authentication included.', ['route', 'outcome'],
+)
+WS_FRAME_SECONDS = Histogram(
+    'chat_ws_frame_duration_seconds', 'Time a consumer spends handling one incoming WebSocket frame.', ['route'],
+)
+DB_QUERIES = Histogram(
+    'chat_db_queries', 'Database queries per HTTP request or WebSocket event.', ['route', 'operation'], QUERY_BUCKETS,
+)
+DB_SECONDS = Counter(
+    'chat_db_query_seconds_total', 'Time spent in database queries.', ['route', 'operation'],
+)
+GROUP_SEND_SECONDS = Histogram(
+    'chat_group_send_duration_seconds', 'Channel layer group_send latency.',
+)
+FANOUT_FAILURES = Counter(
+    'chat_fanout_failures_total', 'Failed group sends from the async fan-out queue, retried or dropped.', ['outcome'],
+)
+
+METRICS = [
+    REQUEST_SECONDS, WS_CONNECT_SECONDS, WS_FRAME_SECONDS, DB_QUERIES, DB_SECONDS, GROUP_SEND_SECONDS, FANOUT_FAILURES,
+]
+
+
+class QueryStats:
+    '''Queries run on behalf of one request or WebSocket, from whichever thread runs them'''
+
+    def __init__(self):
+        self.queries = 0
+        self.seconds = 0.0
+
+    def mark(self):
+        return self.queries, self.seconds
+
+    def record(self, route, operation, since=(0, 0.0)):
+        DB_QUERIES.observe(self.queries - since[0], route, operation)
+        DB_SECONDS.inc(route, operation, amount=self.seconds - since[1])
+
+
+# Context variables follow the work into sync_to_async/database_sync_to_async threads
+current = contextvars.ContextVar('chat_query_stats', default=None)
+
+
+def count_queries(execute, sql, params, many, context):
+    '''execute_wrapper installed on each connection when CHAT_METRICS is on; a no-op outside an instrumented request'''
+    stats = current.get()
+    if stats is None:
+        return execute(sql, params, many, context)
+    started = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        stats.queries += 1
+        stats.seconds += time.perf_counter() - started
+
+
+def instrument(connection):
+    # connection_created fires again each time a closed connection reconnects
+    if count_queries not in connection.execute_wrappers:
+        connection.execute_wrappers.append(count_queries)
+
+
+def observe_group_send(seconds):
+    if settings.CHAT_METRICS:
+        GROUP_SEND_SECONDS.observe(seconds)
+
+
+def route_name(request):
+    match = getattr(request, 'resolver_match', None)
+    return match.view_name if match else 'unmatched'
+
+
+class MetricsMiddleware:
+    '''
+    Django middleware recording latency and database queries per route (the URL
+    name, so room IDs don't multiply the series). Add it first in MIDDLEWARE;
+    settings.py does this when CHAT_METRICS is on.
+    '''
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        stats, token, started = self.start()
+        try:
+            response = self.get_response(request)
+        finally:
+            current.reset(token)
+        self.finish(request, response, stats, started)
+        return response
+
+    async def __acall__(self, request):
+        stats, token, started = self.start()
+        try:
+            response = await self.get_response(request)
+        finally:
+            current.reset(token)
+        self.finish(request, response, stats, started)
+        return response
+
+    def start(self):
+        stats = QueryStats()
+        return stats, current.set(stats), time.perf_counter()
+
+    def finish(self, request, response, stats, started):
+        # Streaming responses are timed until the view returns, not until the body is sent
+        route = route_name(request)
+        REQUEST_SECONDS.observe(time.perf_counter() - started, route, request.method, str(response.status_code))
+        stats.record(route, request.method)
+
+
+class WebSocketMetrics:
+    '''
+    ASGI wrapper for the websocket application recording handshake latency, the
+    time and queries spent on each incoming frame, and the queries made while
+    connecting. Consumers handle one message at a time, so a frame's handling
+    ends when the consumer asks for the next one.
+    '''
+
+    def __init__(self, app, urlpatterns=()):
+        self.app = app
+        self.urlpatterns = urlpatterns
+
+    def route(self, path):
+        path = path.lstrip('/')
+        for pattern in self.urlpatterns:
+            if pattern.pattern.match(path):
+                return str(pattern.pattern)
+        return 'unmatched'
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'websocket':
+            return await self.app(scope, receive, send)
+
+        route = self.route(scope['path'])
+        stats = QueryStats()
+        token = current.set(stats)
+        started = time.perf_counter()
+        state = {'connecting': True, 'frame': None}
+
+        def finish_frame():
+            if state['frame'] is not None:
+                frame_started, since = state['frame']
+                state['frame'] = None
+                WS_FRAME_SECONDS.observe(time.perf_counter() - frame_started, route)
+                stats.record(route, 'receive', since)
+
+        async def instrumented_receive():
+            finish_frame()
+            message = await receive()
+            if message['type'] == 'websocket.receive':
+                state['frame'] = (time.perf_counter(), stats.mark())
+            return message
+
+        async def instrumented_send(message):
+            if state['connecting'] and message['type'] in ('websocket.accept', 'websocket.close'):
+                state['connecting'] = False
+                outcome = 'accepted' if message['type'] == 'websocket.accept' else 'rejected'
+                WS_CONNECT_SECONDS.observe(time.perf_counter() - started, route, outcome)
+                stats.record(route, 'connect')
+            await send(message)
+
+        try:
+            return await self.app(scope, instrumented_receive, instrumented_send)
+        finally:
+            finish_frame()
+            current.reset(token)
+
+
+def render_connect_stats():
+    stats = connect_stats.snapshot()
+    lines = []
+    for name, key, kind, documentation in [
+        ('chat_ws_auth_connects_total', 'connects', 'counter', 'WebSocket connections authenticated.'),
+        ('chat_ws_auth_cache_hits_total', 'cache_hits', 'counter', 'Token users found in the auth cache.'),
+        ('chat_ws_auth_cache_misses_total', 'cache_misses', 'counter', 'Token users loaded from the database.'),
+        ('chat_ws_auth_avg_seconds', 'avg_connect_seconds', 'gauge', 'Mean time spent authenticating a connection.'),
+        ('chat_ws_auth_max_seconds', 'max_connect_seconds', 'gauge', 'Longest time spent authenticating a connection.'),
+    ]:
+        lines += [f'# HELP {name} {documentation}', f'# TYPE {name} {kind}', f'{name} {format_value(stats[key])}']
+    return lines
+
+
+def render():
+    '''Every metric in the Prometheus text exposition format'''
+    lines = []
+    for metric in METRICS:
+        lines += metric.render()
+    lines += render_connect_stats()
+    return '\n'.join(lines) + '\n'
+
+
+def clear():
+    for metric in METRICS:
+        metric.clear()
+
+
+def metrics_view(request):
+    '''
+    Metrics for this process only; scrape every worker. Hidden unless CHAT_METRICS
+    is on. Needs `Authorization: Bearer <CHAT_METRICS_TOKEN>` when that is set,
+    and a staff session otherwise.
+    '''
+    if not settings.CHAT_METRICS:
+        raise Http404()
+    if settings.CHAT_METRICS_TOKEN:
+        expected = f'Bearer {settings.CHAT_METRICS_TOKEN}'
+        if not hmac.compare_digest(request.headers.get('Authorization', ''), expected):
+            return HttpResponse(status=401)
+    elif not request.user.is_staff:
+        return HttpResponse(status=403)
+    return HttpResponse(render(), content_type=CONTENT_TYPE)
@@ -1,30 +1,114 @@
+import logging
+import threading
+import time
 from urllib.parse import parse_qs
+from django.conf import settings
 from django.contrib.auth import get_user_model
 from django.contrib.auth.models import AnonymousUser
 from channels.db import database_sync_to_async
 from rest_framework_simplejwt.tokens import AccessToken, TokenError
-import jwt
+from .cache import LRUCache, MISSING
+
+logger = logging.getLogger(__name__)
 
 User = get_user_model()
 
+# Enough of the user for the consumers; anything else loads lazily if touched.
+# Kept in model field order, which Model.from_db() expects for partial rows.
+USER_FIELDS = [
+    field.attname for field in User._meta.concrete_fields
+    if field.attname in {'id', 'username', 'is_active', 'is_staff', 'is_superuser'}
+]
+
+_users = LRUCache(maxsize=settings.CHAT_AUTH_CACHE_SIZE, ttl=settings.CHAT_AUTH_CACHE_TTL)
+
+
+class ConnectStats:
+    '''Running totals for WebSocket authentication: cache hit rate and time spent per connect.'''
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.hits = 0
+        self.misses = 0
+        self.connects = 0
+        self.total_seconds = 0.0
+        self.max_seconds = 0.0
+
+    def record(self, hit, seconds):
+        with self.lock:
+            self.connects += 1
+            if hit is True:
+                self.hits += 1
+            elif hit is False:
+                self.misses += 1
+            self.total_seconds += seconds
+            self.max_seconds = max(self.max_seconds, seconds)
+
+    def snapshot(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                'connects': self.connects,
+                'cache_hits': self.hits,
+                'cache_misses': self.misses,
+                'cache_hit_rate': self.hits / lookups if lookups else 0.0,
+                'avg_connect_seconds': self.total_seconds / self.connects if self.connects else 0.0,
+                'max_connect_seconds': self.max_seconds,
+            }
+
+
+connect_stats = ConnectStats()
+
+
 @database_sync_to_async
-def get_user(user_id):
-    try:
-        return User.objects.get(id=user_id)
-    except User.DoesNotExist:
-        return AnonymousUser
-    
+def load_user(user_id):
+    return User.objects.filter(id=user_id).values_list(*USER_FIELDS).first()
+
+
+async def get_user(user_id, expires_at):
+    '''
+    The user for a token, as a lightweight snapshot. Looked up in a bounded cache
+    first; entries never outlive the token that loaded them. Returns the user and
+    whether it came from the cache.
+    '''
+    values = _users.get(user_id)
+    hit = values is not MISSING
+    if not hit:
+        values = await load_user(user_id)
+        ttl = min(settings.CHAT_AUTH_CACHE_TTL, expires_at - time.time())
+        if ttl > 0:
+            _users.set(user_id, values, ttl)
+    if values is None or not values[USER_FIELDS.index('is_active')]:
+        return AnonymousUser(), hit
+    return User.from_db('default', USER_FIELDS, values), hit
+
+
+def invalidate_user(user_id):
+    # This process only; other workers' entries expire within CHAT_AUTH_CACHE_TTL
+    _users.delete(user_id)
+
+
+def clear():
+    _users.clear()
+
+
 class JWTAuthMiddleware:
 
     def __init__(self, app) -> None:
         self.app = app
 
     async def __call__(self, scope, receive, send):
+        started = time.perf_counter()
+        hit = None
         parsed_query_string = parse_qs(scope["query_string"])
-        token = parsed_query_string.get(b"token")[0].decode("utf-8")
+        token = parsed_query_string.get(b"token", [b""])[0].decode("utf-8")
         try:
             access_token = AccessToken(token)
-            scope["user"] = await get_user(access_token["user_id"])
+            scope["user"], hit = await get_user(access_token["user_id"], access_token["exp"])
         except TokenError:
             scope["user"] = AnonymousUser()
-        return await self.app(scope, receive, send)
\ No newline at end of file
+        connect_stats.record(hit, time.perf_counter() - started)
+        return await self.app(scope, receive, send)
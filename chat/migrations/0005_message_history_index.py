@@ -0,0 +1,23 @@
+# Generated by Django 4.2.15 on 2026-10-18 20:07
+
+from django.db import migrations, models
+import uuid
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0004_alter_message_content'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='message',
+            name='message_id',
+            field=models.UUIDField(db_index=True, default=uuid.uuid4, editable=False),
+        ),
+        migrations.AddIndex(
+            model_name='message',
+            index=models.Index(fields=['room', 'date_sent', 'id'], name='chat_message_history_idx'),
+        ),
+    ]
@@ -0,0 +1,56 @@
+from django.db import migrations
+
+# On SQLite, later migrations that make Django rebuild chat_message drop these
+# triggers with the old table; such migrations must recreate them.
+SQLITE_FORWARDS = [
+    # External-content FTS5 table: the text lives only in chat_message
+    "CREATE VIRTUAL TABLE chat_message_fts USING fts5(content, room_id UNINDEXED, content='chat_message', content_rowid='id')",
+    """CREATE TRIGGER chat_message_fts_insert AFTER INSERT ON chat_message BEGIN
+        INSERT INTO chat_message_fts(rowid, content, room_id) VALUES (new.id, new.content, new.room_id);
+    END""",
+    """CREATE TRIGGER chat_message_fts_delete AFTER DELETE ON chat_message BEGIN
+        INSERT INTO chat_message_fts(chat_message_fts, rowid, content, room_id) VALUES ('delete', old.id, old.content, old.room_id);
+    END""",
+    """CREATE TRIGGER chat_message_fts_update AFTER UPDATE ON chat_message BEGIN
+        INSERT INTO chat_message_fts(chat_message_fts, rowid, content, room_id) VALUES ('delete', old.id, old.content, old.room_id);
+        INSERT INTO chat_message_fts(rowid, content, room_id) VALUES (new.id, new.content, new.room_id);
+    END""",
+    "INSERT INTO chat_message_fts(chat_message_fts) VALUES ('rebuild')",
+]
+
+SQLITE_BACKWARDS = [
+    "DROP TRIGGER IF EXISTS chat_message_fts_insert",
+    "DROP TRIGGER IF EXISTS chat_message_fts_delete",
+    "DROP TRIGGER IF EXISTS chat_message_fts_update",
+    "DROP TABLE IF EXISTS chat_message_fts",
+]
+
+POSTGRESQL_FORWARDS = [
+    # Must match the expression chat.search uses, or the planner won't pick it
+    "CREATE INDEX chat_message_search_idx ON chat_message USING GIN (to_tsvector('english', content))",
+]
+
+POSTGRESQL_BACKWARDS = [
+    "DROP INDEX IF EXISTS chat_message_search_idx",
+]
+
+
+def run(statements):
+    def apply(apps, schema_editor):
+        for statement in statements.get(schema_editor.connection.vendor, []):
+            schema_editor.execute(statement)
+    return apply
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0006_readcursor'),
+    ]
+
+    operations = [
+        migrations.RunPython(
+            run({'sqlite': SQLITE_FORWARDS, 'postgresql': POSTGRESQL_FORWARDS}),
+            run({'sqlite': SQLITE_BACKWARDS, 'postgresql': POSTGRESQL_BACKWARDS}),
+        ),
+    ]
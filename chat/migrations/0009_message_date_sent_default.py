@@ -0,0 +1,26 @@
+# Generated by Django 4.2.15 on 2026-10-18 21:27
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0008_room_retention'),
+    ]
+
+    # Only Django's state changes: defaults aren't stored in the database, and
+    # altering the column would make SQLite rebuild chat_message and drop the
+    # full-text search triggers added in 0007
+    operations = [
+        migrations.SeparateDatabaseAndState(
+            state_operations=[
+                migrations.AlterField(
+                    model_name='message',
+                    name='date_sent',
+                    field=models.DateTimeField(default=django.utils.timezone.now, editable=False),
+                ),
+            ],
+        ),
+    ]
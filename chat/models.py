@@ -1,7 +1,14 @@
 import uuid
 from django.db import models
+from django.utils import timezone
 from django.contrib.auth import get_user_model
 
+class ChatRoomQuerySet(models.QuerySet):
+    def with_listing_data(self):
+        '''Creator and member count in the same query, for room listings'''
+        return self.select_related('creator').annotate(total_members=models.Count('members'))
+
+
 class ChatRoom(models.Model):
     room_id = models.UUIDField(default=uuid.uuid4, editable=False)
     room_name = models.CharField(max_length=100)
@@ -10,13 +17,54 @@ class ChatRoom(models.Model):
     members = models.ManyToManyField(get_user_model(), related_name='chatrooms')
     date_created = models.DateField(auto_now_add=True)
     date_updated = models.DateField(auto_now=True)
+    # Days of history to keep; None uses CHAT_RETENTION_DAYS and 0 keeps everything
+    retention_days = models.PositiveIntegerField(null=True, blank=True)
+    # Messages sent before this have been archived, see the archive_messages command
+    archived_before = models.DateTimeField(null=True, blank=True, editable=False)
+
+    objects = ChatRoomQuerySet.as_manager()
 
     def __str__(self):
         return self.room_name
 
+class MessageQuerySet(models.QuerySet):
+    def history(self, room):
+        '''A room's messages, stopping at its archive boundary'''
+        queryset = self.filter(room_id=room.pk)
+        if room.archived_before is not None:
+            queryset = queryset.filter(date_sent__gte=room.archived_before)
+        return queryset
+
+
 class Message(models.Model):
-    message_id = models.UUIDField(default=uuid.uuid4, editable=False)
+    message_id = models.UUIDField(default=uuid.uuid4, editable=False, db_index=True)
     content = models.TextField()
     sender = models.ForeignKey(get_user_model(), related_name='messages', on_delete=models.CASCADE)
     room = models.ForeignKey(ChatRoom, related_name='messages', on_delete=models.CASCADE)
-    date_sent = models.DateTimeField(auto_now_add=True)
\ No newline at end of file
+    # Not auto_now_add: write-behind sets it when the message is queued, and
+    # bulk_create must not replace it with the flush time
+    date_sent = models.DateTimeField(default=timezone.now, editable=False)
+    # The room's unread counter after this message (see chat.unread), so a read
+    # cursor here can be turned back into a count. None if it couldn't be bumped.
+    seq = models.PositiveBigIntegerField(null=True, editable=False)
+
+    objects = MessageQuerySet.as_manager()
+
+    class Meta:
+        indexes = [
+            # History pages are keyset scans over (room, date_sent, id)
+            models.Index(fields=['room', 'date_sent', 'id'], name='chat_message_history_idx'),
+        ]
+
+
+class ReadCursor(models.Model):
+    '''How far a member has read in a room: the last message they have seen'''
+    room = models.ForeignKey(ChatRoom, related_name='read_cursors', on_delete=models.CASCADE)
+    user = models.ForeignKey(get_user_model(), related_name='read_cursors', on_delete=models.CASCADE)
+    message_id = models.UUIDField()
+    read_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['room', 'user'], name='chat_readcursor_room_user'),
+        ]
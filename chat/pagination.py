@@ -0,0 +1,168 @@
+import base64
+import json
+import uuid
+from django.conf import settings
+from django.db.models import Q
+from django.utils.dateparse import parse_datetime
+from rest_framework.exceptions import ValidationError
+from rest_framework.pagination import BasePagination, LimitOffsetPagination
+from rest_framework.response import Response
+from rest_framework.utils.urls import remove_query_param, replace_query_param
+
+
+class MessageCursorPagination(BasePagination):
+    '''
+    Keyset pagination over a room's messages, newest first.
+
+    `before` / `after` accept either a message_id or an ISO timestamp. Pages are
+    bounded range scans on the (room, date_sent, id) index, never OFFSET scans.
+    '''
+    page_size = getattr(settings, 'CHAT_HISTORY_PAGE_SIZE', 50)
+    max_page_size = getattr(settings, 'CHAT_HISTORY_MAX_PAGE_SIZE', 200)
+    page_size_query_param = 'page_size'
+
+    def get_page_size(self, request):
+        value = request.query_params.get(self.page_size_query_param)
+        if value is None:
+            return self.page_size
+        try:
+            page_size = int(value)
+        except ValueError:
+            raise ValidationError({self.page_size_query_param: 'A valid integer is required.'})
+        return max(1, min(page_size, self.max_page_size))
+
+    def get_position(self, queryset, value):
+        '''Resolve a cursor value to a (date_sent, id) pair; id is None for timestamps.'''
+        if self._is_uuid(value):
+            position = queryset.filter(message_id=value).values_list('date_sent', 'id').first()
+            if position is None:
+                raise ValidationError({'cursor': 'Unknown message_id.'})
+            return position
+        timestamp = parse_datetime(value)
+        if timestamp is None:
+            raise ValidationError({'cursor': 'Expected a message_id or an ISO 8601 timestamp.'})
+        return timestamp, None
+
+    def _is_uuid(self, value):
+        try:
+            uuid.UUID(value)
+        except ValueError:
+            return False
+        return True
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.request = request
+        self.page_size_value = self.get_page_size(request)
+        before = request.query_params.get('before')
+        after = request.query_params.get('after')
+        if before and after:
+            raise ValidationError({'cursor': 'Use either before or after, not both.'})
+
+        if after:
+            date_sent, pk = self.get_position(queryset, after)
+            newer = Q(date_sent__gt=date_sent)
+            if pk is not None:
+                newer |= Q(date_sent=date_sent, id__gt=pk)
+            rows = list(queryset.filter(newer).order_by('date_sent', 'id')[:self.page_size_value + 1])
+            self.has_newer = len(rows) > self.page_size_value
+            self.has_older = True
+            rows = rows[:self.page_size_value]
+            rows.reverse()
+        else:
+            if before:
+                date_sent, pk = self.get_position(queryset, before)
+                older = Q(date_sent__lt=date_sent)
+                if pk is not None:
+                    older |= Q(date_sent=date_sent, id__lt=pk)
+                queryset = queryset.filter(older)
+            rows = list(queryset.order_by('-date_sent', '-id')[:self.page_size_value + 1])
+            self.has_older = len(rows) > self.page_size_value
+            self.has_newer = bool(before)
+            rows = rows[:self.page_size_value]
+
+        self.page = rows
+        return rows
+
+    def get_next_link(self):
+        '''Link to the next (older) page.'''
+        if not self.has_older or not self.page:
+            return None
+        url = remove_query_param(self.request.build_absolute_uri(), 'after')
+        return replace_query_param(url, 'before', str(self.page[-1].message_id))
+
+    def get_previous_link(self):
+        '''Link to the previous (newer) page.'''
+        if not self.has_newer or not self.page:
+            return None
+        url = remove_query_param(self.request.build_absolute_uri(), 'before')
+        return replace_query_param(url, 'after', str(self.page[0].message_id))
+
+    def get_paginated_response(self, data):
+        return Response({
+            'next': self.get_next_link(),
+            'previous': self.get_previous_link(),
+            'results': data,
+        })
+
+    def get_paginated_response_schema(self, schema):
+        return {
+            'type': 'object',
+            'properties': {
+                'next': {'type': 'string', 'nullable': True, 'format': 'uri'},
+                'previous': {'type': 'string', 'nullable': True, 'format': 'uri'},
+                'results': schema,
+            },
+        }
+
+
+class MessageSearchPagination(MessageCursorPagination):
+    '''
+    Forward-only keyset pagination over ranked search results. `cursor` is an
+    opaque token holding the (score, id) of the last result on the previous page.
+    '''
+    cursor_query_param = 'cursor'
+
+    def decode_cursor(self, request):
+        value = request.query_params.get(self.cursor_query_param)
+        if not value:
+            return None
+        try:
+            score, pk = json.loads(base64.urlsafe_b64decode(value.encode()))
+            return float(score), int(pk)
+        except (ValueError, TypeError):
+            raise ValidationError({self.cursor_query_param: 'Invalid cursor.'})
+
+    def encode_cursor(self, score, pk):
+        return base64.urlsafe_b64encode(json.dumps([score, pk]).encode()).decode()
+
+    def paginate_queryset(self, search, request, view=None):
+        self.request = request
+        page_size = self.get_page_size(request)
+        rows = search.page(self.decode_cursor(request), page_size + 1)
+        self.last = rows[page_size - 1] if len(rows) > page_size else None
+        self.page = [message for message, _ in rows[:page_size]]
+        return self.page
+
+    def get_next_link(self):
+        if self.last is None:
+            return None
+        message, score = self.last
+        return replace_query_param(self.request.build_absolute_uri(), self.cursor_query_param, self.encode_cursor(score, message.pk))
+
+    def get_paginated_response(self, data):
+        return Response({'next': self.get_next_link(), 'results': data})
+
+    def get_paginated_response_schema(self, schema):
+        return {
+            'type': 'object',
+            'properties': {
+                'next': {'type': 'string', 'nullable': True, 'format': 'uri'},
+                'results': schema,
+            },
+        }
+
+
+class PresencePagination(LimitOffsetPagination):
+    '''Pages of a room's online users; `count` is the room's online count.'''
+    default_limit = 100
+    max_limit = 1000
@@ -1,37 +1,36 @@
 from rest_framework.permissions import BasePermission, SAFE_METHODS
-from chat.models import ChatRoom
+from chat.membership import is_member
+
+# The room comes from ChatRoomViewSet.get_room(), which loads it once per request
 
 class IsChatRoomCreator(BasePermission):
     def has_permission(self, request, view):
-        chatroom = ChatRoom.objects.get(room_id=view.kwargs['room_id'])
-        return chatroom.creator == request.user or request.user.is_superuser
+        chatroom = view.get_room()
+        return chatroom.creator_id == request.user.pk or request.user.is_superuser
 
     def  has_object_permission(self, request, view, chatroom):
         if request.method in SAFE_METHODS:
             return True
-        return request.user == chatroom.creator
+        return request.user.pk == chatroom.creator_id
 
 
 class CanAdduser(BasePermission):
     def has_permission(self, request, view):
-        chatroom = ChatRoom.objects.get(room_id=view.kwargs['room_id'])
-        return chatroom.creator == request.user
+        chatroom = view.get_room()
+        return chatroom.creator_id == request.user.pk
 
 class GetMember(BasePermission):
     def has_permission(self, request, view):
-        chatroom = ChatRoom.objects.get(room_id=view.kwargs['room_id'])
+        chatroom = view.get_room()
         if request.user.is_authenticated:
-            if chatroom.creator == request.user or request.user.is_superuser:
+            if chatroom.creator_id == request.user.pk or request.user.is_superuser:
                 return True 
 
     def  has_object_permission(self, request, view, chatroom):
         if request.method in SAFE_METHODS:
             return True
-        chatroom = ChatRoom.objects.get(room_id=view.kwargs['room_id'])
-        return request.user == chatroom.creator
+        return request.user.pk == chatroom.creator_id
 
 class ChatRoomMember(BasePermission):
     def has_permission(self, request, view):
-        chatroom_members = ChatRoom.objects.get(room_id=view.kwargs['room_id']).members.all()
-        if request.user in chatroom_members:
-            return True
\ No newline at end of file
+        return is_member(view.get_room(), request.user)
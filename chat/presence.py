@@ -0,0 +1,244 @@
+import asyncio
+import logging
+import threading
+import time
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from .cache import REDIS_ERRORS, get_redis
+from .events import publish
+
+logger = logging.getLogger(__name__)
+
+
+def users_key(room_pk):
+    return f'chat:presence:{room_pk}'
+
+
+def connections_key(room_pk):
+    return f'chat:presence:{room_pk}:connections'
+
+
+class RedisPresenceStore:
+    '''
+    Who is online in each room, shared by every worker.
+
+    A sorted set per room maps user id -> last heartbeat, so the online count is
+    a ZCARD and pages of the online list are ZREVRANGE slices. A hash counts each
+    user's open sockets so a second tab closing doesn't mark the user offline.
+    Entries whose heartbeats stop (a crashed worker) are pruned after the TTL.
+    '''
+
+    def __init__(self, client):
+        self.client = client
+
+    def join(self, room_pk, user_pk):
+        '''Record a new socket; True if the user just came online'''
+        now = time.time()
+        pipe = self.client.pipeline()
+        pipe.hincrby(connections_key(room_pk), user_pk, 1)
+        pipe.zadd(users_key(room_pk), {user_pk: now})
+        self.expire(pipe, room_pk)
+        connections = pipe.execute()[0]
+        return connections == 1
+
+    def leave(self, room_pk, user_pk):
+        '''Record a closed socket; True if the user just went offline'''
+        connections = self.client.hincrby(connections_key(room_pk), user_pk, -1)
+        if connections > 0:
+            return False
+        pipe = self.client.pipeline()
+        pipe.hdel(connections_key(room_pk), user_pk)
+        pipe.zrem(users_key(room_pk), user_pk)
+        pipe.execute()
+        return True
+
+    def heartbeat(self, room_pk, user_pk):
+        pipe = self.client.pipeline(transaction=False)
+        pipe.zadd(users_key(room_pk), {user_pk: time.time()}, xx=True)
+        self.expire(pipe, room_pk)
+        pipe.execute()
+
+    def expire(self, pipe, room_pk):
+        # The whole room disappears once nobody has sent a heartbeat for a while
+        ttl = int(settings.CHAT_PRESENCE_TTL * 2)
+        pipe.expire(users_key(room_pk), ttl)
+        pipe.expire(connections_key(room_pk), ttl)
+
+    def prune(self, room_pk):
+        cutoff = time.time() - settings.CHAT_PRESENCE_TTL
+        stale = self.client.zrangebyscore(users_key(room_pk), '-inf', cutoff)
+        if stale:
+            pipe = self.client.pipeline()
+            pipe.zremrangebyscore(users_key(room_pk), '-inf', cutoff)
+            pipe.hdel(connections_key(room_pk), *stale)
+            pipe.execute()
+
+    def count(self, room_pk):
+        self.prune(room_pk)
+        return self.client.zcard(users_key(room_pk))
+
+    def online(self, room_pk, start, stop):
+        '''(user id, last heartbeat) pairs, most recently active first'''
+        entries = self.client.zrevrange(users_key(room_pk), start, stop - 1, withscores=True)
+        return [(int(user_pk), last_seen) for user_pk, last_seen in entries]
+
+
+class LocalPresenceStore:
+    '''Per-process stand-in for RedisPresenceStore when REDIS_URL is not configured.'''
+
+    def __init__(self):
+        self.rooms = {}
+        self.lock = threading.Lock()
+
+    def join(self, room_pk, user_pk):
+        with self.lock:
+            users = self.rooms.setdefault(room_pk, {})
+            last_seen, connections = users.get(user_pk, (0, 0))
+            users[user_pk] = (time.time(), connections + 1)
+            return connections == 0
+
+    def leave(self, room_pk, user_pk):
+        with self.lock:
+            users = self.rooms.get(room_pk, {})
+            last_seen, connections = users.get(user_pk, (0, 1))
+            if connections > 1:
+                users[user_pk] = (last_seen, connections - 1)
+                return False
+            users.pop(user_pk, None)
+            return True
+
+    def heartbeat(self, room_pk, user_pk):
+        with self.lock:
+            users = self.rooms.get(room_pk, {})
+            if user_pk in users:
+                users[user_pk] = (time.time(), users[user_pk][1])
+
+    def prune(self, room_pk):
+        cutoff = time.time() - settings.CHAT_PRESENCE_TTL
+        with self.lock:
+            users = self.rooms.get(room_pk, {})
+            for user_pk in [user_pk for user_pk, (last_seen, _) in users.items() if last_seen <= cutoff]:
+                del users[user_pk]
+
+    def count(self, room_pk):
+        self.prune(room_pk)
+        return len(self.rooms.get(room_pk, {}))
+
+    def online(self, room_pk, start, stop):
+        with self.lock:
+            users = sorted(self.rooms.get(room_pk, {}).items(), key=lambda item: item[1][0], reverse=True)
+        return [(user_pk, last_seen) for user_pk, (last_seen, _) in users[start:stop]]
+
+    def clear(self):
+        with self.lock:
+            self.rooms.clear()
+
+
+_local_store = LocalPresenceStore()
+
+
+def get_store():
+    client = get_redis()
+    if client is None:
+        return _local_store
+    return RedisPresenceStore(client)
+
+
+class OnlineUsers:
+    '''
+    Lazy, sliceable view of a room's online users, so DRF's pagination classes can
+    page through it. Only the requested slice is fetched.
+    '''
+
+    def __init__(self, room_pk, store=None):
+        self.room_pk = room_pk
+        self.store = store or get_store()
+
+    def count(self):
+        return self.store.count(self.room_pk)
+
+    def __len__(self):
+        return self.count()
+
+    def __getitem__(self, index):
+        if not isinstance(index, slice):
+            raise TypeError('OnlineUsers only supports slicing')
+        return self.store.online(self.room_pk, index.start or 0, index.stop)
+
+
+class PresenceNotifier:
+    '''
+    Coalesces join/leave notifications into one presence diff per room per
+    interval, instead of a broadcast per connect and disconnect. A user who
+    leaves and rejoins within the same interval produces no notification.
+    '''
+
+    def __init__(self, interval):
+        self.interval = interval
+        self.pending = {}
+        self.lock = threading.Lock()
+        # The loop a flush is scheduled on, if any
+        self.scheduled = None
+        self.last_flush = time.monotonic()
+        # Held so the loop's weak references don't let a scheduled flush be collected
+        self.tasks = set()
+
+    def joined(self, room, username):
+        self.record(room, username, 'joined', 'left')
+
+    def left(self, room, username):
+        self.record(room, username, 'left', 'joined')
+
+    def record(self, room, username, change, opposite):
+        with self.lock:
+            diff = self.pending.setdefault(room.pk, {'room': room, 'joined': set(), 'left': set()})
+            if username in diff[opposite]:
+                diff[opposite].discard(username)
+            else:
+                diff[change].add(username)
+
+    def take(self):
+        with self.lock:
+            pending, self.pending = self.pending, {}
+            self.last_flush = time.monotonic()
+            self.scheduled = None
+        return [diff for diff in pending.values() if diff['joined'] or diff['left']]
+
+    async def flush_soon(self):
+        '''Flush now if the interval has passed, otherwise make sure a flush is scheduled on this loop.'''
+        wait = self.interval - (time.monotonic() - self.last_flush)
+        if wait <= 0:
+            await self.flush()
+            return
+        loop = asyncio.get_running_loop()
+        with self.lock:
+            # A flush scheduled on a loop that has since closed will never run
+            if self.scheduled is not None and not self.scheduled.is_closed():
+                return
+            self.scheduled = loop
+        loop.call_later(wait, self.start_flush, loop)
+
+    def start_flush(self, loop):
+        task = loop.create_task(self.flush())
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    async def flush(self):
+        for diff in self.take():
+            room = diff['room']
+            try:
+                online = await sync_to_async(get_store().count, thread_sensitive=False)(room.pk)
+            except REDIS_ERRORS:
+                online = None
+            try:
+                await publish(room, {
+                    'type': 'presence_diff',
+                    'joined': sorted(diff['joined']),
+                    'left': sorted(diff['left']),
+                    'online': online,
+                })
+            except Exception:
+                logger.exception('Could not publish presence diff for room %s', room.pk)
+
+
+notifier = PresenceNotifier(settings.CHAT_PRESENCE_DIFF_INTERVAL)
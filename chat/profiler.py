@@ -0,0 +1,136 @@
+import os
+import re
+import signal
+import sys
+import threading
+import time
+from collections import Counter
+from datetime import datetime
+from functools import lru_cache
+from django.conf import settings
+
+# Leaf frames of threads with nothing to do: the event loop waiting in select()
+# and executor threads (database_sync_to_async, sync views) waiting for work.
+# Threads blocked anywhere else, e.g. in async_to_sync, are kept.
+IDLE_FRAMES = {
+    ('selectors.py', 'select'),
+    ('thread.py', '_worker'),
+}
+
+
+class ProfilerBusy(Exception):
+    pass
+
+
+@lru_cache(maxsize=None)
+def short_path(filename):
+    '''Path relative to the longest sys.path entry containing it'''
+    best = ''
+    for entry in sys.path:
+        entry = os.path.join(os.path.abspath(entry or '.'), '')
+        if filename.startswith(entry) and len(entry) > len(best):
+            best = entry
+    return filename[len(best):]
+
+
+@lru_cache(maxsize=16384)
+def frame_label(code):
+    return f'{code.co_name} ({short_path(code.co_filename)}:{code.co_firstlineno})'
+
+
+def thread_group(name):
+    '''Threads of one pool share a root frame: ThreadPoolExecutor-3_0 -> ThreadPoolExecutor-N_N'''
+    return re.sub(r'\d+', 'N', name)
+
+
+def is_idle(frame):
+    return (os.path.basename(frame.f_code.co_filename), frame.f_code.co_name) in IDLE_FRAMES
+
+
+def sample(stacks, skip, include_idle=False):
+    '''Add one sample of every thread's Python stack, root first, to the `stacks` Counter'''
+    names = {thread.ident: thread.name for thread in threading.enumerate()}
+    for ident, frame in sys._current_frames().items():
+        if ident == skip or (not include_idle and is_idle(frame)):
+            continue
+        stack = []
+        while frame is not None:
+            stack.append(frame_label(frame.f_code))
+            frame = frame.f_back
+        stack.append(thread_group(names.get(ident, 'unknown')))
+        stacks[';'.join(reversed(stack))] += 1
+
+
+def collapsed(stacks):
+    '''Brendan Gregg's collapsed format, one "frame;frame;frame count" line per stack'''
+    return ''.join(f'{stack} {count}\n' for stack, count in sorted(stacks.items()))
+
+
+class Profiler:
+    '''
+    Time-boxed sampling profiler for the whole worker process. A background
+    thread snapshots every thread's stack each `interval` seconds, so the event
+    loop, the executor threads behind sync_to_async/database_sync_to_async and
+    threads blocked in async_to_sync all show up, grouped by thread name. The
+    result is written as collapsed stacks for flamegraph.pl or speedscope.
+    '''
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.thread = None
+        self.last_path = None
+
+    @property
+    def running(self):
+        return self.thread is not None and self.thread.is_alive()
+
+    def start(self, seconds, interval=None, output_dir=None):
+        '''Start profiling in the background; returns the path the profile will be written to'''
+        interval = interval or settings.CHAT_PROFILER_INTERVAL
+        output_dir = output_dir or settings.CHAT_PROFILER_DIR
+        with self.lock:
+            if self.running:
+                raise ProfilerBusy('A profile is already being captured.')
+            # Microseconds, so back-to-back short profiles don't overwrite each other
+            stamp = datetime.now().strftime('%Y%m%dT%H%M%S%f')
+            path = os.path.join(output_dir, f'profile-{os.getpid()}-{stamp}.collapsed')
+            self.thread = threading.Thread(
+                target=self.run, args=(seconds, interval, path), name='chat-profiler', daemon=True,
+            )
+            self.thread.start()
+        return path
+
+    def run(self, seconds, interval, path):
+        stacks = Counter()
+        me = threading.get_ident()
+        deadline = time.monotonic() + seconds
+        while time.monotonic() < deadline:
+            sample(stacks, me)
+            time.sleep(interval)
+
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path + '.partial', 'w', encoding='utf-8') as output:
+            output.write(collapsed(stacks))
+        os.replace(path + '.partial', path)
+        self.last_path = path
+
+    def wait(self, timeout=None):
+        thread = self.thread
+        if thread is not None:
+            thread.join(timeout)
+
+
+profiler = Profiler()
+
+
+def handle_signal(signum, frame):
+    try:
+        profiler.start(settings.CHAT_PROFILER_SECONDS)
+    except ProfilerBusy:
+        pass
+
+
+def install_signal_handler():
+    '''`kill -<CHAT_PROFILER_SIGNAL> <pid>` profiles that worker. Only possible from the main thread.'''
+    if threading.current_thread() is threading.main_thread() and hasattr(signal, settings.CHAT_PROFILER_SIGNAL):
+        signal.signal(getattr(signal, settings.CHAT_PROFILER_SIGNAL), handle_signal)
@@ -0,0 +1,135 @@
+import json
+from datetime import datetime
+import msgpack
+
+
+class JSONProtocol:
+    '''
+    The default wire format: JSON text frames. Chat messages keep their original
+    {"message": <event>} envelope so existing clients are unaffected.
+    '''
+    subprotocol = 'chat.json'
+
+    def decode(self, text_data=None, bytes_data=None):
+        if text_data is None:
+            raise ValueError('Frames must be JSON text.')
+        return json.loads(text_data)
+
+    def encode(self, kind, payload):
+        if kind == 'message':
+            payload = {'message': payload}
+        return {'text_data': json.dumps(payload)}
+
+
+class MsgpackProtocol:
+    '''
+    Compact binary frames for clients that negotiate `chat.msgpack.v1`.
+
+    Every frame is a msgpack map with short keys and a schema version:
+        message  {v, t: "message", id, u, c, ts}
+        ack      {v, t: "ack", id, cid, ts}
+        error    {v, t: "error", cid, e}
+        info     {v, t: "info", m}
+        presence {v, t: "presence", j, l, n}
+        typing   {v, t: "typing", u, s}
+        read     {v, t: "read", u, id}
+    `ts` is milliseconds since the epoch. Clients send {t: "message", c, cid},
+    {t: "typing", s} or {t: "read", id}.
+    '''
+    subprotocol = 'chat.msgpack.v1'
+    version = 1
+
+    def decode(self, text_data=None, bytes_data=None):
+        if bytes_data is None:
+            raise ValueError('Frames must be msgpack binary.')
+        try:
+            frame = msgpack.unpackb(bytes_data)
+        except Exception:
+            raise ValueError('Frames must be msgpack binary.')
+        if not isinstance(frame, dict):
+            raise ValueError('Frames must be msgpack maps.')
+        return {'type': frame.get('t', 'message'), 'content': frame.get('c'), 'client_id': frame.get('cid'),
+                'state': frame.get('s'), 'message_id': frame.get('id')}
+
+    def encode(self, kind, payload):
+        frame = getattr(self, f'encode_{kind}')(payload)
+        frame['v'] = self.version
+        return {'bytes_data': msgpack.packb(frame)}
+
+    def encode_message(self, event):
+        return {'t': 'message', 'id': event['message_id'], 'u': event['user'],
+                'c': event.get('content'), 'ts': timestamp_ms(event.get('date_sent'))}
+
+    def encode_ack(self, payload):
+        return {'t': 'ack', 'id': payload['message_id'], 'cid': payload.get('client_id'),
+                'ts': timestamp_ms(payload.get('date_sent'))}
+
+    def encode_error(self, payload):
+        return {'t': 'error', 'cid': payload.get('client_id'), 'e': payload['errors']}
+
+    def encode_info(self, payload):
+        return {'t': 'info', 'm': payload.get('message')}
+
+    def encode_presence(self, payload):
+        return {'t': 'presence', 'j': payload['joined'], 'l': payload['left'], 'n': payload['online']}
+
+    def encode_typing(self, payload):
+        return {'t': 'typing', 'u': payload['user'], 's': payload['state']}
+
+    def encode_read(self, payload):
+        return {'t': 'read', 'u': payload['user'], 'id': payload['message_id']}
+
+
+def timestamp_ms(value):
+    if value is None:
+        return None
+    return int(datetime.fromisoformat(value).timestamp() * 1000)
+
+
+PROTOCOLS = [MsgpackProtocol, JSONProtocol]
+
+# Group event type -> outgoing frame kind
+EVENT_FRAMES = {
+    'chat_message': 'message',
+    'send_info_to_user_group': 'info',
+    'presence_diff': 'presence',
+    'chat_typing': 'typing',
+    'chat_read': 'read',
+}
+
+
+def frame_payload(event):
+    '''The part of a group event that becomes the outgoing frame'''
+    if event['type'] == 'send_info_to_user_group':
+        return event['text']
+    if event['type'] == 'chat_typing':
+        return {'type': 'typing', 'user': event['user'], 'state': event['state']}
+    if event['type'] == 'chat_read':
+        return {'type': 'read', 'user': event['user'], 'message_id': event['message_id']}
+    return event
+
+
+def encode_once(event):
+    '''
+    Pre-encode a group event's outgoing frame once per wire protocol and attach
+    the results as event["frames"], so that each subscriber forwards ready-made
+    bytes instead of encoding the same event again.
+    '''
+    kind = EVENT_FRAMES.get(event['type'])
+    if kind is None:
+        return event
+    payload = frame_payload(event)
+    frames = {protocol.subprotocol: protocol().encode(kind, payload) for protocol in PROTOCOLS}
+    return {**event, 'frames': frames}
+
+
+def negotiate(subprotocols):
+    '''
+    Pick the wire protocol from the client's Sec-WebSocket-Protocol offers.
+    Returns the protocol and the subprotocol to accept with (None if the client
+    offered nothing we know, in which case JSON is used).
+    '''
+    for protocol in PROTOCOLS:
+        if protocol.subprotocol in subprotocols:
+            return protocol(), protocol.subprotocol
+    return JSONProtocol(), None
@@ -0,0 +1,163 @@
+import logging
+import math
+import threading
+import time
+from django.conf import settings
+from rest_framework.throttling import BaseThrottle
+from .cache import LRUCache, MISSING, REDIS_ERRORS, get_redis
+
+logger = logging.getLogger(__name__)
+
+# Takes one token from every bucket in KEYS, or from none of them. ARGV is the
+# current time followed by a (rate, burst) pair per key. Returns the seconds to
+# wait before a token is available in all of them, "0" when one was taken.
+TAKE_SCRIPT = '''
+local now = tonumber(ARGV[1])
+local wait = 0
+local levels = {}
+for i, key in ipairs(KEYS) do
+    local rate, burst = tonumber(ARGV[i * 2]), tonumber(ARGV[i * 2 + 1])
+    local bucket = redis.call('HMGET', key, 'tokens', 'ts')
+    local tokens = tonumber(bucket[1]) or burst
+    local elapsed = math.max(0, now - (tonumber(bucket[2]) or now))
+    tokens = math.min(burst, tokens + elapsed * rate)
+    levels[i] = tokens
+    if tokens < 1 then
+        wait = math.max(wait, (1 - tokens) / rate)
+    end
+end
+if wait > 0 then
+    return tostring(wait)
+end
+for i, key in ipairs(KEYS) do
+    local rate, burst = tonumber(ARGV[i * 2]), tonumber(ARGV[i * 2 + 1])
+    redis.call('HSET', key, 'tokens', tostring(levels[i] - 1), 'ts', ARGV[1])
+    redis.call('EXPIRE', key, math.ceil(burst / rate) + 1)
+end
+return '0'
+'''
+
+
+def refill_time(rate, burst):
+    '''Seconds for an empty bucket to fill up again; after that it can be forgotten'''
+    return math.ceil(burst / rate) + 1
+
+
+class RedisBucketStore:
+    '''Token buckets shared by every worker, updated atomically by one Lua call.'''
+
+    def __init__(self, client):
+        self.client = client
+
+    def take(self, limits):
+        keys = [key for key, _, _ in limits]
+        args = [time.time()]
+        for _, rate, burst in limits:
+            args += [rate, burst]
+        return float(self.client.eval(TAKE_SCRIPT, len(keys), *keys, *args))
+
+
+class LocalBucketStore:
+    '''
+    Per-process token buckets: the fallback when Redis is not configured or not
+    reachable, and the home of per-connection buckets, which never leave the
+    process serving the socket. Idle buckets are full, so they simply expire.
+    '''
+
+    def __init__(self, maxsize=100000):
+        self.buckets = LRUCache(maxsize=maxsize, ttl=60)
+        self.lock = threading.Lock()
+
+    def levels(self, limits, now):
+        '''Current tokens in each bucket, and the seconds until all have one'''
+        levels = []
+        wait = 0
+        for key, rate, burst in limits:
+            bucket = self.buckets.get(key)
+            tokens, updated = (burst, now) if bucket is MISSING else bucket
+            tokens = min(burst, tokens + (now - updated) * rate)
+            levels.append(tokens)
+            if tokens < 1:
+                wait = max(wait, (1 - tokens) / rate)
+        return levels, wait
+
+    def take(self, limits):
+        now = time.monotonic()
+        with self.lock:
+            levels, wait = self.levels(limits, now)
+            if wait:
+                return wait
+            for (key, rate, burst), tokens in zip(limits, levels):
+                self.buckets.set(key, (tokens - 1, now), refill_time(rate, burst))
+        return 0
+
+    def wait(self, limits):
+        '''Like take(), without taking anything'''
+        with self.lock:
+            return self.levels(limits, time.monotonic())[1]
+
+    def clear(self):
+        self.buckets.clear()
+
+
+_local_store = LocalBucketStore()
+
+
+def send_limits(user_pk, room_pk):
+    '''(bucket key, tokens per second, burst) for each shared limit that is turned on'''
+    limits = [
+        (f'chat:ratelimit:user:{user_pk}', settings.CHAT_SEND_RATE_PER_USER, settings.CHAT_SEND_BURST_PER_USER),
+        (f'chat:ratelimit:room:{room_pk}', settings.CHAT_SEND_RATE_PER_ROOM, settings.CHAT_SEND_BURST_PER_ROOM),
+    ]
+    return [limit for limit in limits if limit[1] > 0]
+
+
+def check_send(user_pk, room_pk, connection=None):
+    '''
+    Take a token for one message from the user's and the room's buckets, and the
+    connection's when sent over a socket. Tokens are taken from all of them or
+    from none. Returns 0 if the message may go ahead, otherwise the seconds
+    until it could.
+    '''
+    connection_limits = []
+    if connection is not None and settings.CHAT_SEND_RATE_PER_CONNECTION > 0:
+        connection_limits = [(
+            ('connection', connection),
+            settings.CHAT_SEND_RATE_PER_CONNECTION,
+            settings.CHAT_SEND_BURST_PER_CONNECTION,
+        )]
+        # Only checked here and taken last: a socket handles one message at a
+        # time, so nothing else can take its token in between
+        wait = _local_store.wait(connection_limits)
+        if wait:
+            return wait
+
+    wait = take_shared(send_limits(user_pk, room_pk))
+    if not wait and connection_limits:
+        _local_store.take(connection_limits)
+    return wait
+
+
+def take_shared(limits):
+    if not limits:
+        return 0
+    client = get_redis()
+    if client is not None:
+        try:
+            return RedisBucketStore(client).take(limits)
+        except REDIS_ERRORS:
+            logger.warning('Redis unavailable for rate limiting, using per-process buckets', exc_info=True)
+    return _local_store.take(limits)
+
+
+class SendRateThrottle(BaseThrottle):
+    '''Applies the send limits to POSTs on a room view; other methods are not throttled.'''
+
+    def allow_request(self, request, view):
+        if request.method != 'POST':
+            return True
+        self.delay = check_send(request.user.pk, view.get_room().pk)
+        return not self.delay
+
+    def wait(self):
+        return self.delay
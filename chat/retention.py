@@ -0,0 +1,103 @@
+import gzip
+import json
+import os
+import time
+from datetime import timedelta
+from django.conf import settings
+from django.utils import timezone
+from .export import keyset_walk
+from .models import ChatRoom, Message
+from . import rooms
+
+
+def retention_days(room):
+    '''Days of history the room keeps, or 0 to keep everything'''
+    if room.retention_days is not None:
+        return room.retention_days
+    return settings.CHAT_RETENTION_DAYS
+
+
+def retention_cutoff(room, now=None):
+    days = retention_days(room)
+    if not days:
+        return None
+    return (now or timezone.now()) - timedelta(days=days)
+
+
+def archive_path(output_dir, room, cutoff):
+    return os.path.join(output_dir, str(room.room_id), f'{cutoff:%Y%m%dT%H%M%S}.jsonl.gz')
+
+
+def iter_expired(room, cutoff, batch_size):
+    '''Messages sent before `cutoff`, oldest first, read in keyset batches on the history index'''
+    return keyset_walk(
+        Message.objects.filter(room_id=room.pk, date_sent__lt=cutoff),
+        ['message_id', 'sender_id', 'sender__username', 'content'], batch_size,
+    )
+
+
+def write_archive(room, cutoff, path, batch_size):
+    '''Stream expired messages to a gzipped JSONL file; the file only appears once complete'''
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    partial = path + '.partial'
+    count = 0
+    with gzip.open(partial, 'wt', encoding='utf-8') as archive:
+        for message in iter_expired(room, cutoff, batch_size):
+            archive.write(json.dumps({
+                'message_id': str(message['message_id']),
+                'room_id': str(room.room_id),
+                'sender_id': message['sender_id'],
+                'sender': message['sender__username'],
+                'content': message['content'],
+                'date_sent': message['date_sent'].isoformat(),
+            }) + '\n')
+            count += 1
+        archive.flush()
+        os.fsync(archive.fileno())
+    if count:
+        os.replace(partial, path)
+    else:
+        os.remove(partial)
+    return count
+
+
+def move_boundary(room, cutoff):
+    '''From here on history endpoints stop at `cutoff`, even before the rows are gone'''
+    if room.archived_before is None or room.archived_before < cutoff:
+        ChatRoom.objects.filter(pk=room.pk).update(archived_before=cutoff)
+        room.archived_before = cutoff
+        rooms.invalidate(room.room_id)
+
+
+def delete_expired(room, cutoff, chunk_size, pause=0):
+    '''Delete in small autocommitted chunks so no transaction holds locks for long'''
+    deleted = 0
+    while True:
+        ids = list(
+            Message.objects.filter(room_id=room.pk, date_sent__lt=cutoff)
+            .order_by('date_sent', 'id').values_list('id', flat=True)[:chunk_size]
+        )
+        if not ids:
+            return deleted
+        deleted += Message.objects.filter(id__in=ids).delete()[0]
+        if pause:
+            time.sleep(pause)
+
+
+def archive_room(room, output_dir, batch_size=1000, chunk_size=500, pause=0, now=None):
+    '''
+    Archive and delete a room's messages older than its retention period.
+    Returns (archive path or None, messages archived, messages deleted).
+
+    Rows are only deleted once the archive file is complete. If a run is
+    interrupted while deleting, the next run archives what is left to a new
+    file, so restoring should skip message_ids it has already seen.
+    '''
+    cutoff = retention_cutoff(room, now)
+    if cutoff is None:
+        return None, 0, 0
+    path = archive_path(output_dir, room, cutoff)
+    archived = write_archive(room, cutoff, path, batch_size)
+    move_boundary(room, cutoff)
+    deleted = delete_expired(room, cutoff, chunk_size, pause) if archived else 0
+    return (path if archived else None), archived, deleted
@@ -0,0 +1,115 @@
+import logging
+import uuid
+from django.conf import settings
+from django.core.cache import cache
+from .cache import LRUCache, MISSING, REDIS_ERRORS
+from .models import ChatRoom
+
+logger = logging.getLogger(__name__)
+
+# Enough to authorise and publish to a room; other fields load lazily if touched.
+# Kept in model field order, which Model.from_db() expects for partial rows.
+ROOM_FIELDS = [
+    field.attname for field in ChatRoom._meta.concrete_fields
+    if field.attname in {'id', 'room_id', 'room_name', 'creator_id', 'archived_before'}
+]
+
+_cache = LRUCache(maxsize=settings.CHAT_MEMBERSHIP_CACHE_SIZE, ttl=settings.CHAT_MEMBERSHIP_CACHE_TTL)
+
+
+def room_key(room_id):
+    return f'chat:room:{room_id}'
+
+
+def group_name(room_id):
+    '''
+    Channel layer group for a room. Derived from room_id alone, so it needs no
+    lookup and two rooms can never share a group.
+    '''
+    return f'chat_{uuid.UUID(str(room_id)).hex}'
+
+
+def legacy_group_name(room):
+    '''The name-based group rooms used before group names moved to room_id'''
+    return 'chat_' + room.room_name.replace(' ', '-').lower()[:99]
+
+
+# Event types the previous release's consumer handles, and the fields it was sent.
+# It JSON-encodes chat_message events whole, so pre-encoded frames must not reach it.
+LEGACY_EVENT_FIELDS = {
+    'chat_message': ('type', 'message', 'message_id', 'user', 'room_name'),
+    'send_info_to_user_group': ('type', 'text'),
+}
+
+
+def legacy_event(event):
+    '''`event` as the previous release sent it, or None if it had no such event'''
+    fields = LEGACY_EVENT_FIELDS.get(event['type'])
+    if fields is None:
+        return None
+    return {field: event[field] for field in fields if field in event}
+
+
+def group_events(room, event):
+    '''
+    (group, event) pairs a room event is sent as. While CHAT_LEGACY_GROUP_NAMES
+    is on, events also go to the old name-based group, in the old shape, so
+    sockets still held by workers running the previous release keep receiving
+    them during a rolling deploy.
+    '''
+    sends = [(group_name(room.room_id), event)]
+    if settings.CHAT_LEGACY_GROUP_NAMES:
+        legacy = legacy_event(event)
+        if legacy is not None:
+            sends.append((legacy_group_name(room), legacy))
+    return sends
+
+
+def get_room(room_id):
+    '''
+    The ChatRoom with this room_id, or None. Served from the local tier, then the
+    shared cache, then the database; only ROOM_FIELDS are loaded.
+
+    The shared tier is only used with REDIS_URL. Without it the cache is per
+    process, and invalidations would never reach the other workers' copies.
+    '''
+    # One cache key per room, however the UUID in the URL was spelled
+    try:
+        room_id = str(uuid.UUID(str(room_id)))
+    except ValueError:
+        return None
+    values = _cache.get(room_id)
+    if values is MISSING:
+        values = None
+        if settings.REDIS_URL:
+            try:
+                values = cache.get(room_key(room_id))
+            except REDIS_ERRORS:
+                logger.warning('Cache unavailable for room %s, using the database', room_id, exc_info=True)
+        if values is not None and len(values) != len(ROOM_FIELDS):
+            # Cached by a release that loaded different fields
+            values = None
+        if values is None:
+            values = ChatRoom.objects.filter(room_id=room_id).values_list(*ROOM_FIELDS).first()
+            if values is None:
+                return None
+            if settings.REDIS_URL:
+                try:
+                    cache.set(room_key(room_id), values, settings.CHAT_ROOM_CACHE_TTL)
+                except REDIS_ERRORS:
+                    pass
+        _cache.set(room_id, values)
+    return ChatRoom.from_db('default', ROOM_FIELDS, values)
+
+
+def invalidate(room_id):
+    room_id = str(uuid.UUID(str(room_id)))
+    _cache.delete(room_id)
+    try:
+        cache.delete(room_key(room_id))
+    except REDIS_ERRORS:
+        logger.warning('Could not invalidate cached room %s', room_id, exc_info=True)
+
+
+def clear():
+    _cache.clear()
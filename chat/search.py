@@ -0,0 +1,76 @@
+import re
+from django.db import connection
+from rest_framework import status
+from rest_framework.exceptions import APIException
+from .models import Message
+
+# Lower scores rank higher on every backend, so pages are keyset scans on (score, id)
+SQLITE_QUERY = '''
+SELECT id, score FROM (
+    SELECT rowid AS id, bm25(chat_message_fts) AS score
+    FROM chat_message_fts
+    WHERE chat_message_fts MATCH %s AND room_id = %s
+) AS matches
+{after}
+ORDER BY score, id
+LIMIT %s
+'''
+
+# to_tsvector('english', content) is the expression indexed by migration 0007
+POSTGRESQL_QUERY = '''
+SELECT id, score FROM (
+    SELECT m.id, (-ts_rank(to_tsvector('english', m.content), query))::float8 AS score
+    FROM chat_message m, websearch_to_tsquery('english', %s) query
+    WHERE to_tsvector('english', m.content) @@ query AND m.room_id = %s
+) AS matches
+{after}
+ORDER BY score, id
+LIMIT %s
+'''
+
+AFTER = 'WHERE score > %s OR (score = %s AND id > %s)'
+
+QUERIES = {'sqlite': SQLITE_QUERY, 'postgresql': POSTGRESQL_QUERY}
+
+
+class SearchUnavailable(APIException):
+    status_code = status.HTTP_501_NOT_IMPLEMENTED
+    default_detail = 'Message search is not supported on this database.'
+    default_code = 'search_unavailable'
+
+
+def fts5_query(text):
+    '''User input as an FTS5 query: every word must match, FTS5 syntax is not interpreted'''
+    return ' '.join(f'"{word}"' for word in re.findall(r'\w+', text))
+
+
+class MessageSearch:
+    '''
+    Ranked full-text search over one room's messages, backed by the FTS5 table
+    on SQLite and the GIN index on PostgreSQL. Pages are fetched with
+    `page(after, limit)`, where `after` is the (score, id) of the last result seen.
+    '''
+
+    def __init__(self, room, text):
+        self.room = room
+        self.text = text
+
+    def page(self, after, limit):
+        '''Up to `limit` (message, score) pairs, best match first'''
+        sql = QUERIES.get(connection.vendor)
+        if sql is None:
+            raise SearchUnavailable()
+        text = fts5_query(self.text) if connection.vendor == 'sqlite' else self.text
+        if not text:
+            return []
+        params = [text, self.room.pk]
+        if after is not None:
+            params += [after[0], after[0], after[1]]
+        params.append(limit)
+        with connection.cursor() as cursor:
+            cursor.execute(sql.format(after=AFTER if after is not None else ''), params)
+            matches = cursor.fetchall()
+
+        # Matches past the archive boundary that haven't been deleted yet are dropped here
+        messages = Message.objects.history(self.room).select_related('sender', 'room').in_bulk([pk for pk, _ in matches])
+        return [(messages[pk], score) for pk, score in matches if pk in messages]
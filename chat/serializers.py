@@ -1,6 +1,9 @@
+from django.conf import settings
 from django.contrib.auth import get_user_model
 from rest_framework import serializers
-from .models import ChatRoom, Message
+from .models import ChatRoom, Message, ReadCursor
+from . import unread
+from .writebehind import get_message_buffer
 
 
 class ChatRoomSerializer(serializers.ModelSerializer):
@@ -8,11 +11,23 @@ class ChatRoomSerializer(serializers.ModelSerializer):
     total_members = serializers.SerializerMethodField()
     class Meta:
         model = ChatRoom
-        fields = ['room_id', 'room_name', 'creator','total_members','date_created']
+        fields = ['room_id', 'room_name', 'creator','total_members','date_created', 'retention_days']
 
     def get_total_members(self, chatroom):
-        total = chatroom.members.count()
-        return total
+        # Annotated by ChatRoom.objects.with_listing_data()
+        if hasattr(chatroom, 'total_members'):
+            return chatroom.total_members
+        return chatroom.members.count()
+
+
+class UserChatRoomSerializer(ChatRoomSerializer):
+    unread_count = serializers.SerializerMethodField()
+    class Meta(ChatRoomSerializer.Meta):
+        fields = ChatRoomSerializer.Meta.fields + ['unread_count']
+
+    def get_unread_count(self, chatroom):
+        # Looked up for every room at once by the view; None if counts are unavailable
+        return self.context.get('unread_counts', {}).get(chatroom.pk)
     
 class CreateChatRoomSerializer(serializers.ModelSerializer):
     class Meta:
@@ -41,8 +56,7 @@ class AddUserToRoomSerializer(serializers.Serializer):
         return username
 
     def create(self, validated_data):
-        room_id = self.context['room_id']
-        chatroom = ChatRoom.objects.get(room_id=room_id)
+        chatroom = self.context['room']
         user = get_user_model().objects.get(username=validated_data['username'])
         chatroom.members.add(user)
         return user
@@ -65,19 +79,49 @@ class SendChatSerializer(serializers.ModelSerializer):
 
     def create(self, validated_data):
         user = self.context['user']
-        room_id = self.context['room_id']
-        chatroom = ChatRoom.objects.get(room_id=room_id)
-        message  = Message.objects.create(
+        chatroom = self.context['room']
+        message = Message(
             content = validated_data['content'],
             sender = user,
             room = chatroom,
         )
+        message.seq = unread.message_created(message)
+        if settings.CHAT_WRITE_BEHIND:
+            message = get_message_buffer().enqueue(message)
+        else:
+            message.save()
         return message
     
 
+class ReadCursorSerializer(serializers.ModelSerializer):
+    user = serializers.StringRelatedField()
+    class Meta:
+        model = ReadCursor
+        fields = ['user', 'message_id', 'read_at']
+        read_only_fields = ['read_at']
+
+    def validate_message_id(self, message_id):
+        if unread.read_message(self.context['room'], message_id) is None:
+            raise serializers.ValidationError('Message not found in this room.')
+        return message_id
+
+    def create(self, validated_data):
+        return unread.mark_read(self.context['room'], self.context['user'], validated_data['message_id'])
+
+
 class MessageSerializer(serializers.ModelSerializer):
     room = serializers.StringRelatedField()
     sender = serializers.StringRelatedField()
     class Meta:
         model = Message
-        fields = "__all__"
\ No newline at end of file
+        exclude = ['seq']
+
+
+class ProfileSerializer(serializers.Serializer):
+    seconds = serializers.FloatField(min_value=0.1, required=False)
+    interval = serializers.FloatField(min_value=0.001, max_value=1, required=False)
+
+    def validate_seconds(self, seconds):
+        if seconds > settings.CHAT_PROFILER_MAX_SECONDS:
+            raise serializers.ValidationError(f'Profiles are limited to {settings.CHAT_PROFILER_MAX_SECONDS} seconds.')
+        return seconds
@@ -0,0 +1,76 @@
+from django.conf import settings
+from django.db.backends.signals import connection_created
+from django.db.models.signals import m2m_changed, post_delete, post_save
+from django.dispatch import receiver
+from . import membership, metrics, middlewares, rooms, unread
+from .models import ChatRoom
+
+
+@receiver(m2m_changed, sender=ChatRoom.members.through)
+def invalidate_memberships(sender, instance, action, reverse, pk_set, **kwargs):
+    if not reverse:
+        # room.members.add(...) / remove(...) / clear()
+        if action in ('post_add', 'post_remove', 'post_clear'):
+            membership.invalidate_on_commit(instance.pk, pk_set)
+        if action == 'post_add':
+            unread.members_added(instance.pk, pk_set)
+    elif action in ('post_add', 'post_remove'):
+        # user.chatrooms.add(...) / remove(...)
+        for room_pk in pk_set:
+            membership.invalidate_on_commit(room_pk, [instance.pk])
+            if action == 'post_add':
+                unread.members_added(room_pk, [instance.pk])
+    elif action == 'pre_clear':
+        # user.chatrooms.clear(): the rooms are only known before they are cleared
+        for room_pk in instance.chatrooms.values_list('pk', flat=True):
+            membership.invalidate_on_commit(room_pk, [instance.pk])
+
+
+@receiver(post_save, sender=ChatRoom)
+def invalidate_saved_room(sender, instance, created, **kwargs):
+    if not created:
+        rooms.invalidate(instance.room_id)
+
+
+@receiver(post_delete, sender=ChatRoom)
+def invalidate_deleted_room(sender, instance, **kwargs):
+    rooms.invalidate(instance.room_id)
+    membership.invalidate_on_commit(instance.pk)
+    unread.room_deleted(instance.pk)
+
+
+@receiver(post_save, sender=settings.AUTH_USER_MODEL)
+@receiver(post_delete, sender=settings.AUTH_USER_MODEL)
+def invalidate_cached_user(sender, instance, **kwargs):
+    # Deactivated or deleted users must not keep authenticating new sockets
+    middlewares.invalidate_user(instance.pk)
+
+
+# Stored in the database file rather than the connection, so set once per
+# database per process instead of on every connect
+PERSISTENT_PRAGMAS = {'journal_mode'}
+_persistent_pragmas_set = set()
+
+
+@receiver(connection_created)
+def configure_sqlite(sender, connection, **kwargs):
+    '''Apply settings.SQLITE_PRAGMAS to each new SQLite connection'''
+    if connection.vendor != 'sqlite':
+        return
+    with connection.cursor() as cursor:
+        for pragma, value in settings.SQLITE_PRAGMAS.items():
+            if value in (None, ''):
+                continue
+            if pragma in PERSISTENT_PRAGMAS:
+                key = (connection.settings_dict['NAME'], pragma, value)
+                if key in _persistent_pragmas_set:
+                    continue
+                _persistent_pragmas_set.add(key)
+            cursor.execute(f'PRAGMA {pragma} = {value}')
+
+
+@receiver(connection_created)
+def count_queries(sender, connection, **kwargs):
+    # Only counts inside instrumented requests, so skip the wrapper when metrics are off
+    if settings.CHAT_METRICS:
+        metrics.instrument(connection)
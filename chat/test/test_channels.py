@@ -1,9 +1,418 @@
-from rest_framework.test import APITestCase
-from channels.testing import HttpCommunicator, WebsocketCommunicator
-from chat.consumers import ChatConsumer
-from chat.models import ChatRoom
+from django.contrib.auth import get_user_model
+from django.test import TransactionTestCase, override_settings
+from django.urls import reverse
+from asgiref.sync import sync_to_async
+from channels.layers import get_channel_layer
+from channels.routing import URLRouter
+from channels.testing import WebsocketCommunicator
+from rest_framework.test import APIClient
+from rest_framework_simplejwt.tokens import AccessToken
+import asyncio
+import json
+from unittest import mock
+import msgpack
+from chat.middlewares import JWTAuthMiddleware, connect_stats
+from chat.models import ChatRoom, Message
+from chat.test.utils import ChatCacheMixin
+from chat.routing import websocket_urlpatterns
+from chat import presence, rooms
+from chat.events import publish, typing_event
+from chat.ephemeral import Coalescer
 
 
+application = JWTAuthMiddleware(URLRouter(websocket_urlpatterns))
 
-class MyTests(APITestCase):
-    pass
\ No newline at end of file
+
+class ChatConsumerTests(ChatCacheMixin, TransactionTestCase):
+    def setUp(self):
+        self.user1 = get_user_model().objects.create_user(username='testuser', password='testuser')
+        self.user2 = get_user_model().objects.create_user(username='testuser2', password='testuser')
+        self.chatroom = ChatRoom.objects.create(room_name='testroom', creator=self.user1)
+        self.chatroom.members.add(self.user1)
+
+    def communicator(self, user):
+        token = AccessToken.for_user(user)
+        return WebsocketCommunicator(application, f'chat/{self.chatroom.room_id}/?token={token}')
+
+    async def test_member_can_connect(self):
+        communicator = self.communicator(self.user1)
+        connected, _ = await communicator.connect()
+        self.assertTrue(connected)
+        await communicator.disconnect()
+
+    async def test_non_member_is_rejected(self):
+        communicator = self.communicator(self.user2)
+        connected, _ = await communicator.connect()
+        self.assertFalse(connected)
+
+    async def test_send_message_over_socket(self):
+        communicator = self.communicator(self.user1)
+        await communicator.connect()
+        await communicator.send_json_to({'type': 'message', 'content': 'Hello Room', 'client_id': 'abc'})
+
+        # The sender gets the room broadcast as well as the ack
+        frames = [await communicator.receive_json_from() for _ in range(2)]
+        ack = next(frame for frame in frames if frame.get('type') == 'ack')
+        broadcast = next(frame for frame in frames if 'message' in frame)
+        self.assertEqual(ack['client_id'], 'abc')
+        self.assertEqual(broadcast['message']['message_id'], ack['message_id'])
+
+        message = await Message.objects.aget(message_id=ack['message_id'])
+        self.assertEqual(message.content, 'Hello Room')
+        await communicator.disconnect()
+
+    async def test_connection_send_limit(self):
+        communicator = self.communicator(self.user1)
+        await communicator.connect()
+        with self.settings(CHAT_SEND_RATE_PER_CONNECTION=0.01, CHAT_SEND_BURST_PER_CONNECTION=1):
+            await communicator.send_json_to({'type': 'message', 'content': 'one', 'client_id': 'a'})
+            frames = [await communicator.receive_json_from() for _ in range(2)]
+            self.assertIn('ack', [frame.get('type') for frame in frames])
+
+            await communicator.send_json_to({'type': 'message', 'content': 'two', 'client_id': 'b'})
+            response = await communicator.receive_json_from()
+        self.assertEqual(response['type'], 'error')
+        self.assertEqual(response['client_id'], 'b')
+        self.assertGreater(response['errors']['retry_after'], 0)
+        self.assertEqual(await Message.objects.acount(), 1)
+        await communicator.disconnect()
+
+    async def test_invalid_message_returns_error(self):
+        communicator = self.communicator(self.user1)
+        await communicator.connect()
+        await communicator.send_json_to({'type': 'message'})
+        response = await communicator.receive_json_from()
+        self.assertEqual(response['type'], 'error')
+        self.assertIn('content', response['errors'])
+        self.assertEqual(await Message.objects.acount(), 0)
+        await communicator.disconnect()
+
+
+class JWTAuthMiddlewareTests(ChatCacheMixin, TransactionTestCase):
+    def setUp(self):
+        self.user = get_user_model().objects.create_user(username='testuser', password='testuser')
+        self.chatroom = ChatRoom.objects.create(room_name='testroom', creator=self.user)
+        self.chatroom.members.add(self.user)
+        self.path = f'chat/{self.chatroom.room_id}/?token={AccessToken.for_user(self.user)}'
+        connect_stats.reset()
+
+    async def test_reconnect_uses_cached_user(self):
+        for _ in range(3):
+            communicator = WebsocketCommunicator(application, self.path)
+            connected, _ = await communicator.connect()
+            self.assertTrue(connected)
+            await communicator.disconnect()
+        stats = connect_stats.snapshot()
+        self.assertEqual(stats['cache_misses'], 1)
+        self.assertEqual(stats['cache_hits'], 2)
+
+    async def test_deactivated_user_is_rejected(self):
+        communicator = WebsocketCommunicator(application, self.path)
+        await communicator.connect()
+        await communicator.disconnect()
+
+        self.user.is_active = False
+        await self.user.asave()
+
+        communicator = WebsocketCommunicator(application, self.path)
+        connected, _ = await communicator.connect()
+        self.assertFalse(connected)
+
+    async def test_missing_token_is_anonymous(self):
+        communicator = WebsocketCommunicator(application, f'chat/{self.chatroom.room_id}/')
+        connected, _ = await communicator.connect()
+        self.assertFalse(connected)
+
+
+class RoomGroupTests(ChatCacheMixin, TransactionTestCase):
+    def setUp(self):
+        self.user = get_user_model().objects.create_user(username='testuser', password='testuser')
+        self.token = AccessToken.for_user(self.user)
+        # Same name, different rooms
+        self.room1 = ChatRoom.objects.create(room_name='general', creator=self.user)
+        self.room2 = ChatRoom.objects.create(room_name='general', creator=self.user)
+        self.room1.members.add(self.user)
+        self.room2.members.add(self.user)
+
+    async def test_rooms_with_the_same_name_do_not_share_traffic(self):
+        listener = WebsocketCommunicator(application, f'chat/{self.room2.room_id}/?token={self.token}')
+        await listener.connect()
+        sender = WebsocketCommunicator(application, f'chat/{self.room1.room_id}/?token={self.token}')
+        await sender.connect()
+
+        await sender.send_json_to({'type': 'message', 'content': 'only for room 1'})
+        await sender.receive_json_from()
+        await sender.receive_json_from()
+        self.assertTrue(await listener.receive_nothing())
+
+        await sender.disconnect()
+        await listener.disconnect()
+
+    @override_settings(CHAT_LEGACY_GROUP_NAMES=True)
+    async def test_legacy_group_gets_the_previous_release_events(self):
+        channel_layer = get_channel_layer()
+        legacy = await channel_layer.new_channel()
+        await channel_layer.group_add(rooms.legacy_group_name(self.room1), legacy)
+        current = await channel_layer.new_channel()
+        await channel_layer.group_add(rooms.group_name(self.room1.room_id), current)
+        user = await get_user_model().objects.aget(pk=self.user.pk)
+
+        await publish(self.room1, typing_event(user, 'start', 'elsewhere'))
+        sender = WebsocketCommunicator(application, f'chat/{self.room1.room_id}/?token={self.token}')
+        await sender.connect()
+        await sender.send_json_to({'type': 'message', 'content': 'hello'})
+        await sender.receive_json_from()
+        await sender.receive_json_from()
+        await sender.disconnect()
+
+        # The previous release's consumer: one handler per event type, each
+        # JSON-encoding what it is given. Typing events are not sent to it.
+        event = await channel_layer.receive(legacy)
+        self.assertEqual(event['type'], 'chat_message')
+        self.assertEqual(set(event), {'type', 'message', 'message_id', 'user', 'room_name'})
+        json.dumps({'message': event})
+        self.assertEqual((await channel_layer.receive(current))['type'], 'chat_typing')
+        self.assertIn('frames', await channel_layer.receive(current))
+        with self.assertRaises(asyncio.TimeoutError):
+            await asyncio.wait_for(channel_layer.receive(legacy), 0.1)
+
+    async def test_invalid_room_id_is_rejected(self):
+        communicator = WebsocketCommunicator(application, f'chat/not-a-room/?token={self.token}')
+        connected, _ = await communicator.connect()
+        self.assertFalse(connected)
+
+
+class MsgpackProtocolTests(ChatCacheMixin, TransactionTestCase):
+    def setUp(self):
+        self.user = get_user_model().objects.create_user(username='testuser', password='testuser')
+        self.chatroom = ChatRoom.objects.create(room_name='testroom', creator=self.user)
+        self.chatroom.members.add(self.user)
+        self.path = f'chat/{self.chatroom.room_id}/?token={AccessToken.for_user(self.user)}'
+
+    async def test_msgpack_subprotocol_is_negotiated(self):
+        communicator = WebsocketCommunicator(application, self.path, subprotocols=['chat.msgpack.v1'])
+        connected, subprotocol = await communicator.connect()
+        self.assertTrue(connected)
+        self.assertEqual(subprotocol, 'chat.msgpack.v1')
+
+        await communicator.send_to(bytes_data=msgpack.packb({'t': 'message', 'c': 'Hello Room', 'cid': 'abc'}))
+        frames = [msgpack.unpackb(await communicator.receive_from()) for _ in range(2)]
+        ack = next(frame for frame in frames if frame['t'] == 'ack')
+        message = next(frame for frame in frames if frame['t'] == 'message')
+        self.assertEqual(ack['cid'], 'abc')
+        self.assertEqual(message, {'v': 1, 't': 'message', 'id': ack['id'], 'u': 'testuser', 'c': 'Hello Room', 'ts': ack['ts']})
+        await communicator.disconnect()
+
+    async def test_json_remains_the_default(self):
+        communicator = WebsocketCommunicator(application, self.path)
+        connected, subprotocol = await communicator.connect()
+        self.assertTrue(connected)
+        self.assertIsNone(subprotocol)
+        await communicator.send_to(bytes_data=b'binary')
+        response = await communicator.receive_json_from()
+        self.assertEqual(response['type'], 'error')
+        await communicator.disconnect()
+
+
+class PreEncodedBroadcastTests(ChatCacheMixin, TransactionTestCase):
+    def setUp(self):
+        self.user = get_user_model().objects.create_user(username='testuser', password='testuser')
+        self.chatroom = ChatRoom.objects.create(room_name='testroom', creator=self.user)
+        self.chatroom.members.add(self.user)
+        self.path = f'chat/{self.chatroom.room_id}/?token={AccessToken.for_user(self.user)}'
+
+    async def test_consumers_forward_pre_encoded_frames(self):
+        json_client = WebsocketCommunicator(application, self.path)
+        msgpack_client = WebsocketCommunicator(application, self.path, subprotocols=['chat.msgpack.v1'])
+        await json_client.connect()
+        await msgpack_client.connect()
+
+        channel_layer = get_channel_layer()
+        await channel_layer.group_send(rooms.group_name(self.chatroom.room_id), {
+            'type': 'chat_message',
+            'frames': {'chat.json': {'text_data': 'pre-encoded'}, 'chat.msgpack.v1': {'bytes_data': b'pre-encoded'}},
+        })
+        self.assertEqual(await json_client.receive_from(), 'pre-encoded')
+        self.assertEqual(await msgpack_client.receive_from(), b'pre-encoded')
+        await json_client.disconnect()
+        await msgpack_client.disconnect()
+
+    async def test_published_frames_match_per_consumer_encoding(self):
+        communicator = WebsocketCommunicator(application, self.path)
+        await communicator.connect()
+        await communicator.send_json_to({'type': 'message', 'content': 'Hello Room'})
+        frames = [await communicator.receive_json_from() for _ in range(2)]
+        broadcast = next(frame for frame in frames if 'message' in frame)
+        self.assertEqual(broadcast['message']['type'], 'chat_message')
+        self.assertNotIn('frames', broadcast['message'])
+        await communicator.disconnect()
+
+
+class PresenceTests(ChatCacheMixin, TransactionTestCase):
+    def setUp(self):
+        self.user1 = get_user_model().objects.create_user(username='testuser', password='testuser')
+        self.user2 = get_user_model().objects.create_user(username='testuser2', password='testuser')
+        self.chatroom = ChatRoom.objects.create(room_name='testroom', creator=self.user1)
+        self.chatroom.members.add(self.user1, self.user2)
+        self.client = APIClient()
+        self.client.force_authenticate(self.user1)
+        self.url = reverse('chatroom-presence', kwargs={'room_id': str(self.chatroom.room_id)})
+
+    def communicator(self, user):
+        return WebsocketCommunicator(application, f'chat/{self.chatroom.room_id}/?token={AccessToken.for_user(user)}')
+
+    async def test_online_users_endpoint(self):
+        first_tab, second_tab = self.communicator(self.user1), self.communicator(self.user1)
+        other = self.communicator(self.user2)
+        for communicator in (first_tab, second_tab, other):
+            await communicator.connect()
+
+        response = await sync_to_async(self.client.get)(self.url, {'limit': 1})
+        self.assertEqual(response.data['count'], 2)
+        self.assertEqual(len(response.data['results']), 1)
+        self.assertIsNotNone(response.data['next'])
+
+        # Closing one of two tabs keeps the user online
+        await second_tab.disconnect()
+        await other.disconnect()
+        response = await sync_to_async(self.client.get)(self.url)
+        self.assertEqual([user['username'] for user in response.data['results']], ['testuser'])
+        await first_tab.disconnect()
+
+    async def test_joins_and_leaves_are_coalesced(self):
+        listener = self.communicator(self.user1)
+        await listener.connect()
+        presence.notifier.take()
+
+        visitor = self.communicator(self.user2)
+        await visitor.connect()
+        await visitor.disconnect()
+        late = self.communicator(self.user2)
+        await late.connect()
+        self.assertTrue(await listener.receive_nothing())
+
+        await presence.notifier.flush()
+        diff = await listener.receive_json_from()
+        self.assertEqual(diff, {'type': 'presence_diff', 'joined': ['testuser2'], 'left': [], 'online': 2})
+        await late.disconnect()
+        await listener.disconnect()
+
+    def test_flush_is_rescheduled_after_its_loop_closes(self):
+        notifier = presence.PresenceNotifier(interval=60)
+        notifier.joined(self.chatroom, 'testuser')
+        asyncio.run(notifier.flush_soon())
+        self.assertTrue(notifier.scheduled.is_closed())
+
+        async def schedule():
+            await notifier.flush_soon()
+            return asyncio.get_running_loop()
+        self.assertIs(asyncio.run(schedule()), notifier.scheduled)
+
+    def test_scheduled_flush_is_held_until_done(self):
+        notifier = presence.PresenceNotifier(interval=0.05)
+        notifier.joined(self.chatroom, 'testuser')
+
+        async def schedule():
+            published = asyncio.Event()
+
+            async def publish(room, event):
+                await published.wait()
+            with mock.patch.object(presence, 'publish', publish):
+                await notifier.flush_soon()
+                await asyncio.sleep(0.06)
+                held = set(notifier.tasks)
+                published.set()
+                await asyncio.gather(*held)
+            return held
+        self.assertEqual(len(asyncio.run(schedule())), 1)
+        self.assertEqual(notifier.tasks, set())
+
+    def test_stale_presence_expires(self):
+        store = presence.LocalPresenceStore()
+        store.join(self.chatroom.pk, self.user1.pk)
+        with self.settings(CHAT_PRESENCE_TTL=-1):
+            self.assertEqual(store.count(self.chatroom.pk), 0)
+
+
+class EphemeralEventTests(ChatCacheMixin, TransactionTestCase):
+    def setUp(self):
+        self.user1 = get_user_model().objects.create_user(username='testuser', password='testuser')
+        self.user2 = get_user_model().objects.create_user(username='testuser2', password='testuser')
+        self.chatroom = ChatRoom.objects.create(room_name='testroom', creator=self.user1)
+        self.chatroom.members.add(self.user1, self.user2)
+
+    def communicator(self, user):
+        return WebsocketCommunicator(application, f'chat/{self.chatroom.room_id}/?token={AccessToken.for_user(user)}')
+
+    async def connect_both(self):
+        typist, listener = self.communicator(self.user1), self.communicator(self.user2)
+        await typist.connect()
+        await listener.connect()
+        return typist, listener
+
+    async def test_typing_is_relayed_but_not_echoed(self):
+        typist, listener = await self.connect_both()
+        await typist.send_json_to({'type': 'typing', 'state': 'start'})
+        self.assertEqual(await listener.receive_json_from(), {'type': 'typing', 'user': 'testuser', 'state': 'start'})
+        self.assertTrue(await typist.receive_nothing())
+        await typist.disconnect()
+        await listener.disconnect()
+
+    async def test_typing_is_coalesced_within_window(self):
+        with mock.patch('chat.consumers.coalescer', Coalescer(0.2)):
+            typist, listener = await self.connect_both()
+            for state in ('start', 'start', 'stop', 'start', 'stop'):
+                await typist.send_json_to({'type': 'typing', 'state': state})
+            self.assertEqual((await listener.receive_json_from())['state'], 'start')
+            self.assertTrue(await listener.receive_nothing(timeout=0.05))
+
+            # Only the latest change goes out, once the window is over
+            await asyncio.sleep(0.2)
+            self.assertEqual((await listener.receive_json_from())['state'], 'stop')
+            self.assertTrue(await listener.receive_nothing(timeout=0.3))
+            await typist.disconnect()
+            await listener.disconnect()
+
+    async def test_held_back_send_is_kept_until_done(self):
+        coalescer, sent, released = Coalescer(0.05), [], asyncio.Event()
+
+        async def send(value):
+            sent.append(value)
+            await released.wait()
+        released.set()
+        await coalescer.submit('key', 'start', send)
+        released.clear()
+        await coalescer.submit('key', 'stop', send)
+        await asyncio.sleep(0.06)
+        self.assertEqual(len(coalescer.tasks), 1)
+        released.set()
+        await asyncio.gather(*coalescer.tasks)
+        self.assertEqual(sent, ['start', 'stop'])
+        self.assertEqual(coalescer.tasks, set())
+
+    async def test_read_cursor_is_relayed_and_not_stored(self):
+        message = await Message.objects.acreate(content='hi', sender=self.user2, room=self.chatroom)
+        typist, listener = await self.connect_both()
+        await typist.send_json_to({'type': 'read', 'message_id': str(message.message_id)})
+        frame = await listener.receive_json_from()
+        self.assertEqual(frame, {'type': 'read', 'user': 'testuser', 'message_id': str(message.message_id)})
+        self.assertEqual(await Message.objects.acount(), 1)
+
+        await typist.send_json_to({'type': 'read', 'message_id': 'not-a-message'})
+        self.assertEqual((await typist.receive_json_from())['type'], 'error')
+        await typist.disconnect()
+        await listener.disconnect()
+
+    async def test_msgpack_typing_frames(self):
+        typist = self.communicator(self.user1)
+        listener = WebsocketCommunicator(
+            application, f'chat/{self.chatroom.room_id}/?token={AccessToken.for_user(self.user2)}',
+            subprotocols=['chat.msgpack.v1'],
+        )
+        await typist.connect()
+        await listener.connect()
+        await typist.send_json_to({'type': 'typing'})
+        frame = msgpack.unpackb(await listener.receive_from())
+        self.assertEqual(frame, {'t': 'typing', 'u': 'testuser', 's': 'start', 'v': 1})
+        await typist.disconnect()
+        await listener.disconnect()
@@ -0,0 +1,27 @@
+from django.db import connection, connections
+from django.test import TestCase
+
+
+class SQLitePragmaTests(TestCase):
+    def pragma(self, name):
+        with connection.cursor() as cursor:
+            cursor.execute(f'PRAGMA {name}')
+            return cursor.fetchone()[0]
+
+    def test_connections_are_tuned(self):
+        self.assertEqual(self.pragma('journal_mode'), 'wal')
+        # NORMAL
+        self.assertEqual(self.pragma('synchronous'), 1)
+        self.assertEqual(self.pragma('busy_timeout'), 5000)
+        self.assertEqual(self.pragma('cache_size'), -20000)
+
+    def test_journal_mode_is_not_set_on_every_connect(self):
+        self.pragma('journal_mode')
+        reconnected = connections.create_connection('default')
+        reconnected.force_debug_cursor = True
+        reconnected.ensure_connection()
+        self.addCleanup(reconnected.close)
+        pragmas = [query['sql'] for query in reconnected.queries]
+        self.assertIn('PRAGMA busy_timeout = 5000', pragmas)
+        self.assertFalse([sql for sql in pragmas if 'journal_mode' in sql])
+        self.assertEqual(self.pragma('journal_mode'), 'wal')
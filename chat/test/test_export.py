@@ -0,0 +1,73 @@
+import csv
+import io
+import json
+from asgiref.sync import async_to_sync
+from django.contrib.auth import get_user_model
+from django.core.management import call_command
+from django.urls import reverse
+from rest_framework import status
+from rest_framework.test import APITestCase
+from chat.export import export_lines
+from chat.models import ChatRoom, Message
+from chat.test.utils import ChatCacheMixin, QueryBudgetMixin
+
+
+class RoomExportTests(ChatCacheMixin, QueryBudgetMixin, APITestCase):
+    def setUp(self):
+        self.user1 = get_user_model().objects.create_user(username='testuser', password='testuser')
+        self.user2 = get_user_model().objects.create_user(username='testuser2', password='testuser')
+        self.chatroom = ChatRoom.objects.create(room_name='testroom', creator=self.user1)
+        self.chatroom.members.add(self.user1)
+        self.messages = [
+            Message.objects.create(content=f'message, "{i}"', sender=self.user1, room=self.chatroom)
+            for i in range(5)
+        ]
+        self.url = reverse('chatroom-export', kwargs={'room_id': str(self.chatroom.room_id)})
+
+    def content(self, response):
+        '''The body of a streamed response, read the way the ASGI handler reads it'''
+        async def collect():
+            return b''.join([chunk async for chunk in response.streaming_content])
+        return async_to_sync(collect)().decode()
+
+    def get(self, user, **params):
+        self.client.force_authenticate(user)
+        return self.client.get(self.url, params)
+
+    def test_ndjson_export(self):
+        with self.settings(CHAT_EXPORT_BATCH_SIZE=2):
+            response = self.get(self.user1)
+            self.assertEqual(response['Content-Type'], 'application/x-ndjson')
+            rows = [json.loads(line) for line in self.content(response).splitlines()]
+        self.assertEqual([row['message_id'] for row in rows], [str(m.message_id) for m in self.messages])
+        self.assertEqual(rows[0], {
+            'message_id': str(self.messages[0].message_id),
+            'sender': 'testuser',
+            'content': 'message, "0"',
+            'date_sent': self.messages[0].date_sent.isoformat(),
+        })
+
+    def test_csv_export(self):
+        response = self.get(self.user1, output='csv')
+        self.assertIn('attachment', response['Content-Disposition'])
+        rows = list(csv.reader(io.StringIO(self.content(response))))
+        self.assertEqual(rows[0], ['message_id', 'sender', 'content', 'date_sent'])
+        self.assertEqual(len(rows), 6)
+        self.assertEqual(rows[1][2], 'message, "0"')
+
+    def test_unknown_format(self):
+        self.assertEqual(self.get(self.user1, output='xml').status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_only_members_can_export(self):
+        self.assertEqual(self.get(self.user2).status_code, status.HTTP_403_FORBIDDEN)
+
+    def test_one_query_per_batch(self):
+        # Five messages in batches of two: three full or partial batches and one empty one
+        with self.assertQueryBudget(4):
+            lines = list(export_lines(self.chatroom, 'ndjson', batch_size=2))
+        self.assertEqual(len(lines), 5)
+
+    def test_export_room_command(self):
+        out = io.StringIO()
+        call_command('export_room', str(self.chatroom.room_id), '--format', 'csv', '--batch-size', '3', stdout=out)
+        self.assertEqual(len(list(csv.reader(io.StringIO(out.getvalue())))), 6)
@@ -0,0 +1,113 @@
+import asyncio
+import json
+from unittest import mock
+from django.contrib.auth import get_user_model
+from django.test import TransactionTestCase, override_settings
+from channels.layers import get_channel_layer
+from channels.testing import HttpCommunicator
+from rest_framework.test import APIClient
+from rest_framework_simplejwt.tokens import AccessToken
+from chat import metrics, rooms
+from chat.fanout import Publisher, publisher
+from chat.models import ChatRoom, Message
+from chat.test.utils import ChatCacheMixin
+
+
+class PublisherTests(ChatCacheMixin, TransactionTestCase):
+    def setUp(self):
+        self.user = get_user_model().objects.create_user(username='testuser', password='testuser')
+        self.rooms = [ChatRoom.objects.create(room_name=f'room{i}', creator=self.user) for i in range(2)]
+        self.publisher = Publisher(maxsize=100, batch_size=10, retries=2, retry_delay=0.001)
+
+    async def subscribe(self, room):
+        channel_layer = get_channel_layer()
+        channel = await channel_layer.new_channel()
+        await channel_layer.group_add(rooms.group_name(room.room_id), channel)
+        return channel
+
+    def event(self, n):
+        return {'type': 'test_event', 'content': str(n)}
+
+    async def test_batches_keep_order_per_room(self):
+        channels = [await self.subscribe(room) for room in self.rooms]
+        for n in range(25):
+            await self.publisher.submit(self.rooms[n % 2], self.event(n))
+        await self.publisher.drain()
+
+        channel_layer = get_channel_layer()
+        for offset, channel in enumerate(channels):
+            received = [(await channel_layer.receive(channel))['content'] for _ in range(offset, 25, 2)]
+            self.assertEqual(received, [str(n) for n in range(offset, 25, 2)])
+
+    async def test_transient_failures_are_retried(self):
+        send_group = mock.AsyncMock(side_effect=[ConnectionError(), None])
+        with mock.patch('chat.fanout.send_group', send_group):
+            await self.publisher.submit(self.rooms[0], self.event(1))
+            await self.publisher.drain()
+        self.assertEqual(send_group.await_count, 2)
+        self.assertEqual(metrics.FANOUT_FAILURES.value('retried'), 1)
+        self.assertEqual(metrics.FANOUT_FAILURES.value('dropped'), 0)
+
+    async def test_gives_up_and_carries_on(self):
+        send_group = mock.AsyncMock(side_effect=[ConnectionError()] * 3 + [None])
+        with mock.patch('chat.fanout.send_group', send_group), self.assertLogs('chat.fanout', 'ERROR'):
+            await self.publisher.submit(self.rooms[0], self.event(1))
+            await self.publisher.submit(self.rooms[0], self.event(2))
+            await self.publisher.drain()
+        self.assertEqual(send_group.await_count, 4)
+        self.assertEqual(send_group.await_args.args[2]['content'], '2')
+        self.assertEqual(metrics.FANOUT_FAILURES.value('dropped'), 1)
+
+
+@override_settings(CHAT_FANOUT_ASYNC=True)
+class FireAndForgetTests(ChatCacheMixin, TransactionTestCase):
+    def setUp(self):
+        self.user = get_user_model().objects.create_user(username='testuser', password='testuser')
+        self.chatroom = ChatRoom.objects.create(room_name='testroom', creator=self.user)
+        self.chatroom.members.add(self.user)
+
+    async def post(self, content):
+        from chatAPI.asgi import application
+        body = json.dumps({'content': content}).encode()
+        communicator = HttpCommunicator(
+            application, 'POST', f'/api/v1/chatroom/{self.chatroom.room_id}/chat/', body=body,
+            headers=[
+                (b'host', b'testserver'),
+                (b'content-type', b'application/json'),
+                (b'content-length', str(len(body)).encode()),
+                (b'authorization', f'Bearer {AccessToken.for_user(self.user)}'.encode()),
+            ],
+        )
+        return await communicator.get_response(timeout=5)
+
+    def test_response_does_not_wait_for_the_broadcast(self):
+        # Async test methods run on a loop async_to_sync starts for them, so run
+        # this one on a loop that outlives the request, as a server's does
+        asyncio.run(self.check_response_does_not_wait())
+
+    async def check_response_does_not_wait(self):
+        released = asyncio.Event()
+
+        async def stalled(channel_layer, group, event):
+            await released.wait()
+
+        send_group = mock.AsyncMock(side_effect=stalled)
+        with mock.patch('chat.fanout.send_group', send_group):
+            response = await self.post('hello')
+            self.assertEqual(response['status'], 201)
+            self.assertEqual(await Message.objects.acount(), 1)
+
+            released.set()
+            await publisher.drain()
+        _, group, event = send_group.await_args.args
+        self.assertEqual(group, rooms.group_name(self.chatroom.room_id))
+        self.assertEqual(event['content'], 'hello')
+
+    def test_short_lived_loops_publish_before_responding(self):
+        client = APIClient()
+        client.force_authenticate(self.user)
+        with mock.patch('chat.fanout.publish') as publish:
+            response = client.post(f'/api/v1/chatroom/{self.chatroom.room_id}/chat/', {'content': 'hello'}, format='json')
+        self.assertEqual(response.status_code, 201)
+        publish.assert_awaited_once()
+        self.assertIsNone(publisher.queue)
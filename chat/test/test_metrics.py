@@ -0,0 +1,125 @@
+from django.contrib.auth import get_user_model
+from django.db import connection, connections
+from django.test import SimpleTestCase, TransactionTestCase, modify_settings, override_settings
+from django.urls import reverse
+from channels.routing import URLRouter
+from channels.testing import WebsocketCommunicator
+from rest_framework.test import APITestCase
+from rest_framework import status
+from rest_framework_simplejwt.tokens import AccessToken
+from chat import metrics
+from chat.middlewares import JWTAuthMiddleware
+from chat.models import ChatRoom
+from chat.routing import websocket_urlpatterns
+from chat.test.utils import ChatCacheMixin
+
+
+class HistogramTests(SimpleTestCase):
+    def test_render_is_cumulative(self):
+        histogram = metrics.Histogram('test_seconds', 'Test.', ['route'], buckets=(0.1, 1))
+        for value in (0.05, 0.5, 0.5, 3):
+            histogram.observe(value, 'a"b')
+        self.assertEqual(histogram.render(), [
+            '# HELP test_seconds Test.',
+            '# TYPE test_seconds histogram',
+            'test_seconds_bucket{route="a\\"b",le="0.1"} 1',
+            'test_seconds_bucket{route="a\\"b",le="1.0"} 3',
+            'test_seconds_bucket{route="a\\"b",le="+Inf"} 4',
+            'test_seconds_sum{route="a\\"b"} 4.05',
+            'test_seconds_count{route="a\\"b"} 4',
+        ])
+
+
+@override_settings(CHAT_METRICS=True, CHAT_METRICS_TOKEN='')
+@modify_settings(MIDDLEWARE={'prepend': 'chat.metrics.MetricsMiddleware'})
+class MetricsMiddlewareTests(ChatCacheMixin, APITestCase):
+    def setUp(self):
+        self.user = get_user_model().objects.create_user(username='testuser', password='testuser')
+        self.chatroom = ChatRoom.objects.create(room_name='testroom', creator=self.user)
+        self.chatroom.members.add(self.user)
+        self.client.force_authenticate(self.user)
+        # The test connection was opened before CHAT_METRICS was turned on
+        metrics.instrument(connection)
+        self.addCleanup(connection.execute_wrappers.remove, metrics.count_queries)
+
+    def test_request_latency_and_queries_by_route(self):
+        url = reverse('chatroom-chat', kwargs={'room_id': str(self.chatroom.room_id)})
+        for content in ('one', 'two'):
+            response = self.client.post(url, {'content': content}, format='json')
+            self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+
+        self.assertEqual(metrics.REQUEST_SECONDS.count('chatroom-chat', 'POST', '201'), 2)
+        self.assertEqual(metrics.DB_QUERIES.count('chatroom-chat', 'POST'), 2)
+        self.assertGreater(metrics.DB_QUERIES.sum('chatroom-chat', 'POST'), 0)
+        self.assertEqual(metrics.GROUP_SEND_SECONDS.count(), 2)
+
+    def test_metrics_endpoint(self):
+        self.client.get(reverse('chatroom-messages', kwargs={'room_id': str(self.chatroom.room_id)}))
+        staff = get_user_model().objects.create_user(username='staff', password='staff', is_staff=True)
+        self.client.force_login(staff)
+        response = self.client.get(reverse('metrics'))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertTrue(response['Content-Type'].startswith('text/plain; version=0.0.4'))
+        body = response.content.decode()
+        self.assertIn('chat_http_request_duration_seconds_count{route="chatroom-messages",method="GET",status="200"} 1', body)
+        self.assertIn('chat_db_queries_count{route="chatroom-messages",operation="GET"} 1', body)
+        self.assertIn('chat_ws_auth_connects_total', body)
+
+    def test_metrics_token(self):
+        with self.settings(CHAT_METRICS_TOKEN='secret'):
+            self.assertEqual(self.client.get(reverse('metrics')).status_code, status.HTTP_401_UNAUTHORIZED)
+            response = self.client.get(reverse('metrics'), HTTP_AUTHORIZATION='Bearer secret')
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+    def test_metrics_need_staff_without_token(self):
+        self.assertEqual(self.client.get(reverse('metrics')).status_code, status.HTTP_403_FORBIDDEN)
+        self.client.force_login(self.user)
+        self.assertEqual(self.client.get(reverse('metrics')).status_code, status.HTTP_403_FORBIDDEN)
+
+    def test_metrics_off(self):
+        with self.settings(CHAT_METRICS=False):
+            self.assertEqual(self.client.get(reverse('metrics')).status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_connections_are_not_instrumented_when_off(self):
+        with self.settings(CHAT_METRICS=False):
+            unmetered = connections.create_connection('default')
+            unmetered.ensure_connection()
+            self.addCleanup(unmetered.close)
+        self.assertNotIn(metrics.count_queries, unmetered.execute_wrappers)
+
+
+@override_settings(CHAT_METRICS=True)
+class WebSocketMetricsTests(ChatCacheMixin, TransactionTestCase):
+    def setUp(self):
+        self.user = get_user_model().objects.create_user(username='testuser', password='testuser')
+        self.chatroom = ChatRoom.objects.create(room_name='testroom', creator=self.user)
+        self.chatroom.members.add(self.user)
+        self.application = metrics.WebSocketMetrics(
+            JWTAuthMiddleware(URLRouter(websocket_urlpatterns)), websocket_urlpatterns,
+        )
+        self.route = str(websocket_urlpatterns[0].pattern)
+
+    def communicator(self, user):
+        token = AccessToken.for_user(user)
+        return WebsocketCommunicator(self.application, f'chat/{self.chatroom.room_id}/?token={token}')
+
+    async def test_connect_and_frames(self):
+        communicator = self.communicator(self.user)
+        connected, _ = await communicator.connect()
+        self.assertTrue(connected)
+        await communicator.send_json_to({'type': 'message', 'content': 'Hello Room', 'client_id': 'abc'})
+        frames = [await communicator.receive_json_from() for _ in range(2)]
+        self.assertIn('ack', [frame.get('type') for frame in frames])
+        await communicator.disconnect()
+
+        self.assertEqual(metrics.WS_CONNECT_SECONDS.count(self.route, 'accepted'), 1)
+        self.assertGreater(metrics.DB_QUERIES.sum(self.route, 'connect'), 0)
+        self.assertEqual(metrics.WS_FRAME_SECONDS.count(self.route), 1)
+        self.assertGreater(metrics.DB_QUERIES.sum(self.route, 'receive'), 0)
+        self.assertEqual(metrics.GROUP_SEND_SECONDS.count(), 1)
+
+    async def test_rejected_connect(self):
+        outsider = await get_user_model().objects.acreate(username='outsider')
+        connected, _ = await self.communicator(outsider).connect()
+        self.assertFalse(connected)
+        self.assertEqual(metrics.WS_CONNECT_SECONDS.count(self.route, 'rejected'), 1)
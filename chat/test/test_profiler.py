@@ -0,0 +1,93 @@
+import os
+import shutil
+import tempfile
+import threading
+from django.contrib.auth import get_user_model
+from django.test import SimpleTestCase
+from django.urls import reverse
+from rest_framework.test import APITestCase
+from rest_framework import status
+from chat.profiler import ProfilerBusy, profiler, thread_group
+from chat.test.utils import ChatCacheMixin
+
+
+def spin_until(event):
+    while not event.is_set():
+        sum(range(1000))
+
+
+class ProfilerTests(SimpleTestCase):
+    def setUp(self):
+        self.output_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.output_dir, ignore_errors=True)
+
+    def test_collapsed_stacks(self):
+        done = threading.Event()
+        worker = threading.Thread(target=spin_until, args=(done,), name='ThreadPoolExecutor-7_2')
+        worker.start()
+        try:
+            path = profiler.start(0.2, interval=0.005, output_dir=self.output_dir)
+            with self.assertRaises(ProfilerBusy):
+                profiler.start(0.2, output_dir=self.output_dir)
+            profiler.wait(5)
+        finally:
+            done.set()
+            worker.join()
+
+        self.assertEqual(profiler.last_path, path)
+        with open(path) as profile:
+            lines = profile.read().splitlines()
+        spinning = [line for line in lines if 'spin_until' in line]
+        self.assertTrue(spinning)
+        stack, count = spinning[0].rsplit(' ', 1)
+        self.assertTrue(stack.startswith('ThreadPoolExecutor-N_N;'))
+        self.assertIn('spin_until (chat/test/test_profiler.py:', stack)
+        self.assertGreater(int(count), 0)
+        # The sampler leaves itself out
+        self.assertFalse([line for line in lines if line.startswith('chat-profiler')])
+
+    def test_back_to_back_profiles_keep_their_own_files(self):
+        paths = []
+        for _ in range(2):
+            paths.append(profiler.start(0.01, interval=0.005, output_dir=self.output_dir))
+            profiler.wait(5)
+        self.assertNotEqual(paths[0], paths[1])
+        self.assertTrue(all(os.path.exists(path) for path in paths))
+
+    def test_thread_group(self):
+        self.assertEqual(thread_group('asyncio_12'), 'asyncio_N')
+        self.assertEqual(thread_group('MainThread'), 'MainThread')
+
+
+class ProfilerViewTests(ChatCacheMixin, APITestCase):
+    def setUp(self):
+        self.output_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.output_dir, ignore_errors=True)
+        self.staff = get_user_model().objects.create_user(username='staff', password='staff', is_staff=True)
+        self.user = get_user_model().objects.create_user(username='testuser', password='testuser')
+        self.url = reverse('profiler')
+
+    def test_staff_only(self):
+        with self.settings(CHAT_PROFILER=True):
+            self.client.force_authenticate(self.user)
+            self.assertEqual(self.client.post(self.url, {'seconds': 0.1}).status_code, status.HTTP_403_FORBIDDEN)
+
+    def test_disabled(self):
+        self.client.force_authenticate(self.staff)
+        self.assertEqual(self.client.post(self.url, {'seconds': 0.1}).status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_capture_and_fetch(self):
+        self.client.force_authenticate(self.staff)
+        with self.settings(CHAT_PROFILER=True, CHAT_PROFILER_DIR=self.output_dir, CHAT_PROFILER_MAX_SECONDS=1):
+            response = self.client.post(self.url, {'seconds': 5}, format='json')
+            self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+            response = self.client.post(self.url, {'seconds': 0.1, 'interval': 0.005}, format='json')
+            self.assertEqual(response.status_code, status.HTTP_202_ACCEPTED)
+            self.assertTrue(response.data['path'].startswith(self.output_dir))
+            profiler.wait(5)
+
+            response = self.client.get(self.url)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertTrue(response['Content-Type'].startswith('text/plain'))
+        self.assertIn('MainThread;', response.content.decode())
@@ -0,0 +1,167 @@
+import time
+from unittest import mock
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.test import SimpleTestCase, TestCase, override_settings
+from django.urls import reverse
+from rest_framework import status
+from rest_framework.test import APITestCase
+from chat import membership, presence, ratelimit, rooms, unread
+from chat.models import ChatRoom
+from chat.test.utils import ChatCacheMixin, FakeRedisMixin, QueryBudgetMixin, requires_fakeredis
+
+
+@requires_fakeredis
+class RedisMembershipTests(FakeRedisMixin, ChatCacheMixin, TestCase):
+    def setUp(self):
+        self.user = get_user_model().objects.create_user(username='testuser', password='testuser')
+        self.outsider = get_user_model().objects.create_user(username='outsider', password='testuser')
+        self.chatroom = ChatRoom.objects.create(room_name='testroom', creator=self.user)
+        self.chatroom.members.add(self.user)
+
+    def test_member_set_is_filled_once(self):
+        self.assertTrue(membership.is_member(self.chatroom, self.user))
+        self.assertFalse(membership.is_member(self.chatroom, self.outsider))
+        self.assertEqual(self.redis.smembers(membership.members_key(self.chatroom.pk)), {b'0', str(self.user.pk).encode()})
+
+        membership.clear()
+        with self.assertNumQueries(0):
+            self.assertTrue(membership.is_member(self.chatroom, self.user))
+
+    def test_large_rooms_are_filled_in_chunks(self):
+        users = get_user_model().objects.bulk_create(
+            get_user_model()(username=f'member{i}') for i in range(membership.FILL_CHUNK * 2 + 10)
+        )
+        membership.Membership.objects.bulk_create(
+            membership.Membership(chatroom_id=self.chatroom.pk, customuser_id=user.pk) for user in users
+        )
+        self.assertTrue(membership.is_member(self.chatroom, users[-1]))
+        # Every member plus the LOADED marker
+        self.assertEqual(self.redis.scard(membership.members_key(self.chatroom.pk)), len(users) + 2)
+
+    def test_fill_is_skipped_after_an_invalidation(self):
+        load = membership.Membership.objects.filter
+
+        def invalidated_while_loading(*args, **kwargs):
+            rows = list(load(*args, **kwargs).values_list('customuser_id', flat=True))
+            membership.invalidate(self.chatroom.pk)
+            queryset = mock.Mock()
+            queryset.values_list.return_value = rows
+            return queryset
+
+        with mock.patch.object(membership.Membership.objects, 'filter', invalidated_while_loading):
+            self.assertTrue(membership.is_member(self.chatroom, self.user))
+        self.assertFalse(self.redis.exists(membership.members_key(self.chatroom.pk)))
+
+    def test_invalidation_drops_the_set(self):
+        membership.is_member(self.chatroom, self.outsider)
+        self.chatroom.members.add(self.outsider)
+        self.assertFalse(self.redis.exists(membership.members_key(self.chatroom.pk)))
+        self.assertTrue(membership.is_member(self.chatroom, self.outsider))
+
+
+@requires_fakeredis
+class RedisRoomCacheTests(FakeRedisMixin, ChatCacheMixin, QueryBudgetMixin, APITestCase):
+    def setUp(self):
+        self.user = get_user_model().objects.create_user(username='testuser', password='testuser')
+        self.chatroom = ChatRoom.objects.create(room_name='testroom', creator=self.user)
+        self.chatroom.members.add(self.user)
+        self.url = reverse('chatroom-chat', kwargs={'room_id': str(self.chatroom.room_id)})
+
+    def test_room_and_membership_survive_without_local_tier(self):
+        '''Another worker only has the shared cache to go on'''
+        self.client.force_authenticate(self.user)
+        self.client.post(self.url, {'content': 'first'}, format='json')
+        rooms.clear()
+        membership.clear()
+        with self.assertQueryBudget(1) as context:
+            response = self.client.post(self.url, {'content': 'second'}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertFalse(any('FROM "chat_chatroom"' in q['sql'] for q in context.captured_queries))
+
+
+@requires_fakeredis
+@override_settings(CHAT_SEND_RATE_PER_USER=0.01, CHAT_SEND_BURST_PER_USER=2,
+                   CHAT_SEND_RATE_PER_ROOM=0.01, CHAT_SEND_BURST_PER_ROOM=3)
+class RedisBucketStoreTests(FakeRedisMixin, ChatCacheMixin, SimpleTestCase):
+    def test_buckets_are_shared(self):
+        self.assertEqual(ratelimit.check_send(1, 10), 0)
+        self.assertEqual(ratelimit.check_send(1, 10), 0)
+        self.assertGreater(ratelimit.check_send(1, 10), 0)
+        self.assertTrue(self.redis.exists('chat:ratelimit:user:1', 'chat:ratelimit:room:10'))
+        self.assertEqual(len(ratelimit._local_store.buckets), 0)
+
+    def test_tokens_are_taken_from_all_buckets_or_none(self):
+        for user_pk in (1, 2, 3):
+            self.assertEqual(ratelimit.check_send(user_pk, 10), 0)
+        self.assertGreater(ratelimit.check_send(4, 10), 0)
+        # The refused message left user 4's bucket full
+        self.assertEqual(ratelimit.check_send(4, 11), 0)
+        self.assertEqual(ratelimit.check_send(4, 11), 0)
+
+
+@requires_fakeredis
+class RedisUnreadStoreTests(FakeRedisMixin, ChatCacheMixin, SimpleTestCase):
+    def setUp(self):
+        self.store = unread.get_store()
+
+    def test_uses_redis(self):
+        self.assertIsInstance(self.store, unread.RedisUnreadStore)
+
+    def test_counts_follow_the_room_sequence(self):
+        self.assertEqual([self.store.bump(10, 1) for _ in range(3)], [1, 2, 3])
+        self.store.bump(11, 2)
+        self.assertEqual(self.store.counts(1, [10, 11, 12]), {10: 0, 11: 1, 12: 0})
+        self.assertEqual(self.store.counts(2, [10, 11]), {10: 3, 11: 0})
+
+    def test_mark_read_and_read_up_to(self):
+        for _ in range(3):
+            self.store.bump(10, 1)
+        self.store.mark_read(10, [2, 3])
+        self.assertEqual(self.store.counts(2, [10]), {10: 0})
+        self.store.bump(10, 1)
+        self.store.read_up_to(10, 3, 2)
+        self.assertEqual(self.store.counts(3, [10]), {10: 2})
+
+    def test_forget(self):
+        self.store.bump(10, 1)
+        self.store.forget(10)
+        self.assertFalse(self.redis.exists(unread.seq_key(10)))
+        self.assertEqual(self.store.counts(2, [10]), {10: 0})
+
+
+@requires_fakeredis
+class RedisPresenceStoreTests(FakeRedisMixin, ChatCacheMixin, SimpleTestCase):
+    def setUp(self):
+        self.store = presence.get_store()
+
+    def test_uses_redis(self):
+        self.assertIsInstance(self.store, presence.RedisPresenceStore)
+
+    def test_second_socket_keeps_user_online(self):
+        self.assertTrue(self.store.join(10, 1))
+        self.assertFalse(self.store.join(10, 1))
+        self.assertFalse(self.store.leave(10, 1))
+        self.assertEqual(self.store.count(10), 1)
+        self.assertTrue(self.store.leave(10, 1))
+        self.assertEqual(self.store.count(10), 0)
+
+    def test_online_is_most_recent_first(self):
+        for user_pk in (1, 2, 3):
+            self.store.join(10, user_pk)
+        self.redis.zadd(presence.users_key(10), {1: time.time() + 1})
+        self.assertEqual([user_pk for user_pk, _ in self.store.online(10, 0, 2)], [1, 3])
+        self.assertEqual(len(self.store.online(10, 0, 10)), 3)
+
+    def test_heartbeat_only_refreshes_online_users(self):
+        self.store.heartbeat(10, 1)
+        self.assertEqual(self.store.count(10), 0)
+
+    def test_stale_users_are_pruned(self):
+        self.store.join(10, 1)
+        self.store.join(10, 2)
+        stale = time.time() - settings.CHAT_PRESENCE_TTL - 1
+        self.redis.zadd(presence.users_key(10), {1: stale})
+        self.assertEqual(self.store.count(10), 1)
+        self.assertFalse(self.redis.hexists(presence.connections_key(10), 1))
+        self.assertEqual(self.store.online(10, 0, 10)[0][0], 2)
@@ -0,0 +1,77 @@
+import gzip
+import json
+import os
+import shutil
+import tempfile
+from datetime import timedelta
+from io import StringIO
+from django.contrib.auth import get_user_model
+from django.core.management import call_command
+from django.urls import reverse
+from django.utils import timezone
+from rest_framework.test import APITestCase
+from chat.models import ChatRoom, Message
+from chat.test.utils import ChatCacheMixin
+
+
+class ArchiveMessagesTests(ChatCacheMixin, APITestCase):
+    def setUp(self):
+        self.user = get_user_model().objects.create_user(username='testuser', password='testuser')
+        self.chatroom = ChatRoom.objects.create(room_name='testroom', creator=self.user, retention_days=30)
+        self.chatroom.members.add(self.user)
+        self.keep_forever = ChatRoom.objects.create(room_name='keep', creator=self.user)
+        self.output_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.output_dir)
+
+    def message(self, room, days_ago, content='hello'):
+        message = Message.objects.create(content=content, sender=self.user, room=room)
+        Message.objects.filter(pk=message.pk).update(date_sent=timezone.now() - timedelta(days=days_ago))
+        return message
+
+    def archive(self, *args):
+        out = StringIO()
+        call_command('archive_messages', '--output-dir', self.output_dir, '--chunk-size', '2', *args, stdout=out)
+        return out.getvalue()
+
+    def test_old_messages_are_archived_then_deleted(self):
+        old = [self.message(self.chatroom, 40 + i, f'old {i}') for i in range(5)]
+        recent = self.message(self.chatroom, 1, 'recent')
+        untouched = self.message(self.keep_forever, 400)
+
+        output = self.archive('--batch-size', '2')
+        self.assertIn('archived 5 messages', output)
+        self.assertEqual(set(Message.objects.values_list('pk', flat=True)), {recent.pk, untouched.pk})
+
+        room_dir = os.path.join(self.output_dir, str(self.chatroom.room_id))
+        [filename] = os.listdir(room_dir)
+        with gzip.open(os.path.join(room_dir, filename), 'rt') as archive:
+            rows = [json.loads(line) for line in archive]
+        # Oldest first, with the sender's username
+        self.assertEqual([row['message_id'] for row in rows], [str(m.message_id) for m in reversed(old)])
+        self.assertEqual(rows[0]['sender'], 'testuser')
+
+        self.chatroom.refresh_from_db()
+        self.assertIsNotNone(self.chatroom.archived_before)
+
+    def test_dry_run_changes_nothing(self):
+        self.message(self.chatroom, 40)
+        self.assertIn('would archive', self.archive('--dry-run'))
+        self.assertEqual(Message.objects.count(), 1)
+        self.assertEqual(os.listdir(self.output_dir), [])
+
+    def test_default_retention_setting(self):
+        self.message(self.keep_forever, 10)
+        with self.settings(CHAT_RETENTION_DAYS=7):
+            self.archive()
+        self.assertEqual(Message.objects.count(), 0)
+
+    def test_history_stops_at_archive_boundary(self):
+        self.message(self.chatroom, 40, 'old')
+        recent = self.message(self.chatroom, 1, 'recent')
+        # Boundary moved but rows not deleted yet, as mid-way through an archive run
+        ChatRoom.objects.filter(pk=self.chatroom.pk).update(archived_before=timezone.now() - timedelta(days=30))
+
+        self.client.force_authenticate(self.user)
+        url = reverse('chatroom-messages', kwargs={'room_id': str(self.chatroom.room_id)})
+        response = self.client.get(url)
+        self.assertEqual([m['message_id'] for m in response.data['results']], [str(recent.message_id)])
@@ -1,11 +1,17 @@
+import uuid
+from unittest import mock
+from django.core.cache import cache
 from django.urls import reverse, resolve
 from django.contrib.auth import get_user_model
 from rest_framework.test import APITestCase
 from rest_framework import status
-from ..models import ChatRoom
+from .. import membership, presence, ratelimit, rooms, unread
+from ..views import chat_view
+from ..models import ChatRoom, Message, ReadCursor
+from .utils import ChatCacheMixin, QueryBudgetMixin
 # Create your tests here.
 
-class ChatRoomViewSetTests(APITestCase):
+class ChatRoomViewSetTests(ChatCacheMixin, APITestCase):
     def setUp(self) -> None:
         self.admin = get_user_model().objects.create_superuser(username='adminuser', password='12345678')
         self.user1 = get_user_model().objects.create_user(username='testuser', password='testuser')
@@ -163,3 +169,434 @@ class ChatRoomViewSetTests(APITestCase):
         }
         chat_response  = self.client.post(url, data, format='json')
         self.assertEqual(chat_response.status_code, status.HTTP_201_CREATED)
+
+
+class MessageHistoryTests(ChatCacheMixin, APITestCase):
+    def setUp(self) -> None:
+        self.user1 = get_user_model().objects.create_user(username='testuser', password='testuser')
+        self.user2 = get_user_model().objects.create_user(username='testuser2', password='testuser')
+        self.chatroom = ChatRoom.objects.create(room_name='testroom', creator=self.user1)
+        self.chatroom.members.add(self.user1)
+        self.messages = [
+            Message.objects.create(content=f'message {i}', sender=self.user1, room=self.chatroom)
+            for i in range(5)
+        ]
+        self.url = reverse('chatroom-messages', kwargs={'room_id': str(self.chatroom.room_id)})
+
+    def test_only_members_can_read_history(self):
+        self.client.force_authenticate(self.user2)
+        response = self.client.get(self.url)
+        self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+
+    def test_latest_page_is_newest_first(self):
+        self.client.force_authenticate(self.user1)
+        response = self.client.get(self.url, {'page_size': 2})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        contents = [m['content'] for m in response.data['results']]
+        self.assertEqual(contents, ['message 4', 'message 3'])
+        self.assertIsNotNone(response.data['next'])
+        self.assertIsNone(response.data['previous'])
+
+    def test_walk_history_with_cursors(self):
+        self.client.force_authenticate(self.user1)
+        seen = []
+        url = self.url + '?page_size=2'
+        while url:
+            response = self.client.get(url)
+            seen += [m['content'] for m in response.data['results']]
+            url = response.data['next']
+        self.assertEqual(seen, [f'message {i}' for i in range(4, -1, -1)])
+
+    def test_after_cursor_returns_newer_messages(self):
+        self.client.force_authenticate(self.user1)
+        response = self.client.get(self.url, {'after': str(self.messages[2].message_id)})
+        contents = [m['content'] for m in response.data['results']]
+        self.assertEqual(contents, ['message 4', 'message 3'])
+
+    def test_invalid_cursor(self):
+        self.client.force_authenticate(self.user1)
+        response = self.client.get(self.url, {'before': 'not-a-cursor'})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+
+class QueryBudgetTests(ChatCacheMixin, QueryBudgetMixin, APITestCase):
+    def setUp(self) -> None:
+        self.user = get_user_model().objects.create_user(username='testuser', password='testuser')
+        self.others = [
+            get_user_model().objects.create_user(username=f'member{i}', password='testuser')
+            for i in range(3)
+        ]
+        for i in range(20):
+            chatroom = ChatRoom.objects.create(room_name=f'room {i}', creator=self.others[i % 3])
+            chatroom.members.add(self.user, *self.others)
+
+    def test_room_list_query_budget(self):
+        self.client.force_authenticate(self.user)
+        with self.assertQueryBudget(1):
+            response = self.client.get(reverse('chatroom-list'))
+        self.assertEqual(len(response.data), 20)
+        self.assertEqual({room['total_members'] for room in response.data}, {4})
+        # The listing is unordered, so compare creators per room
+        self.assertEqual({room['room_name']: room['creator'] for room in response.data},
+                         {f'room {i}': f'member{i % 3}' for i in range(20)})
+
+    def test_user_chatrooms_query_budget(self):
+        self.client.force_authenticate(self.user)
+        url = reverse('user-chatrooms', kwargs={'pk': self.user.pk})
+        with self.assertQueryBudget(1):
+            response = self.client.get(url)
+        self.assertEqual(len(response.data), 20)
+        # Filtering by this user must not shrink the member count to 1
+        self.assertEqual({room['total_members'] for room in response.data}, {4})
+
+    def test_send_message_loads_room_once(self):
+        chatroom = ChatRoom.objects.first()
+        url = reverse('chatroom-chat', kwargs={'room_id': str(chatroom.room_id)})
+        self.client.force_authenticate(self.user)
+        # Room, membership check and the insert
+        with self.assertQueryBudget(3) as context:
+            response = self.client.post(url, {'content': 'Hello Room'}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        room_queries = [q for q in context.captured_queries if 'FROM "chat_chatroom"' in q['sql']]
+        self.assertEqual(len(room_queries), 1)
+
+    def test_unknown_room_returns_404(self):
+        url = reverse('chatroom-chat', kwargs={'room_id': str(uuid.uuid4())})
+        self.client.force_authenticate(self.user)
+        response = self.client.post(url, {'content': 'Hello Room'}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+
+class MembershipTests(ChatCacheMixin, QueryBudgetMixin, APITestCase):
+    def setUp(self) -> None:
+        self.user1 = get_user_model().objects.create_user(username='testuser', password='testuser')
+        self.user2 = get_user_model().objects.create_user(username='testuser2', password='testuser')
+        self.chatroom = ChatRoom.objects.create(room_name='testroom', creator=self.user1)
+        self.chatroom.members.add(self.user1)
+        self.url = reverse('chatroom-messages', kwargs={'room_id': str(self.chatroom.room_id)})
+
+    def test_membership_check_is_cached(self):
+        self.client.force_authenticate(self.user1)
+        self.client.get(self.url)
+        with self.assertQueryBudget(2) as context:
+            response = self.client.get(self.url)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertFalse(any('chat_chatroom_members' in q['sql'] for q in context.captured_queries))
+
+    def test_add_member_invalidates_cache(self):
+        self.client.force_authenticate(self.user2)
+        self.assertEqual(self.client.get(self.url).status_code, status.HTTP_403_FORBIDDEN)
+
+        self.client.force_authenticate(self.user1)
+        add_url = reverse('chatroom-add-member', kwargs={'room_id': self.chatroom.room_id})
+        self.client.post(add_url, {'username': 'testuser2'}, format='json')
+
+        self.client.force_authenticate(self.user2)
+        self.assertEqual(self.client.get(self.url).status_code, status.HTTP_200_OK)
+
+    def test_remove_member_invalidates_cache(self):
+        self.chatroom.members.add(self.user2)
+        self.client.force_authenticate(self.user2)
+        self.assertEqual(self.client.get(self.url).status_code, status.HTTP_200_OK)
+
+        self.client.force_authenticate(self.user1)
+        member_url = reverse('chatroom-member', kwargs={'room_id': str(self.chatroom.room_id), 'user_id': self.user2.pk})
+        self.client.delete(member_url)
+
+        self.client.force_authenticate(self.user2)
+        self.assertEqual(self.client.get(self.url).status_code, status.HTTP_403_FORBIDDEN)
+
+    def test_reverse_m2m_changes_invalidate_cache(self):
+        self.client.force_authenticate(self.user2)
+        self.assertEqual(self.client.get(self.url).status_code, status.HTTP_403_FORBIDDEN)
+        self.user2.chatrooms.add(self.chatroom)
+        self.assertEqual(self.client.get(self.url).status_code, status.HTTP_200_OK)
+
+    def test_cache_is_invalidated_again_on_commit(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            self.chatroom.members.add(self.user2)
+            # Another reader caches the membership as it was before the commit
+            membership._cache.set((self.chatroom.pk, self.user2.pk), False)
+        self.client.force_authenticate(self.user2)
+        self.assertEqual(self.client.get(self.url).status_code, status.HTTP_200_OK)
+
+
+class RoomCacheTests(ChatCacheMixin, QueryBudgetMixin, APITestCase):
+    def setUp(self) -> None:
+        self.user = get_user_model().objects.create_user(username='testuser', password='testuser')
+        self.chatroom = ChatRoom.objects.create(room_name='testroom', creator=self.user)
+        self.chatroom.members.add(self.user)
+        self.url = reverse('chatroom-chat', kwargs={'room_id': str(self.chatroom.room_id)})
+
+    def test_cached_room_skips_room_query(self):
+        self.client.force_authenticate(self.user)
+        self.client.post(self.url, {'content': 'first'}, format='json')
+        with self.assertQueryBudget(1) as context:
+            response = self.client.post(self.url, {'content': 'second'}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(response.data['room'], 'testroom')
+        # Only the insert is left
+        self.assertTrue(context.captured_queries[0]['sql'].startswith('INSERT INTO "chat_message"'))
+
+    def test_room_update_invalidates_cache(self):
+        self.client.force_authenticate(self.user)
+        self.client.post(self.url, {'content': 'first'}, format='json')
+        detail_url = reverse('chatroom-detail', kwargs={'room_id': self.chatroom.room_id})
+        self.client.patch(detail_url, {'room_name': 'renamed'}, format='json')
+        response = self.client.post(self.url, {'content': 'second'}, format='json')
+        self.assertEqual(response.data['room'], 'renamed')
+
+    def test_room_id_spellings_share_a_cache_entry(self):
+        spelling = self.chatroom.room_id.hex.upper()
+        self.assertEqual(rooms.get_room(spelling).pk, self.chatroom.pk)
+        self.chatroom.room_name = 'renamed'
+        self.chatroom.save()
+        self.assertEqual(rooms.get_room(spelling).room_name, 'renamed')
+        self.assertIsNone(rooms.get_room('not-a-room'))
+
+    def test_per_process_cache_is_not_a_shared_tier(self):
+        '''Without Redis, other workers could never see this process invalidate it'''
+        rooms.get_room(self.chatroom.room_id)
+        self.assertIsNone(cache.get(rooms.room_key(self.chatroom.room_id)))
+
+
+class UnreadCountTests(ChatCacheMixin, QueryBudgetMixin, APITestCase):
+    def setUp(self):
+        self.user1 = get_user_model().objects.create_user(username='testuser', password='testuser')
+        self.user2 = get_user_model().objects.create_user(username='testuser2', password='testuser')
+        self.chatroom = ChatRoom.objects.create(room_name='testroom', creator=self.user1)
+        self.chatroom.members.add(self.user1, self.user2)
+        self.chat_url = reverse('chatroom-chat', kwargs={'room_id': str(self.chatroom.room_id)})
+        self.read_url = reverse('chatroom-read', kwargs={'room_id': str(self.chatroom.room_id)})
+
+    def send(self, user, count=1):
+        self.client.force_authenticate(user)
+        return [self.client.post(self.chat_url, {'content': 'hi'}, format='json').data for _ in range(count)]
+
+    def unread(self, user):
+        self.client.force_authenticate(user)
+        response = self.client.get(reverse('user-chatrooms', kwargs={'pk': user.pk}))
+        return response.data[0]['unread_count']
+
+    def test_messages_from_others_are_unread(self):
+        self.send(self.user2, 3)
+        self.assertEqual(self.unread(self.user1), 3)
+        # Your own messages never count
+        self.assertEqual(self.unread(self.user2), 0)
+
+    def test_reading_clears_the_count(self):
+        messages = self.send(self.user2, 2)
+        self.client.force_authenticate(self.user1)
+        response = self.client.post(self.read_url, {'message_id': messages[-1]['message_id']}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(self.unread(self.user1), 0)
+
+        self.send(self.user2)
+        self.assertEqual(self.unread(self.user1), 1)
+        cursor = ReadCursor.objects.get(room=self.chatroom, user=self.user1)
+        self.assertEqual(str(cursor.message_id), messages[-1]['message_id'])
+
+        response = self.client.get(self.read_url)
+        self.assertEqual([entry['user'] for entry in response.data], ['testuser'])
+
+    def test_reading_an_earlier_message_leaves_later_ones_unread(self):
+        messages = self.send(self.user2, 3)
+        self.client.force_authenticate(self.user1)
+        self.client.post(self.read_url, {'message_id': messages[0]['message_id']}, format='json')
+        self.assertEqual(self.unread(self.user1), 2)
+
+    def test_message_sent_while_marking_read_stays_unread(self):
+        messages = self.send(self.user2, 2)
+        self.assertEqual(Message.objects.get(message_id=messages[1]['message_id']).seq, 2)
+        read_message = unread.read_message
+
+        def sent_during_read(*args):
+            found = read_message(*args)
+            # Looked up by the serializer and again by mark_read; another message lands in between each
+            message = Message.objects.create(content='late', sender=self.user2, room=self.chatroom)
+            unread.message_created(message)
+            return found
+
+        self.client.force_authenticate(self.user1)
+        with mock.patch.object(unread, 'read_message', sent_during_read):
+            self.client.post(self.read_url, {'message_id': messages[1]['message_id']}, format='json')
+        self.assertEqual(self.unread(self.user1), 2)
+
+    def test_cursor_must_be_in_the_room(self):
+        other_room = ChatRoom.objects.create(room_name='otherroom', creator=self.user1)
+        other_room.members.add(self.user1)
+        other_url = reverse('chatroom-chat', kwargs={'room_id': str(other_room.room_id)})
+        self.client.force_authenticate(self.user1)
+        message = self.client.post(other_url, {'content': 'elsewhere'}, format='json').data
+
+        response = self.client.post(self.read_url, {'message_id': message['message_id']}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertIn('message_id', response.data)
+        self.assertFalse(ReadCursor.objects.filter(room=self.chatroom).exists())
+
+    def test_new_members_start_caught_up(self):
+        self.send(self.user1, 2)
+        newcomer = get_user_model().objects.create_user(username='newcomer', password='testuser')
+        self.chatroom.members.add(newcomer)
+        self.assertEqual(self.unread(newcomer), 0)
+
+    def test_counts_do_not_query_messages(self):
+        self.send(self.user2, 5)
+        self.client.force_authenticate(self.user1)
+        with self.assertQueryBudget(1) as context:
+            self.client.get(reverse('user-chatrooms', kwargs={'pk': self.user1.pk}))
+        self.assertFalse([q for q in context.captured_queries if 'chat_message' in q['sql']])
+
+    def test_non_members_cannot_read(self):
+        outsider = get_user_model().objects.create_user(username='outsider', password='testuser')
+        self.client.force_authenticate(outsider)
+        response = self.client.get(self.read_url)
+        self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+
+
+class SendRateLimitTests(ChatCacheMixin, APITestCase):
+    def setUp(self):
+        self.user1 = get_user_model().objects.create_user(username='testuser', password='testuser')
+        self.user2 = get_user_model().objects.create_user(username='testuser2', password='testuser')
+        self.chatroom = ChatRoom.objects.create(room_name='testroom', creator=self.user1)
+        self.chatroom.members.add(self.user1, self.user2)
+        self.url = reverse('chatroom-chat', kwargs={'room_id': str(self.chatroom.room_id)})
+
+    def send(self, user):
+        self.client.force_authenticate(user)
+        return self.client.post(self.url, {'content': 'hi'}, format='json')
+
+    def test_user_burst_is_limited(self):
+        with self.settings(CHAT_SEND_RATE_PER_USER=0.01, CHAT_SEND_BURST_PER_USER=3):
+            statuses = [self.send(self.user1).status_code for _ in range(4)]
+            self.assertEqual(statuses, [201, 201, 201, 429])
+            self.assertIn('Retry-After', self.send(self.user1))
+            # Other users have their own buckets
+            self.assertEqual(self.send(self.user2).status_code, status.HTTP_201_CREATED)
+        self.assertEqual(Message.objects.count(), 4)
+
+    def test_denied_sends_keep_the_connection_token(self):
+        with self.settings(CHAT_SEND_RATE_PER_USER=0.01, CHAT_SEND_BURST_PER_USER=1,
+                           CHAT_SEND_RATE_PER_CONNECTION=0.01, CHAT_SEND_BURST_PER_CONNECTION=1):
+            self.assertEqual(self.send(self.user1).status_code, status.HTTP_201_CREATED)
+            self.assertGreater(ratelimit.check_send(self.user1.pk, self.chatroom.pk, 'socket'), 0)
+            with self.settings(CHAT_SEND_RATE_PER_USER=0):
+                self.assertEqual(ratelimit.check_send(self.user1.pk, self.chatroom.pk, 'socket'), 0)
+                self.assertGreater(ratelimit.check_send(self.user1.pk, self.chatroom.pk, 'socket'), 0)
+
+    def test_room_limit_applies_to_everyone(self):
+        with self.settings(CHAT_SEND_RATE_PER_ROOM=0.01, CHAT_SEND_BURST_PER_ROOM=2):
+            self.assertEqual(self.send(self.user1).status_code, status.HTTP_201_CREATED)
+            self.assertEqual(self.send(self.user2).status_code, status.HTTP_201_CREATED)
+            self.assertEqual(self.send(self.user2).status_code, status.HTTP_429_TOO_MANY_REQUESTS)
+
+    def test_reads_are_not_limited(self):
+        with self.settings(CHAT_SEND_RATE_PER_USER=0.01, CHAT_SEND_BURST_PER_USER=1):
+            self.send(self.user1)
+            response = self.client.get(self.url)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+
+class AsyncChatViewTests(ChatCacheMixin, APITestCase):
+    def setUp(self):
+        self.user = get_user_model().objects.create_user(username='testuser', password='testuser')
+        self.chatroom = ChatRoom.objects.create(room_name='testroom', creator=self.user)
+        self.chatroom.members.add(self.user)
+        self.url = reverse('chatroom-chat', kwargs={'room_id': str(self.chatroom.room_id)})
+        self.client.force_authenticate(self.user)
+
+    def test_routed_to_async_view(self):
+        self.assertIs(resolve(self.url).func, chat_view)
+
+    def test_send_awaits_fan_out_on_the_loop(self):
+        with mock.patch('chat.views.async_to_sync', side_effect=AssertionError('bridged')), \
+                mock.patch('chat.views.fan_out', new_callable=mock.AsyncMock) as fan_out:
+            response = self.client.post(self.url, {'content': 'hi'}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(response.json()['content'], 'hi')
+        fan_out.assert_awaited_once()
+        room, event = fan_out.await_args.args
+        self.assertEqual(room.pk, self.chatroom.pk)
+        self.assertEqual(event['message_id'], response.data['message_id'])
+
+    def test_join_does_not_announce_presence(self):
+        response = self.client.get(self.url)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(presence.notifier.take(), [])
+
+    def test_errors_skip_fan_out(self):
+        with mock.patch('chat.views.fan_out', new_callable=mock.AsyncMock) as fan_out:
+            response = self.client.post(self.url, {}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertIn('content', response.data)
+        fan_out.assert_not_awaited()
+
+    def test_sync_views(self):
+        with self.settings(CHAT_ASYNC_VIEWS=False), \
+                mock.patch('chat.views.fan_out', new_callable=mock.AsyncMock) as fan_out:
+            response = self.client.post(self.url, {'content': 'hi'}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        fan_out.assert_awaited_once()
+
+
+class MessageSearchTests(ChatCacheMixin, APITestCase):
+    def setUp(self):
+        self.user1 = get_user_model().objects.create_user(username='testuser', password='testuser')
+        self.user2 = get_user_model().objects.create_user(username='testuser2', password='testuser')
+        self.chatroom = ChatRoom.objects.create(room_name='testroom', creator=self.user1)
+        self.chatroom.members.add(self.user1)
+        self.other_room = ChatRoom.objects.create(room_name='otherroom', creator=self.user2)
+        self.url = reverse('chatroom-messages-search', kwargs={'room_id': str(self.chatroom.room_id)})
+        self.client.force_authenticate(self.user1)
+
+    def message(self, content, room=None):
+        return Message.objects.create(content=content, sender=self.user1, room=room or self.chatroom)
+
+    def test_correct_url(self):
+        self.assertEqual(self.url, f'/api/v1/chatroom/{self.chatroom.room_id}/messages/search/')
+
+    def test_results_are_ranked_and_scoped_to_the_room(self):
+        once = self.message('deploy went out this morning, lots of other words in this one')
+        twice = self.message('deploy deploy')
+        self.message('nothing to see here')
+        self.message('deploy in another room', room=self.other_room)
+
+        response = self.client.get(self.url, {'q': 'deploy'})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual([m['message_id'] for m in response.data['results']], [str(twice.message_id), str(once.message_id)])
+        self.assertIsNone(response.data['next'])
+
+    def test_walk_results_with_cursor(self):
+        for i in range(5):
+            self.message(f'release notes part {i}')
+        seen = []
+        response = self.client.get(self.url, {'q': 'release', 'page_size': 2})
+        while True:
+            seen += [m['message_id'] for m in response.data['results']]
+            if not response.data['next']:
+                break
+            response = self.client.get(response.data['next'])
+        self.assertEqual(len(seen), 5)
+        self.assertEqual(len(set(seen)), 5)
+
+    def test_index_follows_edits_and_deletes(self):
+        message = self.message('typo in the original')
+        message.content = 'fixed wording'
+        message.save()
+        self.assertEqual(self.client.get(self.url, {'q': 'typo'}).data['results'], [])
+        self.assertEqual(len(self.client.get(self.url, {'q': 'fixed'}).data['results']), 1)
+        message.delete()
+        self.assertEqual(self.client.get(self.url, {'q': 'fixed'}).data['results'], [])
+
+    def test_query_syntax_is_not_interpreted(self):
+        self.message('hello world')
+        response = self.client.get(self.url, {'q': '"hello* ('})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(len(response.data['results']), 1)
+
+    def test_query_is_required(self):
+        self.assertEqual(self.client.get(self.url).status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_only_members_can_search(self):
+        self.client.force_authenticate(self.user2)
+        self.assertEqual(self.client.get(self.url, {'q': 'hello'}).status_code, status.HTTP_403_FORBIDDEN)
@@ -0,0 +1,109 @@
+import json
+import os
+import shutil
+import tempfile
+from datetime import timedelta
+from unittest import mock
+from django.contrib.auth import get_user_model
+from django.test import TransactionTestCase, override_settings
+from rest_framework.test import APIClient
+from django.urls import reverse
+from django.utils import timezone
+from chat.models import ChatRoom, Message
+from chat.test.utils import ChatCacheMixin
+from chat.writebehind import BufferFull, MessageBuffer
+
+
+class MessageBufferTests(ChatCacheMixin, TransactionTestCase):
+    def setUp(self):
+        self.user = get_user_model().objects.create_user(username='testuser', password='testuser')
+        self.chatroom = ChatRoom.objects.create(room_name='testroom', creator=self.user)
+        self.chatroom.members.add(self.user)
+
+    def message(self, content):
+        return Message(content=content, sender=self.user, room=self.chatroom)
+
+    def test_messages_are_flushed_in_batches(self):
+        buffer = MessageBuffer(batch_size=10, flush_interval=0.01)
+        buffer.start()
+        queued = [buffer.enqueue(self.message(f'message {i}')) for i in range(25)]
+        buffer.close()
+        saved = list(Message.objects.order_by('id').values_list('message_id', flat=True))
+        self.assertEqual(saved, [message.message_id for message in queued])
+
+    def test_flush_keeps_the_queued_date_sent(self):
+        buffer = MessageBuffer()
+        message = self.message('hello')
+        message.date_sent = timezone.now() - timedelta(hours=1)
+        queued = buffer.enqueue(message)
+        buffer.flush()
+        self.assertEqual(Message.objects.get(message_id=queued.message_id).date_sent, queued.date_sent)
+
+    def test_full_buffer_applies_backpressure(self):
+        buffer = MessageBuffer(max_pending=1, enqueue_timeout=0.01)
+        buffer.enqueue(self.message('first'))
+        with self.assertRaises(BufferFull):
+            buffer.enqueue(self.message('second'))
+        buffer.flush()
+        self.assertEqual(Message.objects.count(), 1)
+
+    def journal_dir(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory, ignore_errors=True)
+        return directory
+
+    def test_recover_replays_unsaved_journal_entries(self):
+        journal_path = os.path.join(self.journal_dir(), 'journal.jsonl')
+        buffer = MessageBuffer(journal_path=journal_path)
+        lost = buffer.enqueue(self.message('lost in a crash'))
+        saved = self.message('already saved')
+        saved.save()
+        with open(buffer.journal_path, 'a') as journal:
+            journal.write(json.dumps({
+                'message_id': str(saved.message_id), 'content': saved.content,
+                'sender_id': self.user.id, 'room_id': self.chatroom.id,
+                'date_sent': saved.date_sent.isoformat(),
+            }) + '\n')
+
+        recovered = MessageBuffer(journal_path=journal_path).recover()
+        self.assertEqual(recovered, 1)
+        self.assertEqual(Message.objects.get(message_id=lost.message_id).date_sent, lost.date_sent)
+        self.assertEqual(os.listdir(os.path.dirname(journal_path)), [])
+
+    def test_journals_of_running_workers_are_left_alone(self):
+        journal_path = os.path.join(self.journal_dir(), 'journal.jsonl')
+        buffer = MessageBuffer(journal_path=journal_path)
+        queued = buffer.enqueue(self.message('still queued elsewhere'))
+        # The same journal, as if written by another worker that is still running
+        other = f'{journal_path}.{os.getppid()}'
+        os.rename(buffer.journal_path, other)
+
+        self.assertEqual(MessageBuffer(journal_path=journal_path).recover(), 0)
+        self.assertFalse(Message.objects.filter(message_id=queued.message_id).exists())
+        self.assertTrue(os.path.exists(other))
+
+    def test_failed_batches_go_to_dead_letters(self):
+        journal_path = os.path.join(self.journal_dir(), 'journal.jsonl')
+        buffer = MessageBuffer(journal_path=journal_path, max_retries=1)
+        failed = buffer.enqueue(self.message('cannot be saved'))
+        with mock.patch.object(Message.objects, 'bulk_create', side_effect=RuntimeError), \
+                self.assertLogs('chat.writebehind', 'ERROR'):
+            buffer.flush()
+        self.assertEqual(buffer.pending, 0)
+        self.assertEqual(os.path.getsize(buffer.journal_path), 0)
+        with open(f'{journal_path}.dead') as dead_letters:
+            self.assertEqual(json.loads(dead_letters.readline())['message_id'], str(failed.message_id))
+
+    @override_settings(CHAT_WRITE_BEHIND=True)
+    def test_rest_send_uses_write_behind(self):
+        buffer = MessageBuffer()
+        client = APIClient()
+        client.force_authenticate(self.user)
+        url = reverse('chatroom-chat', kwargs={'room_id': str(self.chatroom.room_id)})
+        with mock.patch('chat.serializers.get_message_buffer', return_value=buffer):
+            response = client.post(url, {'content': 'Hello Room'}, format='json')
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(Message.objects.count(), 0)
+
+        buffer.flush()
+        self.assertTrue(Message.objects.filter(message_id=response.data['message_id']).exists())
@@ -0,0 +1,73 @@
+from contextlib import contextmanager
+from unittest import mock, skipUnless
+from django.core.cache import cache
+from django.db import connection
+from django.test import override_settings
+from django.test.utils import CaptureQueriesContext
+from chat import cache as chat_cache, ephemeral, fanout, membership, metrics, middlewares, presence, ratelimit, rooms, unread
+
+try:
+    import fakeredis
+    import lupa  # noqa: F401 - fakeredis needs it to run Lua scripts
+except ImportError:
+    fakeredis = None
+
+requires_fakeredis = skipUnless(fakeredis, 'fakeredis[lua] is not installed')
+
+
+class QueryBudgetMixin:
+    '''
+    Adds assertQueryBudget to a TestCase. Unlike assertNumQueries it allows fewer
+    queries than the budget, so endpoints can get cheaper without touching tests.
+    '''
+
+    @contextmanager
+    def assertQueryBudget(self, budget):
+        with CaptureQueriesContext(connection) as context:
+            yield context
+        executed = len(context.captured_queries)
+        if executed > budget:
+            queries = '\n'.join(f'{i}. {query["sql"]}' for i, query in enumerate(context.captured_queries, start=1))
+            self.fail(f'{executed} queries executed, budget is {budget}:\n{queries}')
+
+
+class ChatCacheMixin:
+    '''
+    Clears chat's in-process caches before each test. Rows rolled back between
+    tests never fire the invalidation signals, and primary keys get reused.
+    '''
+
+    def _pre_setup(self):
+        super()._pre_setup()
+        membership.clear()
+        rooms.clear()
+        middlewares.clear()
+        presence._local_store.clear()
+        presence.notifier.take()
+        ephemeral.coalescer.clear()
+        unread._local_store.clear()
+        ratelimit._local_store.clear()
+        metrics.clear()
+        fanout.publisher.clear()
+        cache.clear()
+
+
+class FakeRedisMixin:
+    '''
+    Points chat's Redis client at a fresh in-memory fakeredis server, so the
+    Redis-backed stores run instead of their per-process stand-ins. Decorate the
+    TestCase with @requires_fakeredis.
+    '''
+
+    def _pre_setup(self):
+        super()._pre_setup()
+        self.redis = fakeredis.FakeRedis()
+        self.redis_url = override_settings(REDIS_URL='redis://fakeredis')
+        self.redis_url.enable()
+        self.redis_client = mock.patch.object(chat_cache, '_redis', self.redis)
+        self.redis_client.start()
+
+    def _post_teardown(self):
+        self.redis_client.stop()
+        self.redis_url.disable()
+        super()._post_teardown()
@@ -0,0 +1,182 @@
+import logging
+import threading
+from .cache import REDIS_ERRORS, get_redis
+from .models import Message, ReadCursor
+
+logger = logging.getLogger(__name__)
+
+
+def seq_key(room_pk):
+    return f'chat:room:{room_pk}:seq'
+
+
+def read_key(user_pk):
+    return f'chat:user:{user_pk}:read'
+
+
+# Bump the room's message counter and mark the sender as caught up, in one round trip
+BUMP_SCRIPT = '''
+local seq = redis.call('INCR', KEYS[1])
+redis.call('HSET', KEYS[2], ARGV[1], seq)
+return seq
+'''
+
+# Mark every user whose read hash is given as caught up with the room
+MARK_READ_SCRIPT = '''
+local seq = redis.call('GET', KEYS[1]) or 0
+for i = 2, #KEYS do
+    redis.call('HSET', KEYS[i], ARGV[1], seq)
+end
+return seq
+'''
+
+
+class RedisUnreadStore:
+    '''
+    Unread counts kept incrementally in Redis, shared by every worker.
+
+    Each room has a counter bumped once per message, and each user has a hash of
+    room id -> counter value when they last read it. A user's unread count for a
+    room is the difference, so sending a message is O(1) regardless of how many
+    members the room has, and no count is ever computed over the message table.
+    '''
+
+    def __init__(self, client):
+        self.client = client
+
+    def bump(self, room_pk, sender_pk):
+        return int(self.client.eval(BUMP_SCRIPT, 2, seq_key(room_pk), read_key(sender_pk), room_pk))
+
+    def mark_read(self, room_pk, user_pks):
+        if user_pks:
+            self.client.eval(MARK_READ_SCRIPT, 1 + len(user_pks), seq_key(room_pk),
+                             *[read_key(user_pk) for user_pk in user_pks], room_pk)
+
+    def read_up_to(self, room_pk, user_pk, seq):
+        self.client.hset(read_key(user_pk), room_pk, seq)
+
+    def counts(self, user_pk, room_pks):
+        if not room_pks:
+            return {}
+        pipe = self.client.pipeline(transaction=False)
+        pipe.hmget(read_key(user_pk), room_pks)
+        pipe.mget([seq_key(room_pk) for room_pk in room_pks])
+        read, seqs = pipe.execute()
+        return {
+            room_pk: max(0, int(seq or 0) - int(last_read or 0))
+            for room_pk, last_read, seq in zip(room_pks, read, seqs)
+        }
+
+    def forget(self, room_pk):
+        self.client.delete(seq_key(room_pk))
+
+
+class LocalUnreadStore:
+    '''Per-process stand-in for RedisUnreadStore when REDIS_URL is not configured.'''
+
+    def __init__(self):
+        self.seqs = {}
+        self.read = {}
+        self.lock = threading.Lock()
+
+    def bump(self, room_pk, sender_pk):
+        with self.lock:
+            seq = self.seqs[room_pk] = self.seqs.get(room_pk, 0) + 1
+            self.read[(sender_pk, room_pk)] = seq
+            return seq
+
+    def mark_read(self, room_pk, user_pks):
+        with self.lock:
+            seq = self.seqs.get(room_pk, 0)
+            for user_pk in user_pks:
+                self.read[(user_pk, room_pk)] = seq
+
+    def read_up_to(self, room_pk, user_pk, seq):
+        with self.lock:
+            self.read[(user_pk, room_pk)] = seq
+
+    def counts(self, user_pk, room_pks):
+        with self.lock:
+            return {
+                room_pk: max(0, self.seqs.get(room_pk, 0) - self.read.get((user_pk, room_pk), 0))
+                for room_pk in room_pks
+            }
+
+    def forget(self, room_pk):
+        with self.lock:
+            self.seqs.pop(room_pk, None)
+
+    def clear(self):
+        with self.lock:
+            self.seqs.clear()
+            self.read.clear()
+
+
+_local_store = LocalUnreadStore()
+
+
+def get_store():
+    client = get_redis()
+    if client is None:
+        return _local_store
+    return RedisUnreadStore(client)
+
+
+# Unread counts are a convenience: Redis trouble is logged, never raised to the sender or reader
+
+def message_created(message):
+    '''The room's counter value for the new message, or None if it could not be bumped'''
+    try:
+        return get_store().bump(message.room_id, message.sender_id)
+    except REDIS_ERRORS:
+        logger.warning('Could not bump unread counter for room %s', message.room_id, exc_info=True)
+        return None
+
+
+def members_added(room_pk, user_pks):
+    '''New members start with nothing unread'''
+    try:
+        get_store().mark_read(room_pk, list(user_pks))
+    except REDIS_ERRORS:
+        logger.warning('Could not reset unread counters for room %s', room_pk, exc_info=True)
+
+
+def room_deleted(room_pk):
+    try:
+        get_store().forget(room_pk)
+    except REDIS_ERRORS:
+        logger.warning('Could not drop unread counter for room %s', room_pk, exc_info=True)
+
+
+def read_message(room, message_id):
+    '''The message's fields needed to mark it read, or None if it is not in the room's history'''
+    return Message.objects.history(room).filter(message_id=message_id).values('seq').first()
+
+
+def mark_read(room, user, message_id):
+    '''
+    Move the user's read cursor to message_id, leaving the messages from others
+    sent after it unread. Returns None if the message is not in the room.
+    '''
+    message = read_message(room, message_id)
+    if message is None:
+        return None
+    try:
+        if message['seq'] is None:
+            # Sent while the counter was unavailable: treat it as the latest message
+            get_store().mark_read(room.pk, [user.pk])
+        else:
+            get_store().read_up_to(room.pk, user.pk, message['seq'])
+    except REDIS_ERRORS:
+        logger.warning('Could not move unread counter for room %s', room.pk, exc_info=True)
+    cursor, _ = ReadCursor.objects.update_or_create(room_id=room.pk, user_id=user.pk, defaults={'message_id': message_id})
+    return cursor
+
+
+def unread_counts(user, room_pks):
+    '''Unread count per room for one user, in a single lookup. Empty if Redis is down.'''
+    try:
+        return get_store().counts(user.pk, list(room_pks))
+    except REDIS_ERRORS:
+        logger.warning('Could not load unread counts for user %s', user.pk, exc_info=True)
+        return {}
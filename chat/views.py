@@ -1,19 +1,32 @@
+import os
+from datetime import datetime, timezone
+from django.conf import settings
 from django.contrib.auth import get_user_model
+from django.http import Http404, HttpResponse, StreamingHttpResponse
 from django.shortcuts import get_object_or_404
+from rest_framework import generics
 from rest_framework.decorators import action
 from rest_framework import status
 from rest_framework.permissions import IsAdminUser, IsAuthenticated, AllowAny
 from rest_framework.viewsets import ModelViewSet
 from rest_framework.response import Response
-from asgiref.sync import async_to_sync
-from channels.layers import get_channel_layer
-from .models import ChatRoom
-from .serializers import ChatRoomSerializer, CreateChatRoomSerializer,  AddUserToRoomSerializer, MemberSerializer, ChatRoomMemberSerializer, SendChatSerializer, MessageSerializer
+from asgiref.sync import async_to_sync, sync_to_async
+from .models import ChatRoom, Message, ReadCursor
+from .serializers import ChatRoomSerializer, CreateChatRoomSerializer,  AddUserToRoomSerializer, MemberSerializer, ChatRoomMemberSerializer, SendChatSerializer, MessageSerializer, ReadCursorSerializer, ProfileSerializer
 from .permissions import IsChatRoomCreator, CanAdduser, GetMember, ChatRoomMember
+from .pagination import MessageCursorPagination, MessageSearchPagination, PresencePagination
+from .ratelimit import SendRateThrottle
+from .search import MessageSearch
+from .presence import OnlineUsers
+from .events import chat_message_event
+from .fanout import fan_out
+from .export import FORMATS, export_lines, stream_lines
+from .profiler import ProfilerBusy, profiler
+from . import rooms
 
 
 class ChatRoomViewSet(ModelViewSet):
-    queryset = ChatRoom.objects.all()
+    queryset = ChatRoom.objects.with_listing_data()
     serializer_class = ChatRoomSerializer
     lookup_field = 'room_id'
     permission_classes  = [IsAuthenticated]
@@ -21,6 +34,38 @@ class ChatRoomViewSet(ModelViewSet):
     def get_serializer_context(self):
         return super().get_serializer_context()
 
+    def get_room(self):
+        '''
+        The room named in the URL, loaded once per request. Permissions, actions
+        and serializers all share this instance. Outside the CRUD actions it
+        comes from the room cache, so only its id, name and creator_id are loaded.
+        '''
+        if not hasattr(self, '_room'):
+            if self.action in ['retrieve', 'update', 'partial_update', 'destroy']:
+                self._room = generics.get_object_or_404(self.get_queryset(), room_id=self.kwargs['room_id'])
+            else:
+                self._room = rooms.get_room(self.kwargs['room_id'])
+                if self._room is None:
+                    raise Http404
+        return self._room
+
+    def on_loop(self, function, *args):
+        '''
+        Run the coroutine function `function(*args)` on the event loop. Under
+        chat_view it is awaited there once the sync part of the request is done;
+        otherwise async_to_sync holds this thread until it finishes.
+        '''
+        pending = getattr(self.request, 'pending_async', None)
+        if pending is None:
+            async_to_sync(function)(*args)
+        else:
+            pending.append((function, args))
+
+    def get_object(self):
+        room = self.get_room()
+        self.check_object_permissions(self.request, room)
+        return room
+
     def get_serializer_class(self):
         if self.action == 'create':
             return CreateChatRoomSerializer
@@ -35,7 +80,7 @@ class ChatRoomViewSet(ModelViewSet):
 
     @action(detail=True, methods=['post'], permission_classes=[CanAdduser], serializer_class=AddUserToRoomSerializer)
     def add_member(self, request, **kwargs):
-        serializer = AddUserToRoomSerializer(data=request.data, context={'room_id':self.kwargs['room_id']})
+        serializer = AddUserToRoomSerializer(data=request.data, context={'room':self.get_room()})
         serializer.is_valid(raise_exception=True)
         serializer.save()
         return Response(serializer.data, status=status.HTTP_201_CREATED)
@@ -43,9 +88,7 @@ class ChatRoomViewSet(ModelViewSet):
 
     @action(detail=True, permission_classes=[IsChatRoomCreator])
     def get_members(self, request, **kwargs):
-        room_id = self.kwargs['room_id']
-        members = ChatRoom.objects.get(room_id=room_id)
-        serializer = MemberSerializer(members)
+        serializer = MemberSerializer(self.get_room())
         return Response(serializer.data)
 
 
@@ -60,38 +103,156 @@ class ChatRoomViewSet(ModelViewSet):
             return Response(serializer.data, status=status.HTTP_200_OK)
 
         if request.method == 'DELETE':
-            if user == chat_room.creator:
+            if user.pk == chat_room.creator_id:
                 return Response({'detail': 'Chat room creator cannot be removed'}, status=status.HTTP_400_BAD_REQUEST)
             chat_room.members.remove(user)
             return Response({'detail': 'User removed successfully'}, status=status.HTTP_204_NO_CONTENT)
 
-    @action(detail=True, methods=['get', 'post'], permission_classes=[ChatRoomMember], serializer_class=SendChatSerializer)
+    @action(detail=True, methods=['get', 'post'], permission_classes=[ChatRoomMember], serializer_class=SendChatSerializer,
+            throttle_classes=[SendRateThrottle])
     def chat(self, request, **kwargs):
-        room = get_object_or_404(ChatRoom, room_id=self.kwargs['room_id'])
+        room = self.get_room()
 
-        channel_room_name = room.room_name.replace(' ', '-').lower()[:99]
         if request.method ==  'GET':
-            channel_layer = get_channel_layer()
-            async_to_sync(channel_layer.group_send)(
-                        f'chat_{channel_room_name}', 
-                        {"type": "send_info_to_user_group",
-                        "text": {"message": f"{request.user.username} joined chat"}})
+            # Not announced: presence follows WebSocket connections, which also
+            # report leaving, and a REST call has no connection to follow
             return Response({'success': 'User joined chat'}, status=status.HTTP_200_OK)
 
         if request.method == 'POST':
-            serializer = SendChatSerializer(data=request.data, context={'room_id':self.kwargs['room_id'], 'user':request.user})
+            serializer = SendChatSerializer(data=request.data, context={'room':room, 'user':request.user})
             serializer.is_valid(raise_exception=True)
             message = serializer.save()
-            socket_message = f"Message with id {message.id} was created!"
-            channel_layer = get_channel_layer()
-            async_to_sync(channel_layer.group_send)(
-                f'chat_{channel_room_name}', 
-                {
-                    'type': 'chat_message', 
-                    'message': socket_message,
-                    'message_id': str(message.message_id),
-                    'user': request.user.username,
-                    'room_name': room.room_name
-                }
-            )
-            return Response(MessageSerializer(message).data, status=status.HTTP_201_CREATED)
\ No newline at end of file
+            self.on_loop(fan_out, room, chat_message_event(message))
+            return Response(MessageSerializer(message).data, status=status.HTTP_201_CREATED)
+
+    @action(detail=True, methods=['get'], permission_classes=[ChatRoomMember], serializer_class=MessageSerializer,
+            pagination_class=MessageCursorPagination)
+    def messages(self, request, **kwargs):
+        queryset = Message.objects.history(self.get_room()).select_related('sender', 'room')
+        page = self.paginate_queryset(queryset)
+        serializer = MessageSerializer(page, many=True)
+        return self.get_paginated_response(serializer.data)
+
+    @action(detail=True, methods=['get'], permission_classes=[ChatRoomMember])
+    def export(self, request, **kwargs):
+        # Not `format`, which DRF reserves for choosing a renderer
+        output = request.query_params.get('output', 'ndjson')
+        if output not in FORMATS:
+            return Response({'output': f'Choose one of: {", ".join(FORMATS)}.'}, status=status.HTTP_400_BAD_REQUEST)
+        room = self.get_room()
+        lines = export_lines(room, output, settings.CHAT_EXPORT_BATCH_SIZE)
+        response = StreamingHttpResponse(stream_lines(lines), content_type=FORMATS[output])
+        response['Content-Disposition'] = f'attachment; filename="room-{room.room_id}.{output}"'
+        return response
+
+    @action(detail=True, methods=['get'], url_path='messages/search', url_name='messages-search', permission_classes=[ChatRoomMember],
+            serializer_class=MessageSerializer, pagination_class=MessageSearchPagination)
+    def search_messages(self, request, **kwargs):
+        query = request.query_params.get('q', '').strip()
+        if not query:
+            return Response({'q': 'A search query is required.'}, status=status.HTTP_400_BAD_REQUEST)
+        page = self.paginate_queryset(MessageSearch(self.get_room(), query))
+        serializer = MessageSerializer(page, many=True)
+        return self.get_paginated_response(serializer.data)
+
+    @action(detail=True, methods=['get', 'post'], permission_classes=[ChatRoomMember], serializer_class=ReadCursorSerializer)
+    def read(self, request, **kwargs):
+        room = self.get_room()
+
+        if request.method == 'GET':
+            cursors = ReadCursor.objects.filter(room_id=room.pk).select_related('user').order_by('-read_at')
+            return Response(ReadCursorSerializer(cursors, many=True).data, status=status.HTTP_200_OK)
+
+        if request.method == 'POST':
+            serializer = ReadCursorSerializer(data=request.data, context={'room': room, 'user': request.user})
+            serializer.is_valid(raise_exception=True)
+            serializer.save()
+            return Response(serializer.data, status=status.HTTP_200_OK)
+
+    @action(detail=True, methods=['get'], permission_classes=[ChatRoomMember], pagination_class=PresencePagination)
+    def presence(self, request, **kwargs):
+        page = self.paginate_queryset(OnlineUsers(self.get_room().pk))
+        usernames = dict(get_user_model().objects.filter(id__in=[user_pk for user_pk, _ in page]).values_list('id', 'username'))
+        results = [
+            {
+                'user_id': user_pk,
+                'username': usernames[user_pk],
+                'last_seen': datetime.fromtimestamp(last_seen, tz=timezone.utc).isoformat(),
+            }
+            for user_pk, last_seen in page if user_pk in usernames
+        ]
+        return self.get_paginated_response(results)
+
+
+sync_chat_view = ChatRoomViewSet.as_view(
+    {'get': 'chat', 'post': 'chat'}, basename='chatroom', detail=True, **ChatRoomViewSet.chat.kwargs,
+)
+
+
+class RenderedResponse(HttpResponse):
+    '''
+    A DRF Response rendered in the view's thread. It has no render(), so Django
+    doesn't hop to a thread again just to render it; `data` is kept for tests.
+    '''
+
+    def __init__(self, response):
+        response.render()
+        super().__init__(response.content, status=response.status_code)
+        for header, value in response.items():
+            self[header] = value
+        self.data = response.data
+
+
+def render_view(view, request, **kwargs):
+    response = view(request, **kwargs)
+    return RenderedResponse(response) if isinstance(response, Response) else response
+
+
+async def chat_view(request, room_id):
+    '''
+    ChatRoomViewSet.chat as an async view, routed ahead of the viewset. The
+    sync part (authentication, permissions, throttling, validation, the INSERT
+    and rendering) runs in one sync_to_async call; the broadcast is then
+    awaited natively instead of a thread blocking in async_to_sync.
+    '''
+    if not settings.CHAT_ASYNC_VIEWS:
+        return await sync_to_async(sync_chat_view)(request, room_id=room_id)
+    request.pending_async = []
+    response = await sync_to_async(render_view)(sync_chat_view, request, room_id=room_id)
+    for function, args in request.pending_async:
+        await function(*args)
+    return response
+
+# DRF views are CSRF exempt; csrf_exempt() itself only wraps sync views in Django 4.2
+chat_view.csrf_exempt = True
+
+
+class ProfilerView(generics.GenericAPIView):
+    '''
+    Sampling profiler for the worker that serves the request (staff only, needs
+    CHAT_PROFILER). POST starts a time-boxed profile; GET returns the last one
+    as collapsed stacks.
+    '''
+    serializer_class = ProfileSerializer
+    permission_classes = [IsAdminUser]
+
+    def initial(self, request, *args, **kwargs):
+        if not settings.CHAT_PROFILER:
+            raise Http404()
+        super().initial(request, *args, **kwargs)
+
+    def get(self, request):
+        if profiler.last_path is None or not os.path.exists(profiler.last_path):
+            return Response({'detail': 'No profile has been captured by this worker yet.'}, status=status.HTTP_404_NOT_FOUND)
+        with open(profiler.last_path, encoding='utf-8') as profile:
+            return HttpResponse(profile.read(), content_type='text/plain; charset=utf-8')
+
+    def post(self, request):
+        serializer = self.get_serializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        seconds = serializer.validated_data.get('seconds', settings.CHAT_PROFILER_SECONDS)
+        try:
+            path = profiler.start(seconds, serializer.validated_data.get('interval'))
+        except ProfilerBusy as error:
+            return Response({'detail': str(error)}, status=status.HTTP_409_CONFLICT)
+        return Response({'pid': os.getpid(), 'seconds': seconds, 'path': path}, status=status.HTTP_202_ACCEPTED)
@@ -0,0 +1,228 @@
+import atexit
+import json
+import logging
+import os
+import queue
+import re
+import threading
+import time
+from django.conf import settings
+from django.db import close_old_connections, connection
+from django.utils import timezone
+from rest_framework import status
+from rest_framework.exceptions import APIException
+from .models import Message
+
+logger = logging.getLogger(__name__)
+
+
+class BufferFull(APIException):
+    status_code = status.HTTP_503_SERVICE_UNAVAILABLE
+    default_detail = 'Message queue is full, try again shortly.'
+    default_code = 'buffer_full'
+
+
+class MessageBuffer:
+    '''
+    Write-behind buffer for chat messages.
+
+    Messages are given their message_id up front and handed back to the caller
+    immediately; a background thread persists them with bulk_create every
+    `batch_size` messages or `flush_interval` seconds, whichever comes first.
+    When a journal path is set each process appends its queued messages to its
+    own journal, `<path>.<pid>`. `recover()` replays the journals of processes
+    that are no longer running. Batches that still fail after `max_retries` are
+    moved to `<path>.dead` for manual replay.
+    '''
+
+    def __init__(self, batch_size=100, flush_interval=0.05, max_pending=10000,
+                 enqueue_timeout=1.0, journal_path=None, max_retries=3):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.enqueue_timeout = enqueue_timeout
+        self.journal_base = journal_path
+        self.journal_path = f'{journal_path}.{os.getpid()}' if journal_path else None
+        self.max_retries = max_retries
+        self.queue = queue.Queue(maxsize=max_pending)
+        self.pending = 0
+        self.journal_lock = threading.Lock()
+        self.flush_lock = threading.Lock()
+        self.stopping = threading.Event()
+        self.thread = None
+
+    def start(self):
+        if self.thread is not None:
+            return
+        self.recover()
+        self.thread = threading.Thread(target=self.run, name='chat-write-behind', daemon=True)
+        self.thread.start()
+        atexit.register(self.close)
+
+    def close(self):
+        '''Stop the worker and flush whatever is still queued.'''
+        self.stopping.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        self.flush()
+
+    def enqueue(self, message):
+        if message.date_sent is None:
+            message.date_sent = timezone.now()
+        try:
+            self.queue.put(message, timeout=self.enqueue_timeout)
+        except queue.Full:
+            raise BufferFull()
+        # Journalled only once queued, so a message refused with BufferFull is never replayed
+        with self.journal_lock:
+            self.pending += 1
+            self.write_journal(message)
+        return message
+
+    def run(self):
+        try:
+            while not self.stopping.is_set():
+                batch = self.next_batch()
+                if batch:
+                    self.save(batch)
+        finally:
+            connection.close()
+
+    def next_batch(self):
+        '''Block for the first message, then collect until the batch is full or the interval ends.'''
+        try:
+            batch = [self.queue.get(timeout=self.flush_interval)]
+        except queue.Empty:
+            return []
+        deadline = time.monotonic() + self.flush_interval
+        while len(batch) < self.batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self.queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def flush(self):
+        '''Persist everything currently queued from the calling thread.'''
+        while True:
+            batch = []
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            if not batch:
+                return
+            self.save(batch)
+
+    def save(self, batch):
+        with self.flush_lock:
+            for attempt in range(1, self.max_retries + 1):
+                close_old_connections()
+                try:
+                    Message.objects.bulk_create(batch, batch_size=self.batch_size)
+                    break
+                except Exception:
+                    logger.exception('Write-behind flush of %s messages failed (attempt %s)', len(batch), attempt)
+                    if attempt < self.max_retries:
+                        time.sleep(min(0.1 * 2 ** attempt, 2))
+            else:
+                logger.error('Dropping %s messages from the write-behind queue', len(batch))
+                self.write_dead_letters(batch)
+            with self.journal_lock:
+                self.pending -= len(batch)
+                if not self.pending and self.journal_path:
+                    open(self.journal_path, 'w').close()
+
+    def journal_entry(self, message):
+        return json.dumps({
+            'message_id': str(message.message_id),
+            'content': message.content,
+            'sender_id': message.sender_id,
+            'room_id': message.room_id,
+            'date_sent': message.date_sent.isoformat(),
+            'seq': message.seq,
+        }) + '\n'
+
+    def write_journal(self, message):
+        if not self.journal_path:
+            return
+        with open(self.journal_path, 'a') as journal:
+            journal.write(self.journal_entry(message))
+
+    def write_dead_letters(self, batch):
+        '''Keep a batch that could not be saved; the journal is truncated without it'''
+        if not self.journal_base:
+            return
+        with open(f'{self.journal_base}.dead', 'a') as dead_letters:
+            dead_letters.write(''.join(self.journal_entry(message) for message in batch))
+
+    def orphaned_journals(self):
+        '''Journals left by processes that are no longer running, this process's included'''
+        directory, name = os.path.split(os.path.abspath(self.journal_base))
+        pattern = re.compile(rf'{re.escape(name)}\.(\d+)$')
+        for filename in os.listdir(directory):
+            match = pattern.match(filename)
+            if match and (int(match.group(1)) == os.getpid() or not process_alive(int(match.group(1)))):
+                yield os.path.join(directory, filename)
+
+    def recover(self):
+        '''Replay journalled messages that never made it to the database.'''
+        if not self.journal_base or not os.path.isdir(os.path.dirname(os.path.abspath(self.journal_base))):
+            return 0
+        recovered = 0
+        for path in self.orphaned_journals():
+            # Claimed by renaming, so workers starting together don't both replay it
+            claimed = f'{path}.recovering.{os.getpid()}'
+            try:
+                os.rename(path, claimed)
+            except FileNotFoundError:
+                continue
+            recovered += self.replay(claimed)
+            os.remove(claimed)
+        if recovered:
+            logger.warning('Recovered %s messages from the write-behind journal', recovered)
+        return recovered
+
+    def replay(self, path):
+        with open(path) as journal:
+            entries = [json.loads(line) for line in journal if line.strip()]
+        saved = set(
+            str(message_id) for message_id in Message.objects.filter(
+                message_id__in=[entry['message_id'] for entry in entries]
+            ).values_list('message_id', flat=True)
+        )
+        missing = [Message(**entry) for entry in entries if entry['message_id'] not in saved]
+        Message.objects.bulk_create(missing, batch_size=self.batch_size)
+        return len(missing)
+
+
+def process_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+_buffer = None
+_buffer_lock = threading.Lock()
+
+
+def get_message_buffer():
+    global _buffer
+    with _buffer_lock:
+        if _buffer is None:
+            _buffer = MessageBuffer(
+                batch_size=settings.CHAT_WRITE_BEHIND_BATCH_SIZE,
+                flush_interval=settings.CHAT_WRITE_BEHIND_FLUSH_INTERVAL,
+                max_pending=settings.CHAT_WRITE_BEHIND_MAX_PENDING,
+                journal_path=settings.CHAT_WRITE_BEHIND_JOURNAL,
+            )
+            _buffer.start()
+        return _buffer
@@ -8,6 +8,7 @@ https://docs.djangoproject.com/en/4.2/howto/deployment/asgi/
 """
 
 import os
+from django.conf import settings
 from channels.auth import AuthMiddlewareStack
 from channels.routing import ProtocolTypeRouter, URLRouter
 from django.core.asgi import get_asgi_application
@@ -16,10 +17,19 @@ from chat.middlewares import JWTAuthMiddleware
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'chatAPI.settings')
 
 from chat.routing import websocket_urlpatterns
+from chat.metrics import WebSocketMetrics
+from chat.profiler import install_signal_handler
 
 django_asgi_app = get_asgi_application()
 
+websocket_app = JWTAuthMiddleware(URLRouter(websocket_urlpatterns))
+if settings.CHAT_METRICS:
+    websocket_app = WebSocketMetrics(websocket_app, websocket_urlpatterns)
+
+if settings.CHAT_PROFILER:
+    install_signal_handler()
+
 application = ProtocolTypeRouter({
     'http':get_asgi_application(),
-    'websocket': JWTAuthMiddleware(URLRouter(websocket_urlpatterns))
-})
\ No newline at end of file
+    'websocket': websocket_app
+})
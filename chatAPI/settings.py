@@ -90,14 +90,58 @@ WSGI_APPLICATION = 'chatAPI.wsgi.application'
 # Database
 # https://docs.djangoproject.com/en/4.2/ref/settings/#databases
 
-DATABASES = {
-    'default': {
-        'ENGINE': 'django.db.backends.sqlite3',
-        'NAME': BASE_DIR / 'db.sqlite3',
-        "TEST": {
-            "NAME": os.path.join(BASE_DIR, "db_test.sqlite3"),
-        },
+# SQLite unless DB_ENGINE=postgresql. Tests use SQLite by default too.
+DB_ENGINE = config('DB_ENGINE', default='sqlite3')
+
+if DB_ENGINE == 'postgresql':
+    DATABASES = {
+        'default': {
+            'ENGINE': 'django.db.backends.postgresql',
+            'NAME': config('DB_NAME', default='chatapi'),
+            'USER': config('DB_USER', default='chatapi'),
+            'PASSWORD': config('DB_PASSWORD', default=''),
+            'HOST': config('DB_HOST', default='localhost'),
+            'PORT': config('DB_PORT', default='5432'),
+            # Close connections after each request by default. Under ASGI every
+            # request runs sync code in its own thread-sensitive context, so a
+            # persistent connection is opened per context and not reused by the
+            # next request. Pool with an external pooler such as PgBouncer instead,
+            # and only raise this when Django talks to that pooler.
+            'CONN_MAX_AGE': config('DB_CONN_MAX_AGE', cast=int, default=0),
+            'CONN_HEALTH_CHECKS': config('DB_CONN_HEALTH_CHECKS', cast=bool, default=True),
+            # Set when connecting through PgBouncer in transaction pooling mode,
+            # which cannot keep server-side cursors open across transactions.
+            # It does not pool anything itself.
+            'DISABLE_SERVER_SIDE_CURSORS': config('DB_PGBOUNCER', cast=bool, default=False),
+            'OPTIONS': {
+                'connect_timeout': config('DB_CONNECT_TIMEOUT', cast=int, default=5),
+                'sslmode': config('DB_SSLMODE', default='prefer'),
+            },
+        }
+    }
+else:
+    DATABASES = {
+        'default': {
+            'ENGINE': 'django.db.backends.sqlite3',
+            'NAME': config('DB_NAME', default=BASE_DIR / 'db.sqlite3'),
+            "TEST": {
+                "NAME": os.path.join(BASE_DIR, "db_test.sqlite3"),
+            },
+        }
     }
+
+# Applied to every new SQLite connection (see chat/signals.py), except
+# journal_mode, which the database file keeps and is set once. WAL lets history
+# reads run alongside a writer, synchronous=NORMAL is durable in WAL mode short of
+# power loss, and busy_timeout makes writers wait for the lock instead of failing.
+# cache_size is in KiB when negative. Set a value to an empty string to keep
+# SQLite's default for it.
+SQLITE_PRAGMAS = {
+    'journal_mode': config('DB_SQLITE_JOURNAL_MODE', default='WAL'),
+    'synchronous': config('DB_SQLITE_SYNCHRONOUS', default='NORMAL'),
+    'cache_size': config('DB_SQLITE_CACHE_SIZE', default='-20000'),
+    'mmap_size': config('DB_SQLITE_MMAP_SIZE', default='134217728'),
+    'busy_timeout': config('DB_SQLITE_BUSY_TIMEOUT', default='5000'),
 }
 
 
@@ -169,4 +213,116 @@ CHANNEL_LAYERS = {
             "hosts": [("127.0.0.1", 6379)],
         },
     },
-}
\ No newline at end of file
+}
+
+# Cache
+# With REDIS_URL set, Django's cache and chat's room/membership cache live in Redis
+# and are shared by every worker. Without it each process only caches locally.
+REDIS_URL = config('REDIS_URL', default='')
+
+if REDIS_URL:
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+            'LOCATION': REDIS_URL,
+        }
+    }
+else:
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        }
+    }
+
+# Chat
+CHAT_HISTORY_PAGE_SIZE = config('CHAT_HISTORY_PAGE_SIZE', cast=int, default=50)
+CHAT_HISTORY_MAX_PAGE_SIZE = config('CHAT_HISTORY_MAX_PAGE_SIZE', cast=int, default=200)
+
+# Write-behind message persistence: messages are acknowledged and broadcast
+# immediately and saved in batches by a background thread. With a journal path,
+# each worker journals to <path>.<pid>, journals of stopped workers are replayed
+# on startup, and batches that cannot be saved are kept in <path>.dead.
+CHAT_WRITE_BEHIND = config('CHAT_WRITE_BEHIND', cast=bool, default=False)
+CHAT_WRITE_BEHIND_BATCH_SIZE = config('CHAT_WRITE_BEHIND_BATCH_SIZE', cast=int, default=100)
+CHAT_WRITE_BEHIND_FLUSH_INTERVAL = config('CHAT_WRITE_BEHIND_FLUSH_INTERVAL', cast=float, default=0.05)
+CHAT_WRITE_BEHIND_MAX_PENDING = config('CHAT_WRITE_BEHIND_MAX_PENDING', cast=int, default=10000)
+CHAT_WRITE_BEHIND_JOURNAL = config('CHAT_WRITE_BEHIND_JOURNAL', default=None)
+
+# Room metadata and membership caching. The local tier is per process and kept
+# short lived; Redis holds room metadata and member ID sets for all workers.
+CHAT_MEMBERSHIP_CACHE_SIZE = config('CHAT_MEMBERSHIP_CACHE_SIZE', cast=int, default=100000)
+CHAT_MEMBERSHIP_CACHE_TTL = config('CHAT_MEMBERSHIP_CACHE_TTL', cast=float, default=5)
+CHAT_ROOM_CACHE_TTL = config('CHAT_ROOM_CACHE_TTL', cast=int, default=3600)
+CHAT_REDIS_SOCKET_TIMEOUT = config('CHAT_REDIS_SOCKET_TIMEOUT', cast=float, default=0.5)
+
+# WebSocket authentication: users resolved from JWTs are cached per process.
+# Deactivating or deleting a user only evicts them in the worker that saved the
+# change, so other workers keep admitting them for up to CHAT_AUTH_CACHE_TTL.
+CHAT_AUTH_CACHE_SIZE = config('CHAT_AUTH_CACHE_SIZE', cast=int, default=50000)
+CHAT_AUTH_CACHE_TTL = config('CHAT_AUTH_CACHE_TTL', cast=float, default=5)
+
+# Room groups are named after room_id. Turn this on for the duration of a rolling
+# deploy from a release that used name-based groups, then turn it off again.
+CHAT_LEGACY_GROUP_NAMES = config('CHAT_LEGACY_GROUP_NAMES', cast=bool, default=False)
+
+# Presence: sockets send heartbeats every CHAT_PRESENCE_HEARTBEAT seconds and are
+# considered gone CHAT_PRESENCE_TTL seconds after the last one. Join/leave
+# notifications are batched into one diff per room every CHAT_PRESENCE_DIFF_INTERVAL.
+CHAT_PRESENCE_TTL = config('CHAT_PRESENCE_TTL', cast=float, default=60)
+CHAT_PRESENCE_HEARTBEAT = config('CHAT_PRESENCE_HEARTBEAT', cast=float, default=20)
+CHAT_PRESENCE_DIFF_INTERVAL = config('CHAT_PRESENCE_DIFF_INTERVAL', cast=float, default=2)
+
+# Typing and read-cursor events go out at most once per user per room every
+# CHAT_EPHEMERAL_WINDOW seconds; the latest change within a window is sent at its end.
+CHAT_EPHEMERAL_WINDOW = config('CHAT_EPHEMERAL_WINDOW', cast=float, default=3)
+
+# Message send rate limits (token buckets): messages per second and burst size
+# per user, per room and per WebSocket connection. A rate of 0 turns a limit off.
+# User and room buckets are shared through Redis when REDIS_URL is set.
+CHAT_SEND_RATE_PER_USER = config('CHAT_SEND_RATE_PER_USER', cast=float, default=5)
+CHAT_SEND_BURST_PER_USER = config('CHAT_SEND_BURST_PER_USER', cast=int, default=20)
+CHAT_SEND_RATE_PER_ROOM = config('CHAT_SEND_RATE_PER_ROOM', cast=float, default=30)
+CHAT_SEND_BURST_PER_ROOM = config('CHAT_SEND_BURST_PER_ROOM', cast=int, default=100)
+CHAT_SEND_RATE_PER_CONNECTION = config('CHAT_SEND_RATE_PER_CONNECTION', cast=float, default=3)
+CHAT_SEND_BURST_PER_CONNECTION = config('CHAT_SEND_BURST_PER_CONNECTION', cast=int, default=10)
+
+# Retention: messages older than this many days are archived and deleted by
+# `manage.py archive_messages`. Rooms can override it; 0 keeps messages forever.
+CHAT_RETENTION_DAYS = config('CHAT_RETENTION_DAYS', cast=int, default=0)
+CHAT_ARCHIVE_DIR = config('CHAT_ARCHIVE_DIR', default=os.path.join(BASE_DIR, 'archive'))
+
+# Rows fetched per query when exporting a room's history
+CHAT_EXPORT_BATCH_SIZE = config('CHAT_EXPORT_BATCH_SIZE', cast=int, default=2000)
+
+# Metrics: per-route latency, database queries and group_send timing, served in
+# Prometheus format at /metrics to staff sessions, or to scrapers sending the
+# CHAT_METRICS_TOKEN bearer token when that is set.
+CHAT_METRICS = config('CHAT_METRICS', cast=bool, default=False)
+CHAT_METRICS_TOKEN = config('CHAT_METRICS_TOKEN', default='')
+if CHAT_METRICS:
+    MIDDLEWARE.insert(0, 'chat.metrics.MetricsMiddleware')
+
+# Sampling profiler: staff can POST to /api/v1/profiler/, or send the worker
+# CHAT_PROFILER_SIGNAL, to record every thread's stacks for a few seconds. The
+# collapsed-stack output lands in CHAT_PROFILER_DIR, ready for flamegraph.pl.
+CHAT_PROFILER = config('CHAT_PROFILER', cast=bool, default=False)
+CHAT_PROFILER_SIGNAL = config('CHAT_PROFILER_SIGNAL', default='SIGUSR2')
+CHAT_PROFILER_SECONDS = config('CHAT_PROFILER_SECONDS', cast=float, default=10)
+CHAT_PROFILER_MAX_SECONDS = config('CHAT_PROFILER_MAX_SECONDS', cast=float, default=120)
+CHAT_PROFILER_INTERVAL = config('CHAT_PROFILER_INTERVAL', cast=float, default=0.01)
+CHAT_PROFILER_DIR = config('CHAT_PROFILER_DIR', default=os.path.join(BASE_DIR, 'profiles'))
+
+# Serve the chat send/join endpoint from an async view that awaits group_send on
+# the event loop, instead of a sync view bridging to it with async_to_sync
+CHAT_ASYNC_VIEWS = config('CHAT_ASYNC_VIEWS', cast=bool, default=True)
+
+# Fire-and-forget fan-out: new messages are acknowledged as soon as they are saved
+# and broadcast by a per-worker queue that sends up to CHAT_FANOUT_BATCH_SIZE
+# events at a time, retrying channel layer failures CHAT_FANOUT_RETRIES times.
+# Needs an ASGI server; without one (WSGI, the test client) sends are awaited as
+# usual. Events still queued when a worker stops are not sent.
+CHAT_FANOUT_ASYNC = config('CHAT_FANOUT_ASYNC', cast=bool, default=False)
+CHAT_FANOUT_QUEUE_SIZE = config('CHAT_FANOUT_QUEUE_SIZE', cast=int, default=10000)
+CHAT_FANOUT_BATCH_SIZE = config('CHAT_FANOUT_BATCH_SIZE', cast=int, default=100)
+CHAT_FANOUT_RETRIES = config('CHAT_FANOUT_RETRIES', cast=int, default=3)
+CHAT_FANOUT_RETRY_DELAY = config('CHAT_FANOUT_RETRY_DELAY', cast=float, default=0.05)
@@ -15,13 +15,15 @@ Including another URLconf
     2. Add a URL to urlpatterns:  path('blog/', include('blog.urls'))
 """
 from django.contrib import admin
-from django.urls import path, include
+from django.urls import path, re_path, include
 from rest_framework import permissions
 from drf_yasg.views import get_schema_view
 from drf_yasg import openapi
 from rest_framework.routers import DefaultRouter
 from users.urls import router as usersrouter
 from chat.urls import router as chatrouter
+from chat.metrics import metrics_view
+from chat.views import ProfilerView, chat_view
 
 schema_view = get_schema_view(
     openapi.Info(
@@ -49,7 +51,11 @@ urlpatterns = [
 
 
     path('admin/', admin.site.urls),
-    path('api/v1/', include(router.urls))
+    # Async send/join; takes over ChatRoomViewSet.chat's URL
+    re_path(r'^api/v1/chatroom/(?P<room_id>[^/.]+)/chat/$', chat_view, name='chatroom-chat'),
+    path('api/v1/', include(router.urls)),
+    path('metrics', metrics_view, name='metrics'),
+    path('api/v1/profiler/', ProfilerView.as_view(), name='profiler'),
     
     # path('api/v1/', include('users.urls')),
     # path('api/v1/', include('chat.urls'))
@@ -6,7 +6,9 @@ from rest_framework.viewsets import ModelViewSet
 from rest_framework.decorators import action
 from .permissions import IsOwnerOrReadOnly
 from .serializers import UserSerializer, RegisterSerializer
-from chat.serializers import ChatRoomSerializer
+from chat.models import ChatRoom
+from chat.serializers import UserChatRoomSerializer
+from chat.unread import unread_counts
 
 
 # Create your views here.
@@ -33,6 +35,8 @@ class UserViewSet(ModelViewSet):
     
     @action(detail=True, methods=['get'], permission_classes=[IsOwnerOrReadOnly])
     def chatrooms(self, request, **kwargs):
-        chatrooms = request.user.chatrooms.all()
-        serializer = ChatRoomSerializer(chatrooms, many=True)
+        # Annotate before filtering so the count covers every member, not just this user
+        chatrooms = list(ChatRoom.objects.with_listing_data().filter(members=request.user))
+        counts = unread_counts(request.user, [chatroom.pk for chatroom in chatrooms])
+        serializer = UserChatRoomSerializer(chatrooms, many=True, context={'unread_counts': counts})
         return Response(serializer.data, status=status.HTTP_200_OK)